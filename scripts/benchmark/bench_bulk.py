@@ -0,0 +1,84 @@
+import random
+import time
+
+from transformers_gad.bulk import ACCEPT, PREFIX, REJECT, make_string_recognizer, recognize_strings
+from transformers_gad.complexity import min_heights, sample_string
+from transformers_gad.optimizer import decode_rules
+from transformers_gad.parser import parse_ebnf
+
+# (name, grammar), both are LALR(1), so every backend recognizes them
+GRAMMARS = [
+    ("repetition", 'root ::= ("a" [b-d]{1,3}){1,2} "z"?'),
+    (
+        "json",
+        r"""
+root   ::= object
+object ::= "{" ws ( string ":" ws value ("," ws string ":" ws value)* )? "}"
+value  ::= object | array | string | number | ("true" | "false" | "null") ws
+array  ::= "[" ws ( value ("," ws value)* )? "]" ws
+string ::= "\"" ( [a-zA-Z0-9] )* "\"" ws
+number ::= ("-"? ("0" | [1-9] [0-9]*)) ("." [0-9]+)? ([eE] [-+]? [0-9]+)? ws
+ws ::= ([ \t\n] ws)?
+""",
+    ),
+]
+BACKENDS = ["stack", "earley", "lalr"]
+NUM_STRINGS = 2000
+# characters appended to the truncated strings, so that some are rejected
+NOISE = 'abz{}[]":,0 '
+
+
+def make_strings(grammar_str, rng):
+    """
+    Strings sampled from the grammar, half of them truncated and some with a
+    random character appended, so that every verdict occurs.
+    """
+    state = parse_ebnf(grammar_str)
+    rules = decode_rules(state.grammar_encoding)
+    heights = min_heights(rules)
+    strings = []
+    for _ in range(NUM_STRINGS):
+        string = sample_string(rules, heights, state.symbol_table["root"], rng)
+        if rng.random() < 0.5:
+            string = string[: rng.randint(0, len(string))]
+        if rng.random() < 0.3:
+            string += rng.choice(NOISE)
+        strings.append(string)
+    return strings
+
+
+def main():
+    """
+    Check that the verdicts of recognize_strings match _accept_string and
+    _accept_prefix on every string for every backend, and time the two, both
+    from the grammar text.
+    """
+    rng = random.Random(0)
+    print(f"{'grammar':<12} {'backend':<8} {'bulk (ms)':>10} {'per-string (ms)':>16}")
+    for name, grammar_str in GRAMMARS:
+        strings = make_strings(grammar_str, rng)
+        for backend in BACKENDS:
+            start = time.perf_counter()
+            verdicts = [verdict for _, verdict in recognize_strings(grammar_str, strings, backend=backend)]
+            bulk_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            recognizer = make_string_recognizer(grammar_str, backend=backend)
+            expected = [
+                ACCEPT
+                if recognizer._accept_string(string)
+                else PREFIX
+                if recognizer._accept_prefix(string)
+                else REJECT
+                for string in strings
+            ]
+            per_string_time = time.perf_counter() - start
+            for string, verdict, expected_verdict in zip(strings, verdicts, expected):
+                assert verdict == expected_verdict, (name, backend, string, verdict, expected_verdict)
+            print(
+                f"{name:<12} {backend:<8} {bulk_time * 1000:>10.1f} {per_string_time * 1000:>16.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
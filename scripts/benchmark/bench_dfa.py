@@ -0,0 +1,71 @@
+import glob
+import random
+import time
+
+from transformers_gad.complexity import count_stacks, min_heights, sample_string
+from transformers_gad.dfa import compile_dfa_grammar
+from transformers_gad.optimizer import decode_rules, optimize_grammar
+from transformers_gad.parser import parse_ebnf
+from transformers_gad.recognizer import StringRecognizer
+
+GRAMMAR_PATHS = sorted(glob.glob("examples/grammars/*.ebnf") + glob.glob("examples/test/*.ebnf"))
+START_RULE_NAME = "root"
+NUM_SAMPLES = 50
+SEED = 0
+
+
+def main():
+    """
+    Compare the optimized grammars with and without the regular rules compiled
+    into DFAs: live stacks while consuming sampled strings, entries of the
+    per-stack code point cache, and the time to recognize the samples.
+    """
+    rng = random.Random(SEED)
+    header = (
+        f"{'grammar':<22} {'rules':>11} {'total stacks':>17} {'max stacks':>11} "
+        f"{'cache entries':>15} {'time (ms)':>15}"
+    )
+    print(header)
+    for path in GRAMMAR_PATHS:
+        with open(path, "r") as f:
+            state = parse_ebnf(f.read())
+        optimized_state = optimize_grammar(state, START_RULE_NAME)
+        compiled_state = compile_dfa_grammar(optimized_state, START_RULE_NAME)
+
+        start_rule_id = state.symbol_table[START_RULE_NAME]
+        rules = decode_rules(state.grammar_encoding)
+        heights = min_heights(rules)
+        samples = [
+            sample_string(rules, heights, start_rule_id, rng) for _ in range(NUM_SAMPLES)
+        ]
+
+        totals, peaks, entries, times = [], [], [], []
+        for s in (optimized_state, compiled_state):
+            recognizer = StringRecognizer(s.grammar_encoding, start_rule_id)
+            start = time.perf_counter()
+            for sample in samples:
+                assert recognizer._accept_string(sample), sample
+            times.append((time.perf_counter() - start) * 1000)
+            entries.append(len(recognizer.caches["consume_code_point_per_stack"]))
+
+            total, peak = 0, 0
+            for sample in samples:
+                sample_total, sample_peak, _ = count_stacks(recognizer, sample)
+                total += sample_total
+                peak = max(peak, sample_peak)
+            totals.append(total)
+            peaks.append(peak)
+
+        name = path.split("/")[-1]
+        print(
+            f"{name:<22} "
+            f"{len(optimized_state.symbol_table):>5}>{len(compiled_state.symbol_table):<5} "
+            f"{totals[0]:>8}>{totals[1]:<8} "
+            f"{peaks[0]:>5}>{peaks[1]:<5} "
+            f"{entries[0]:>7}>{entries[1]:<7} "
+            f"{times[0]:>7.1f}>{times[1]:<7.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
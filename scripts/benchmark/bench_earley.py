@@ -0,0 +1,110 @@
+import itertools
+import time
+
+from transformers_gad.earley import EarleyRecognizer
+from transformers_gad.parser import parse_ebnf
+from transformers_gad.recognizer import StringRecognizer
+
+# (name, grammar, input of about n characters, input lengths, whether the
+# stack recognizer supports the grammar)
+GRAMMARS = [
+    (
+        "brackets",
+        'root ::= x\nx ::= "a" x "b" | "a" x "c" | ""',
+        lambda n: "a" * (n // 2) + "bc" * (n // 4),
+        [8, 16, 24, 32],
+        True,
+    ),
+    (
+        "palindrome",
+        'root ::= p\np ::= "a" p "a" | "b" p "b" | "a" | "b" | ""',
+        lambda n: "ab" * (n // 4) + "ba" * (n // 4),
+        [32, 64, 128],
+        True,
+    ),
+    (
+        "catalan",
+        'root ::= s\ns ::= "a" s s | "a" | ""',
+        lambda n: "a" * n,
+        [32, 64, 128],
+        True,
+    ),
+    (
+        "left-recursive",
+        'root ::= e\ne ::= e "+" t | t\nt ::= t "*" f | f\nf ::= [0-9] | "(" e ")"',
+        lambda n: "+".join("1*2" for _ in range(n // 4)),
+        [32, 64, 128],
+        False,
+    ),
+]
+
+# bounded repetitions, nested and through rule references, on which the two
+# recognizers must agree on every string up to CHECK_LENGTH characters
+REPETITION_GRAMMARS = [
+    'root ::= x x\nx ::= "a"{1,2}',
+    'root ::= ("a"{1,2}){2}',
+    'root ::= ("a" "b"?){1,3} "c"?',
+    'root ::= (x{0,2} "b"){2,3}\nx ::= "a"{1,2} | "c"',
+    'root ::= x{2,}\nx ::= "a"{0,2} "b"',
+]
+CHECK_LENGTH = 8
+
+
+def check_repetitions():
+    """
+    Check that the Earley recognizer accepts the same strings as the stack
+    recognizer on the grammars of REPETITION_GRAMMARS.
+    """
+    for grammar_str in REPETITION_GRAMMARS:
+        state = parse_ebnf(grammar_str)
+        start_rule_id = state.symbol_table["root"]
+        stack = StringRecognizer(state.grammar_encoding, start_rule_id)
+        earley = EarleyRecognizer(state.grammar_encoding, start_rule_id)
+        for n in range(CHECK_LENGTH + 1):
+            for chars in itertools.product("abc", repeat=n):
+                string = "".join(chars)
+                assert earley._accept_string(string) == stack._accept_string(string), (
+                    grammar_str,
+                    string,
+                )
+                assert earley._accept_prefix(string) == stack._accept_prefix(string), (
+                    grammar_str,
+                    string,
+                )
+
+
+def time_recognizer(recognizer, string):
+    start = time.perf_counter()
+    assert recognizer._accept_string(string), string
+    return time.perf_counter() - start
+
+
+def main():
+    """
+    Time the stack and the Earley recognizers on ambiguous grammars, from
+    cold caches. The number of stacks can grow exponentially with the input
+    on such grammars, while an Earley set has O(|G| n) items, so the Earley
+    recognizer is polynomial. It also supports left recursion.
+    """
+    check_repetitions()
+    print(f"{'grammar':<16} {'chars':>6} {'stack (ms)':>11} {'earley (ms)':>12}")
+    for name, grammar_str, make_input, lengths, stack_supported in GRAMMARS:
+        state = parse_ebnf(grammar_str)
+        start_rule_id = state.symbol_table["root"]
+        for n in lengths:
+            string = make_input(n)
+            times = {}
+            if stack_supported:
+                recognizer = StringRecognizer(state.grammar_encoding, start_rule_id)
+                times["stack"] = time_recognizer(recognizer, string)
+            recognizer = EarleyRecognizer(state.grammar_encoding, start_rule_id)
+            times["earley"] = time_recognizer(recognizer, string)
+            columns = [
+                f"{times[backend] * 1000:.1f}" if backend in times else "-"
+                for backend in ("stack", "earley")
+            ]
+            print(f"{name:<16} {len(string):>6} {columns[0]:>11} {columns[1]:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import itertools
+import time
+
+from transformers_gad.lalr import LalrRecognizer
+from transformers_gad.parser import parse_ebnf
+from transformers_gad.recognizer import StringRecognizer
+from transformers_gad.vocab_struct import LEAF
+
+# examples/grammars/json.ebnf with an unambiguous number rule, it is LALR(1)
+GRAMMAR = r"""
+root   ::= object
+object ::= "{" ws ( string ":" ws value ("," ws string ":" ws value)* )? "}"
+value  ::= object | array | string | number | ("true" | "false" | "null") ws
+array  ::= "[" ws ( value ("," ws value)* )? "]" ws
+string ::= "\"" ( [a-zA-Z0-9] )* "\"" ws
+number ::= ("-"? ("0" | [1-9] [0-9]*)) ("." [0-9]+)? ([eE] [-+]? [0-9]+)? ws
+ws ::= ([ \t\n] ws)?
+"""
+DOCUMENT = '{"name": "gad", "tags": ["a", "b", {"k": [1, 2.5, -3e10]}], "ok": true, "n": null}'
+ALPHABET = '{}[]":,- \n.0123456789abeklnrstu'
+WORDS = ["true", "false", "null", '": ', '", "', "], ", '": [', '": {']
+
+
+def make_trie():
+    """
+    Token trie of a synthetic vocabulary: the strings of one or two
+    characters of the alphabet and a few longer JSON fragments.
+    """
+    tokens = list(ALPHABET) + ["".join(pair) for pair in itertools.product(ALPHABET, repeat=2)]
+    tokens += WORDS
+    trie = {}
+    for token_id, token in enumerate(tokens):
+        node = trie
+        for byte in token.encode("utf-8"):
+            node = node.setdefault(byte, {})
+        node[LEAF] = token_id
+    return trie
+
+
+def count_accepted_tokens(trie, stacks, recognizer) -> int:
+    """
+    The number of tokens accepted from the stacks, by the same walk as
+    check_token_acceptance_in_trie.
+    """
+    first_bytes = recognizer._first_bytes(stacks)
+    accepted = 0
+    for byte, next_trie in trie.items():
+        if byte == LEAF:
+            accepted += 1
+            continue
+        if not (first_bytes >> byte) & 1:
+            continue
+        new_stacks = recognizer._step_stacks(byte, stacks)
+        if new_stacks:
+            accepted += count_accepted_tokens(next_trie, new_stacks, recognizer)
+    return accepted
+
+
+def main():
+    """
+    Time the token mask walks along a JSON document for the stack and the
+    LALR(1) recognizers: the stack recognizer walks the trie with all its
+    stacks, the LALR one with a single LR stack.
+    """
+    state = parse_ebnf(GRAMMAR)
+    start_rule_id = state.symbol_table["root"]
+    trie = make_trie()
+
+    start = time.perf_counter()
+    lalr = LalrRecognizer(state.grammar_encoding, start_rule_id)
+    build_time = time.perf_counter() - start
+    print(f"LALR(1) tables: {len(lalr.kernels)} states, built in {build_time * 1000:.1f} ms")
+
+    stack = StringRecognizer(state.grammar_encoding, start_rule_id)
+
+    print(f"{'backend':<8} {'stacks/state':>13} {'masks (ms)':>11} {'accepted':>9}")
+    for name, recognizer in (("stack", stack), ("lalr", lalr)):
+        accept_state = recognizer.get_initial_accept_state()
+        num_stacks = 0
+        accepted = 0
+        start = time.perf_counter()
+        for char in DOCUMENT:
+            num_stacks += len(accept_state.stacks)
+            accepted += count_accepted_tokens(trie, accept_state.stacks, recognizer)
+            accept_state = recognizer._consume_bytes(char.encode("utf-8"), accept_state)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:<8} {num_stacks / len(DOCUMENT):>13.1f} {elapsed * 1000:>11.1f} {accepted:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import glob
+import random
+import time
+
+from transformers_gad.complexity import min_heights, sample_string
+from transformers_gad.optimizer import decode_rules
+from transformers_gad.parser import parse_ebnf
+from transformers_gad.recognizer import StringRecognizer
+
+GRAMMAR_PATHS = sorted(glob.glob("examples/grammars/*.ebnf"))
+START_RULE_NAME = "root"
+NUM_SAMPLES = 50
+NUM_REPEATS = 5
+SEED = 0
+
+
+def main():
+    """
+    Time the recognition of sampled strings once the lazy DFA over the parse
+    states is warm, i.e. every transition has been taken once already.
+    """
+    rng = random.Random(SEED)
+    print(
+        f"{'grammar':<22} {'cold (us/char)':>15} {'warm (us/char)':>15} "
+        f"{'states':>7} {'transitions':>12} {'classes':>8}"
+    )
+    for path in GRAMMAR_PATHS:
+        with open(path, "r") as f:
+            state = parse_ebnf(f.read())
+        start_rule_id = state.symbol_table[START_RULE_NAME]
+        rules = decode_rules(state.grammar_encoding)
+        heights = min_heights(rules)
+        samples = [
+            sample_string(rules, heights, start_rule_id, rng) for _ in range(NUM_SAMPLES)
+        ]
+        num_chars = sum(map(len, samples))
+
+        recognizer = StringRecognizer(state.grammar_encoding, start_rule_id)
+        start = time.perf_counter()
+        for sample in samples:
+            assert recognizer._accept_string(sample), sample
+        cold = (time.perf_counter() - start) / num_chars
+
+        start = time.perf_counter()
+        for _ in range(NUM_REPEATS):
+            for sample in samples:
+                recognizer._accept_string(sample)
+        warm = (time.perf_counter() - start) / NUM_REPEATS / num_chars
+
+        name = path.split("/")[-1]
+        print(
+            f"{name:<22} {cold * 1e6:>15.2f} {warm * 1e6:>15.2f} "
+            f"{len(recognizer.states):>7} {len(recognizer.state_dfa):>12} "
+            f"{recognizer.state_dfa.num_classes:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
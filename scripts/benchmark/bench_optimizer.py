@@ -0,0 +1,63 @@
+import glob
+import random
+
+from transformers_gad.complexity import count_stacks, min_heights, sample_string
+from transformers_gad.optimizer import decode_rules, optimize_grammar
+from transformers_gad.parser import parse_ebnf
+from transformers_gad.recognizer import StringRecognizer
+
+GRAMMAR_PATHS = sorted(glob.glob("examples/grammars/*.ebnf") + glob.glob("examples/test/*.ebnf"))
+START_RULE_NAME = "root"
+NUM_SAMPLES = 50
+SEED = 0
+
+
+def main():
+    rng = random.Random(SEED)
+    header = (
+        f"{'grammar':<22} {'rules':>11} {'encoding':>11} "
+        f"{'total stacks':>17} {'max stacks':>11} {'stack elements':>17}"
+    )
+    print(header)
+    for path in GRAMMAR_PATHS:
+        with open(path, "r") as f:
+            state = parse_ebnf(f.read())
+        optimized_state = optimize_grammar(state, START_RULE_NAME)
+
+        start_rule_id = state.symbol_table[START_RULE_NAME]
+        rules = decode_rules(state.grammar_encoding)
+        heights = min_heights(rules)
+        samples = [
+            sample_string(rules, heights, start_rule_id, rng) for _ in range(NUM_SAMPLES)
+        ]
+
+        recognizers = [
+            StringRecognizer(s.grammar_encoding, s.symbol_table[START_RULE_NAME])
+            for s in (state, optimized_state)
+        ]
+        totals, peaks, depths = [], [], []
+        for recognizer in recognizers:
+            total, peak, depth = 0, 0, 0
+            for sample in samples:
+                assert recognizer._accept_string(sample), sample
+                sample_total, sample_peak, sample_depth = count_stacks(recognizer, sample)
+                total += sample_total
+                peak = max(peak, sample_peak)
+                depth += sample_depth
+            totals.append(total)
+            peaks.append(peak)
+            depths.append(depth)
+
+        name = path.split("/")[-1]
+        print(
+            f"{name:<22} "
+            f"{len(state.symbol_table):>5}>{len(optimized_state.symbol_table):<5} "
+            f"{len(state.grammar_encoding):>5}>{len(optimized_state.grammar_encoding):<5} "
+            f"{totals[0]:>8}>{totals[1]:<8} "
+            f"{peaks[0]:>5}>{peaks[1]:<5} "
+            f"{depths[0]:>8}>{depths[1]:<8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
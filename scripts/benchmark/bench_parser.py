@@ -0,0 +1,103 @@
+import re
+import time
+
+from transformers_gad.parser import _parse_rhs_char_ranges, parse_ebnf
+from transformers_gad.parser_cfg import parse_ebnf as parse_ebnf_slicing
+
+GRAMMAR_PATH = "examples/grammars/c.ebnf"
+# Sizes of the synthetic grammars, in bytes
+SIZES = [16_000, 64_000, 256_000, 1_000_000, 4_000_000]
+# The slicing parser is quadratic, only run it on the small grammars
+MAX_SLICING_SIZE = 300_000
+NUM_REPEAT = 3
+
+# Literal strings, char ranges and comments are kept as is, anything else that
+# looks like a name is a rule name
+TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|\[(?:\\.|[^\]\\])*\]|#[^\n]*|([a-zA-Z0-9_-]+)')
+
+
+def rename_rules(grammar_str, suffix):
+    """
+    Rename every rule of the grammar so that copies of it can be concatenated.
+    """
+    return TOKEN.sub(
+        lambda m: m.group(1) + suffix if m.group(1) else m.group(0), grammar_str
+    )
+
+
+def spell_negated_classes(grammar_str):
+    """
+    Replace every negated char range of the grammar by its complement ranges,
+    which the slicing parser, reading [^...] as a class with a literal '^',
+    encodes the same way as the cursor parser.
+    """
+
+    def spell(m):
+        if not m.group(0).startswith("[^"):
+            return m.group(0)
+        outbuf = []
+        _parse_rhs_char_ranges(m.group(0), 0, outbuf)
+        chars = []
+        for code_point in outbuf[1:]:
+            char = chr(code_point)
+            assert char != "\\", "the slicing parser cannot escape a backslash"
+            chars.append("\\" + char if char in '"[]' else char)
+        return "[" + "".join(a + "-" + b for a, b in zip(chars[::2], chars[1::2])) + "]"
+
+    return TOKEN.sub(spell, grammar_str)
+
+
+def make_grammar(base_grammar, size):
+    """
+    Build a grammar of (at least) `size` bytes by concatenating renamed copies
+    of `base_grammar`, all reachable from a common root rule.
+    """
+    copies = []
+    total = 0
+    i = 0
+    while total < size:
+        copy = rename_rules(base_grammar, f"_{i}")
+        copies.append(copy)
+        total += len(copy)
+        i += 1
+    root = "root ::= " + " | ".join(f"root_{j}" for j in range(i)) + "\n"
+    return root + "".join(copies)
+
+
+def time_parse(parse, grammar_str):
+    best = float("inf")
+    state = None
+    for _ in range(NUM_REPEAT):
+        start = time.perf_counter()
+        state = parse(grammar_str)
+        best = min(best, time.perf_counter() - start)
+    return best, state
+
+
+def main():
+    with open(GRAMMAR_PATH, "r") as f:
+        base_grammar = f.read()
+
+    print(f"{'size (KB)':>10} {'cursor (s)':>12} {'us/KB':>8} {'slicing (s)':>12} {'us/KB':>8}")
+    for size in SIZES:
+        grammar_str = make_grammar(base_grammar, size)
+        kb = len(grammar_str) / 1000
+
+        cursor_time, state = time_parse(parse_ebnf, grammar_str)
+        assert state.grammar_encoding, "grammar failed to parse"
+        row = f"{kb:>10.0f} {cursor_time:>12.3f} {cursor_time / kb * 1e6:>8.1f}"
+
+        if len(grammar_str) <= MAX_SLICING_SIZE:
+            slicing_time, slicing_state = time_parse(
+                parse_ebnf_slicing, spell_negated_classes(grammar_str)
+            )
+            assert slicing_state.grammar_encoding == state.grammar_encoding
+            assert slicing_state.symbol_table == state.symbol_table
+            row += f" {slicing_time:>12.3f} {slicing_time / kb * 1e6:>8.1f}"
+        else:
+            row += f" {'-':>12} {'-':>8}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import time
+
+from transformers_gad.parser import parse_ebnf
+from transformers_gad.recognizer import StringRecognizer
+
+GRAMMAR_PATH = "examples/grammars/json.ebnf"
+START_RULE_NAME = "root"
+DEPTHS = [8, 32, 128, 256]
+NUM_REPEATS = 5
+
+
+def nested_json(depth):
+    """
+    A JSON value nested `depth` levels deep, every level adds a few elements
+    to the bottom of every stack.
+    """
+    value = "1"
+    for i in range(depth):
+        value = f'{{"k{i}": [{value}, true]}}' if i % 2 else f"[{value}, null]"
+    return value
+
+
+def main():
+    """
+    Time the recognition of deeply nested JSON from cold caches, the stacks
+    get deeper with the nesting while the number of live stacks stays small.
+    """
+    with open(GRAMMAR_PATH, "r") as f:
+        state = parse_ebnf(f.read())
+    recognizer = StringRecognizer(state.grammar_encoding, state.symbol_table[START_RULE_NAME])
+
+    print(f"{'depth':>6} {'chars':>7} {'time (ms)':>10}")
+    for depth in DEPTHS:
+        string = nested_json(depth)
+        best = float("inf")
+        for _ in range(NUM_REPEATS):
+            recognizer.clear_caches()
+            start = time.perf_counter()
+            assert recognizer._accept_string(string)
+            best = min(best, time.perf_counter() - start)
+        print(f"{depth:>6} {len(string):>7} {best * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import pytest
+
+
+class FakeLlamaTokenizer:
+    """
+    A Llama-like BPE tokenizer over a handful of tokens, enough for
+    get_mapping to pick the Llama BPE mapping, whose '▁' is a space except
+    right after BOS.
+    """
+
+    vocab = ["<unk>", "<s>", "</s>", "▁{", "{", "}", "▁}", "x", "▁x"]
+    bos_token_id = 1
+    eos_token_id = 2
+    all_special_ids = [0, 1, 2]
+    is_fast = True
+
+    class _Backend:
+        def to_str(self):
+            return '{"model": {"type": "BPE"}, "pre_tokenizer": null}'
+
+    _tokenizer = _Backend()
+
+    def get_vocab(self):
+        return {token: token_id for token_id, token in enumerate(self.vocab)}
+
+    def convert_ids_to_tokens(self, token_id):
+        return self.vocab[token_id]
+
+    def decode(self, token_ids, **kwargs):
+        return "".join(self.vocab[token_id] for token_id in token_ids).replace("▁", " ")
+
+
+@pytest.fixture
+def llama_tokenizer():
+    return FakeLlamaTokenizer()
@@ -0,0 +1,89 @@
+import itertools
+import os
+
+import pytest
+
+from transformers_gad.backends import check_backend, make_recognizer
+from transformers_gad.bulk import make_string_recognizer
+from transformers_gad.grammar_cache import load_compiled_grammar
+from transformers_gad.lalr import LalrRecognizer
+
+# (grammar, alphabet), every string over the alphabet up to MAX_LENGTH is checked
+GRAMMARS = [
+    ('root ::= ("a" [b-d]{1,3}){1,2} "z"?', "abdz"),
+    ('root ::= x x\nx ::= "a"{1,2}', "ab"),
+    ('root ::= ("a" | "ab")* "b"', "ab"),
+    ('root ::= "(" root ")" root | ""', "()"),
+    ('root ::= [^a]+ "a"', "abé"),
+    ('root ::= "é"{2,} | "e"', "eé"),
+]
+# the grammars of GRAMMARS that are LALR(1)
+LALR_GRAMMARS = [GRAMMARS[0], GRAMMARS[3], GRAMMARS[4], GRAMMARS[5]]
+MAX_LENGTH = 6
+JSON_GRAMMAR = os.path.join(os.path.dirname(__file__), os.pardir, "examples", "grammars", "json.ebnf")
+
+
+def all_strings(alphabet):
+    for length in range(MAX_LENGTH + 1):
+        for chars in itertools.product(alphabet, repeat=length):
+            yield "".join(chars)
+
+
+def assert_same_verdicts(grammar_str, alphabet, backend):
+    stack = make_string_recognizer(grammar_str)
+    recognizer = make_string_recognizer(grammar_str, backend=backend)
+    for string in all_strings(alphabet):
+        assert recognizer._accept_string(string) == stack._accept_string(string), string
+        assert recognizer._accept_prefix(string) == stack._accept_prefix(string), string
+
+
+@pytest.mark.parametrize("grammar_str, alphabet", GRAMMARS)
+def test_earley_matches_stack(grammar_str, alphabet):
+    assert_same_verdicts(grammar_str, alphabet, "earley")
+
+
+def test_earley_accepts_left_recursion():
+    recognizer = make_string_recognizer('root ::= root "a" | "b"', backend="earley")
+    assert recognizer._accept_string("baa")
+    assert recognizer._accept_prefix("ba")
+    assert not recognizer._accept_string("a")
+    assert not recognizer._accept_prefix("ab")
+
+
+@pytest.mark.parametrize("grammar_str, alphabet", LALR_GRAMMARS)
+def test_lalr_matches_stack(grammar_str, alphabet):
+    recognizer, backend = make_recognizer(load_compiled_grammar(grammar_str), "lalr")
+    assert backend == "lalr"
+    assert isinstance(recognizer, LalrRecognizer)
+    assert_same_verdicts(grammar_str, alphabet, "lalr")
+
+
+@pytest.mark.parametrize("grammar_str, alphabet", [GRAMMARS[1], GRAMMARS[2]])
+def test_lalr_conflict_falls_back_to_stack(grammar_str, alphabet):
+    recognizer, backend = make_recognizer(load_compiled_grammar(grammar_str), "lalr")
+    assert backend == "stack"
+    assert not isinstance(recognizer, LalrRecognizer)
+    assert_same_verdicts(grammar_str, alphabet, "lalr")
+
+
+def test_json_grammar_falls_back_to_stack():
+    with open(JSON_GRAMMAR, "r") as f:
+        grammar_str = f.read()
+    _, backend = make_recognizer(load_compiled_grammar(grammar_str), "lalr")
+    assert backend == "stack"
+
+
+@pytest.mark.parametrize(
+    "backend, options",
+    [
+        ("earley", {"compile_dfa": True}),
+        ("lalr", {"compile_dfa": True}),
+        ("earley", {"vectorized": True}),
+        ("packrat", {}),
+    ],
+)
+def test_unsupported_options_are_rejected(backend, options):
+    with pytest.raises(ValueError):
+        check_backend(backend, **options)
+    with pytest.raises(ValueError):
+        make_string_recognizer('root ::= "a"', backend=backend, **options)
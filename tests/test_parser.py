@@ -0,0 +1,58 @@
+import glob
+import os
+import re
+
+import pytest
+
+from transformers_gad.parser import MAX_CODE_POINT, parse_ebnf
+from transformers_gad.parser_cfg import parse_ebnf as parse_ebnf_slicing
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "examples")
+EXAMPLE_GRAMMARS = sorted(glob.glob(os.path.join(EXAMPLES_DIR, "**", "*.ebnf"), recursive=True))
+
+NEGATED_CLASS = re.compile(r'"(?:\\.|[^"\\])*"|\[\^(?:\\.|[^\]\\])*\]')
+
+
+def spell_negated_classes(grammar_str):
+    """
+    The grammar with its negated classes written as their complement ranges,
+    which the slicing parser reads as a class with a literal '^'.
+    """
+
+    def spell(m):
+        if not m.group(0).startswith("[^"):
+            return m.group(0)
+        state = parse_ebnf("root ::= " + m.group(0))
+        # root ::= [ranges], the ranges follow the alternative size and their count
+        num_chars = state.grammar_encoding[2]
+        code_points = state.grammar_encoding[3 : 3 + num_chars]
+        chars = ["\\" + chr(c) if chr(c) in '"[]' else chr(c) for c in code_points]
+        return "[" + "".join(a + "-" + b for a, b in zip(chars[::2], chars[1::2])) + "]"
+
+    return NEGATED_CLASS.sub(spell, grammar_str)
+
+
+@pytest.mark.parametrize("path", EXAMPLE_GRAMMARS, ids=os.path.basename)
+def test_cursor_parser_matches_slicing_parser(path):
+    with open(path, "r") as f:
+        grammar_str = f.read()
+    state = parse_ebnf(grammar_str)
+    slicing_state = parse_ebnf_slicing(spell_negated_classes(grammar_str))
+    assert state.grammar_encoding
+    assert state.grammar_encoding == slicing_state.grammar_encoding
+    assert state.symbol_table == slicing_state.symbol_table
+
+
+def test_negated_class_is_its_complement():
+    state = parse_ebnf('root ::= [^a-c\\n]')
+    num_chars = state.grammar_encoding[2]
+    ranges = state.grammar_encoding[3 : 3 + num_chars]
+    assert ranges == [0, ord("\n") - 1, ord("\n") + 1, ord("a") - 1, ord("c") + 1, MAX_CODE_POINT]
+
+
+def test_large_grammar_parses_like_its_parts():
+    rule = 'r{i} ::= "x" [0-9]* | r{j} "y"\n'
+    grammar_str = "".join(rule.format(i=i, j=(i + 1) % 500) for i in range(500))
+    state = parse_ebnf(grammar_str)
+    assert len(state.symbol_table) >= 500
+    assert state.grammar_encoding == parse_ebnf_slicing(grammar_str).grammar_encoding
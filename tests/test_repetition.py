@@ -0,0 +1,61 @@
+import pytest
+
+from transformers_gad.bulk import make_string_recognizer
+from transformers_gad.parser import REPEAT_MARKER, REPEAT_UNBOUNDED, parse_ebnf
+
+
+@pytest.mark.parametrize(
+    "repetition, min_count, max_count",
+    [("{2}", 2, 2), ("{2,}", 2, REPEAT_UNBOUNDED), ("{1,3}", 1, 3), ("{ 1 , 3 }", 1, 3)],
+)
+def test_bounded_repetition_is_a_counter(repetition, min_count, max_count):
+    state = parse_ebnf('root ::= "a"' + repetition)
+    a_id = state.symbol_table["root_1"]
+    # the repeated literal becomes its own rule, referenced by the counter
+    assert state.grammar_encoding[:7] == [a_id, 4, 2, ord("a"), ord("a"), 0, 0]
+    assert state.grammar_encoding[7:] == [
+        state.symbol_table["root"],
+        5,
+        REPEAT_MARKER,
+        a_id,
+        min_count,
+        max_count,
+        0,
+        0,
+        0xFFFF,
+    ]
+
+
+def test_repeated_reference_is_not_wrapped():
+    state = parse_ebnf('root ::= x{2,3}\nx ::= "a"')
+    root = state.grammar_encoding[: state.grammar_encoding.index(0, 2) + 2]
+    assert root == [state.symbol_table["root"], 5, REPEAT_MARKER, state.symbol_table["x"], 2, 3, 0, 0]
+
+
+def test_zero_repetition_is_dropped_and_one_is_kept():
+    assert parse_ebnf('root ::= "a"{0} "b"').grammar_encoding == parse_ebnf('root ::= "b"').grammar_encoding
+    assert parse_ebnf('root ::= "a"{1}').grammar_encoding == parse_ebnf('root ::= "a"').grammar_encoding
+
+
+@pytest.mark.parametrize("repetition", ["{3,1}", "{", "{,2}", "{1,2"])
+def test_invalid_repetition_is_rejected(repetition):
+    assert parse_ebnf('root ::= "a"' + repetition).grammar_encoding == []
+
+
+@pytest.mark.parametrize(
+    "grammar_str, counts",
+    [
+        ('root ::= "a"{2}', [2]),
+        ('root ::= "a"{2,}', [2, 3, 4, 5, 6, 7, 8]),
+        ('root ::= "a"{1,3}', [1, 2, 3]),
+        ('root ::= "a"{0,2}', [0, 1, 2]),
+        ('root ::= ("a"{1,2}){2}', [2, 3, 4]),
+        ('root ::= x x\nx ::= "a"{1,2}', [2, 3, 4]),
+        ('root ::= ("a" | "aa"){2,3}', [2, 3, 4, 5, 6]),
+    ],
+)
+def test_repetition_counts(grammar_str, counts):
+    recognizer = make_string_recognizer(grammar_str)
+    for count in range(9):
+        assert recognizer._accept_string("a" * count) == (count in counts), count
+        assert recognizer._accept_prefix("a" * count) == (count <= max(counts)), count
@@ -0,0 +1,57 @@
+import pytest
+
+from transformers_gad.token_grammar_recognizer import IncrementalTokenRecognizer
+
+GRAMMAR = 'root ::= "{" "x"* "}" | " {" "x"* " }"'
+BOS, SPACE_BRACE, BRACE, CLOSE, X = 1, 3, 4, 5, 7
+
+
+@pytest.fixture(params=["stack", "lalr"])
+def recognizer(request, llama_tokenizer):
+    return IncrementalTokenRecognizer(GRAMMAR, "root", llama_tokenizer, backend=request.param)
+
+
+def test_fork_and_rollback_round_trip(recognizer):
+    root = recognizer.snapshot()
+    prefix = recognizer.fork(root, [BOS, SPACE_BRACE])
+    branch = recognizer.fork(prefix, [X, X, CLOSE])
+    assert branch.num_tokens == 5
+    assert branch.token_ids() == [BOS, SPACE_BRACE, X, X, CLOSE]
+    assert recognizer.string_recognizer._can_stop(branch.accept_state.stacks)
+    assert recognizer.rollback(branch, 3) is prefix
+    assert recognizer.rollback(branch, 5) is root
+    assert root.accept_state == recognizer.string_recognizer.get_initial_accept_state()
+    with pytest.raises(ValueError):
+        recognizer.rollback(branch, 6)
+
+
+def test_forks_share_their_snapshot(recognizer):
+    prefix = recognizer.fork(recognizer.snapshot(), [BOS, SPACE_BRACE])
+    state_before = prefix.accept_state
+    first = recognizer.fork(prefix, [X])
+    second = recognizer.fork(prefix, [CLOSE])
+    assert first.rollback() is second.rollback() is prefix
+    assert prefix.accept_state == state_before
+    assert first.accept_state != second.accept_state
+    # the same tokens again reach the same state
+    assert recognizer.fork(prefix, [X]).accept_state == first.accept_state
+
+
+def test_dumps_and_loads_round_trip(recognizer):
+    snapshot = recognizer.fork(recognizer.snapshot(), [BOS, BRACE, X])
+    loaded = recognizer.loads_snapshot(recognizer.dumps_snapshot(snapshot))
+    assert loaded.accept_state == snapshot.accept_state
+    assert loaded.num_tokens == snapshot.num_tokens
+    assert loaded.parent is None
+    assert (
+        recognizer.fork(loaded, [X, CLOSE]).accept_state
+        == recognizer.fork(snapshot, [X, CLOSE]).accept_state
+    )
+
+
+def test_earley_snapshots_cannot_be_dumped(llama_tokenizer):
+    recognizer = IncrementalTokenRecognizer(GRAMMAR, "root", llama_tokenizer, backend="earley")
+    snapshot = recognizer.fork(recognizer.snapshot(), [BOS, BRACE])
+    assert recognizer.rollback(snapshot, 2).accept_state == recognizer.snapshot().accept_state
+    with pytest.raises(ValueError):
+        recognizer.dumps_snapshot(snapshot)
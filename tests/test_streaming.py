@@ -0,0 +1,65 @@
+import pytest
+
+from transformers_gad.bulk import make_string_recognizer
+from transformers_gad.streaming import StreamingValidator
+
+GRAMMAR = 'root ::= ([à-ü] | "一" [a-c]? | [😀-😂] "x")+ "!"'
+STRINGS = ["", "à", "ü!", "一", "一b!", "一d", "😀x😂x!", "😀!", "à一😁x!", "!", "ý", "a"]
+OPTIONS = [{}, {"compile_dfa": True}, {"backend": "earley"}, {"backend": "lalr"}]
+
+
+def chunks(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("options", OPTIONS, ids=str)
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5])
+def test_chunked_feed_matches_whole_string(options, chunk_size):
+    recognizer = make_string_recognizer(GRAMMAR, **options)
+    for string in STRINGS:
+        validator = StreamingValidator(recognizer)
+        fed = b""
+        for chunk in chunks(string.encode("utf-8"), chunk_size):
+            validator.feed(chunk)
+            fed += chunk
+            try:
+                prefix = fed.decode("utf-8")
+            except UnicodeDecodeError:
+                # the chunk ends in the middle of a character
+                assert validator.pending
+                continue
+            assert not validator.pending
+            assert validator.is_prefix_valid() == recognizer._accept_prefix(prefix), (string, prefix)
+        assert validator.is_prefix_valid() == recognizer._accept_prefix(string), string
+        assert validator.can_finish() == recognizer._accept_string(string), string
+
+
+def test_invalid_text_ignores_later_chunks():
+    validator = StreamingValidator.from_grammar(GRAMMAR)
+    assert not validator.feed("ý".encode("utf-8"))
+    assert not validator.feed("à!".encode("utf-8"))
+    assert not validator.can_finish()
+    validator.reset()
+    assert validator.feed("à!".encode("utf-8"))
+    assert validator.can_finish()
+
+
+def test_expected_next_chars():
+    validator = StreamingValidator.from_grammar(GRAMMAR)
+    expected = validator.expected_next_chars()
+    assert all(ord(c) in expected for c in "àé一😀😂")
+    assert all(ord(c) not in expected for c in "!ýa😃")
+
+    validator.feed("一".encode("utf-8"))
+    expected = validator.expected_next_chars()
+    assert all(ord(c) in expected for c in "abcà一😀!")
+    assert ord("d") not in expected
+
+    # the first three bytes of 😀 leave the completions of the character only
+    validator.feed("😀".encode("utf-8")[:3])
+    assert validator.pending == "😀".encode("utf-8")[:3]
+    assert validator.expected_next_chars().ranges() == [(ord("😀"), ord("😂"))]
+
+    validator.feed("😀".encode("utf-8")[3:] + b"x!")
+    assert validator.can_finish()
+    assert len(validator.expected_next_chars()) == 0
@@ -0,0 +1,86 @@
+import itertools
+
+import pytest
+
+from transformers_gad.mapping import BPEMapping, get_mapping
+from transformers_gad.token_grammar_recognizer import IncrementalTokenRecognizer
+
+# "{" right after BOS, " {" anywhere else
+GRAMMAR = 'root ::= "{" "x"* "}" | " {" "x"* " }"'
+BOS = 1
+SPACE_BRACE = 3  # "▁{"
+TOKENS = [3, 4, 5, 6, 7, 8]
+
+
+@pytest.fixture
+def recognizer(llama_tokenizer):
+    return IncrementalTokenRecognizer(GRAMMAR, "root", llama_tokenizer)
+
+
+def consume_uncached(recognizer, mapping, token_ids):
+    state = recognizer.string_recognizer.get_initial_accept_state()
+    for token_id in token_ids:
+        state = recognizer.string_recognizer._consume_bytes(mapping.map(token_id), state)
+        if not state.stacks:
+            break
+    return state
+
+
+def test_llama_mapping_has_a_context(recognizer):
+    assert isinstance(recognizer.mapping, BPEMapping)
+    assert recognizer.mapping.context() is False
+    recognizer.mapping.skip(BOS)
+    assert recognizer.mapping.context() is True
+
+
+def test_transition_depends_on_bos(recognizer):
+    string_recognizer = recognizer.string_recognizer
+    initial = string_recognizer.get_initial_accept_state()
+    recognizer.mapping.skip(BOS)
+    at_bos = recognizer._consume_token_bytes(SPACE_BRACE, initial)
+    recognizer.mapping.skip(SPACE_BRACE)
+    after_token = recognizer._consume_token_bytes(SPACE_BRACE, initial)
+    assert at_bos == string_recognizer._consume_bytes(b"{", initial)
+    assert after_token == string_recognizer._consume_bytes(b" {", initial)
+    assert at_bos != after_token
+
+    # both transitions are cached, each under its own context
+    recognizer.mapping.skip(BOS)
+    assert recognizer._consume_token_bytes(SPACE_BRACE, initial) == at_bos
+    assert recognizer._consume_token_bytes(SPACE_BRACE, initial) == after_token
+
+
+@pytest.mark.parametrize("use_prefix", [False, True])
+def test_cached_transitions_match_uncached(recognizer, llama_tokenizer, use_prefix):
+    mapping = get_mapping(llama_tokenizer)
+    initial = recognizer.string_recognizer.get_initial_accept_state()
+    # every sequence twice, the second time from the caches only
+    for _ in range(2):
+        for length in range(4):
+            for tail in itertools.product(TOKENS, repeat=length):
+                token_ids = [BOS, *tail]
+                recognizer.mapping.last_token_id = None
+                if use_prefix:
+                    state = recognizer._consume_prefix(token_ids, initial)
+                else:
+                    state = initial
+                    for token_id in token_ids:
+                        state = recognizer._consume_token_bytes(token_id, state)
+                        if not state.stacks:
+                            break
+                mapping.last_token_id = None
+                expected = consume_uncached(recognizer, mapping, token_ids)
+                assert state == expected, token_ids
+                assert recognizer.mapping.last_token_id == mapping.last_token_id, token_ids
+
+
+def test_prefix_cache_hit_records_last_token(recognizer):
+    initial = recognizer.string_recognizer.get_initial_accept_state()
+    recognizer._consume_prefix([BOS], initial)
+    recognizer.mapping.last_token_id = None
+    recognizer._consume_prefix([BOS], initial)
+    assert [stats.hits for stats in recognizer.cache_stats() if stats.name == "prefix_state"] == [1]
+    assert recognizer.mapping.last_token_id == BOS
+    # so the next token is at BOS
+    state = recognizer._consume_token_bytes(SPACE_BRACE, initial)
+    assert state == recognizer.string_recognizer._consume_bytes(b"{", initial)
@@ -0,0 +1,182 @@
+import logging
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from transformers_gad.grammar_analysis import GrammarTables, rule_alternatives
+from transformers_gad.parser import (
+    DFA_REF_MARKER,
+    REF_RULE_MARKER,
+    REPEAT_MARKER,
+)
+
+logger = logging.getLogger(__name__)
+
+# code points below this bound are stepped with a lookup table, see ArrayGrammar.byte_next
+BYTE_TABLE_SIZE = 256
+
+# element kinds, indexed by element offset in `ArrayGrammar.kind`
+KIND_NONE = 0
+KIND_TERMINAL = 1
+KIND_REF = 2
+KIND_DFA_REF = 3
+KIND_DFA_STATE = 4
+KIND_REPEAT = 5
+
+_KINDS = {
+    REF_RULE_MARKER: KIND_REF,
+    DFA_REF_MARKER: KIND_DFA_REF,
+    REPEAT_MARKER: KIND_REPEAT,
+}
+
+
+class ArrayGrammar:
+    """
+    Struct-of-arrays form of a grammar encoding, every per-element array is
+    indexed by element offset:
+    - `kind`: the KIND_* of the element, KIND_NONE for the other offsets,
+    - `size`: the number of ints of the element in the encoding,
+    - `next_offset`: the offset of the next element of the alternative, or
+      0 when the element is the last one,
+    - `range_begin`, `range_end`: the slice of the element in the flat range
+      arrays `range_low`, `range_high` and `range_target`, for terminals and
+      DFA states. The ranges of an element are sorted and disjoint, and
+      `range_target` holds the target state of a DFA transition,
+    - `productive`: whether the rest of the alternative from the element can
+      derive a string, see GrammarTables, always true for DFA states,
+    - `needs_advance`: whether a stack with the element on top has to go
+      through advance_stack, i.e. references, repetitions and accepting DFA
+      states.
+    Rules are `rule_alt_begin`, `rule_alt_end`, slices of `alt_first`, the
+    offset of the first element of every alternative, 0 if it is empty.
+
+    For the code points below BYTE_TABLE_SIZE, which is everything the token
+    trie walks over, `byte_next[row[e], c]` is the result of consuming c at
+    the terminal or DFA state e, as returned by `step`, or -1 if c is
+    rejected, so that a step is a single gather.
+    """
+
+    def __init__(
+        self,
+        grammar_encoding: Sequence[int],
+        rule_offsets: Sequence[int],
+        tables: GrammarTables,
+    ):
+        n = len(grammar_encoding)
+        self.kind = np.zeros(n, dtype=np.int8)
+        self.size = np.zeros(n, dtype=np.int32)
+        self.next_offset = np.zeros(n, dtype=np.int64)
+        self.range_begin = np.zeros(n, dtype=np.int64)
+        self.range_end = np.zeros(n, dtype=np.int64)
+        self.productive = np.zeros(n, dtype=bool)
+        self.needs_advance = np.zeros(n, dtype=bool)
+
+        range_low: List[int] = []
+        range_high: List[int] = []
+        range_target: List[int] = []
+
+        def add_ranges(element_offset, ranges, targets):
+            self.range_begin[element_offset] = len(range_low)
+            for (low, high), target in zip(ranges, targets):
+                range_low.append(low)
+                range_high.append(high)
+                range_target.append(target)
+            self.range_end[element_offset] = len(range_low)
+
+        alt_first: List[int] = []
+        num_rules = len(rule_offsets)
+        self.rule_alt_begin = np.zeros(num_rules, dtype=np.int64)
+        self.rule_alt_end = np.zeros(num_rules, dtype=np.int64)
+        for rule_id, rule_offset in enumerate(rule_offsets):
+            self.rule_alt_begin[rule_id] = len(alt_first)
+            if rule_offset < 0:
+                self.rule_alt_end[rule_id] = len(alt_first)
+                continue
+            for elements in rule_alternatives(grammar_encoding, rule_offset):
+                alt_first.append(elements[0] if elements else 0)
+                for i, element_offset in enumerate(elements):
+                    marker = grammar_encoding[element_offset]
+                    kind = _KINDS.get(marker, KIND_TERMINAL)
+                    self.kind[element_offset] = kind
+                    if i + 1 < len(elements):
+                        self.next_offset[element_offset] = elements[i + 1]
+                    self.productive[element_offset] = not tables.is_dead(element_offset)
+                    self.needs_advance[element_offset] = kind != KIND_TERMINAL
+                    if kind == KIND_TERMINAL:
+                        self.size[element_offset] = marker + 1
+                        # the merged ranges of the CharClass, they are disjoint
+                        ranges = tables.char_classes[element_offset].ranges()
+                        add_ranges(element_offset, ranges, [0] * len(ranges))
+                    elif kind == KIND_REPEAT:
+                        self.size[element_offset] = 4
+                    else:
+                        self.size[element_offset] = 2
+            self.rule_alt_end[rule_id] = len(alt_first)
+        self.alt_first = np.array(alt_first, dtype=np.int64)
+
+        for state_offset, state in tables.dfa_states.items():
+            self.kind[state_offset] = KIND_DFA_STATE
+            self.size[state_offset] = 3 + 3 * len(state.targets)
+            self.productive[state_offset] = True
+            self.needs_advance[state_offset] = state.accepting
+            add_ranges(state_offset, state.ranges(), state.targets)
+
+        self.range_low = np.array(range_low, dtype=np.int64)
+        self.range_high = np.array(range_high, dtype=np.int64)
+        self.range_target = np.array(range_target, dtype=np.int64)
+
+        steppable = np.flatnonzero((self.kind == KIND_TERMINAL) | (self.kind == KIND_DFA_STATE))
+        self.row = np.zeros(n, dtype=np.int64)
+        self.row[steppable] = np.arange(len(steppable))
+        self.byte_next = np.full((len(steppable), BYTE_TABLE_SIZE), -1, dtype=np.int64)
+        code_points = np.arange(BYTE_TABLE_SIZE)
+        for row, element_offset in enumerate(steppable.tolist()):
+            begin, end = self.range_begin[element_offset], self.range_end[element_offset]
+            for low, high, target in zip(
+                self.range_low[begin:end], self.range_high[begin:end], self.range_target[begin:end]
+            ):
+                if low >= BYTE_TABLE_SIZE:
+                    break
+                if self.kind[element_offset] == KIND_DFA_STATE:
+                    replacement = target
+                else:
+                    replacement = self.next_offset[element_offset]
+                    if replacement and not self.productive[replacement]:
+                        continue
+                self.byte_next[row, (code_points >= low) & (code_points <= high)] = replacement
+        logger.debug(
+            f"array grammar with {np.count_nonzero(self.kind)} elements and {len(range_low)} ranges"
+        )
+
+    def step(self, code_point: int, tops: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Consume `code_point` at the top elements of a batch of stacks at once,
+        the tops are terminals or DFA states. Returns the indices of the stacks
+        that accept it, in increasing order, and for each of them the element
+        replacing the top, 0 if the top is just popped.
+        """
+        if code_point < BYTE_TABLE_SIZE:
+            replacements = self.byte_next[self.row[tops], code_point]
+            owners = np.flatnonzero(replacements >= 0)
+            return owners, replacements[owners]
+
+        begins = self.range_begin[tops]
+        counts = self.range_end[tops] - begins
+        # flat index of every range of every top, and the stack it belongs to
+        owners = np.repeat(np.arange(len(tops)), counts)
+        starts = np.repeat(begins - (np.cumsum(counts) - counts), counts)
+        ranges = starts + np.arange(len(owners))
+
+        hits = (self.range_low[ranges] <= code_point) & (code_point <= self.range_high[ranges])
+        # the ranges of an element are disjoint, there is at most one hit per stack
+        owners = owners[hits]
+        ranges = ranges[hits]
+        hit_tops = tops[owners]
+        replacements = np.where(
+            self.kind[hit_tops] == KIND_DFA_STATE,
+            self.range_target[ranges],
+            self.next_offset[hit_tops],
+        )
+        # the rest of the alternative can never be completed, the stack is dead
+        alive = (replacements == 0) | self.productive[replacements]
+        return owners[alive], replacements[alive]
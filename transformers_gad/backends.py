@@ -0,0 +1,65 @@
+import logging
+from typing import Dict, Tuple
+
+from transformers_gad.cache import CacheBudget
+from transformers_gad.earley import EarleyRecognizer
+from transformers_gad.grammar_cache import CompiledGrammar
+from transformers_gad.lalr import LalrConflictError, LalrRecognizer
+from transformers_gad.recognizer import StringRecognizer
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("stack", "earley", "lalr")
+
+
+def check_backend(backend: str, compile_dfa: bool = False, vectorized: bool = False):
+    """
+    Reject an unknown backend, or options it does not support, before the
+    grammar is compiled.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}, expected 'stack', 'earley' or 'lalr'.")
+    if backend in ("earley", "lalr") and compile_dfa:
+        raise ValueError(f"The {backend} backend does not support compile_dfa.")
+    if backend == "earley" and vectorized:
+        raise ValueError("The earley backend does not support vectorized recognition.")
+
+
+def make_recognizer(
+    compiled_grammar: CompiledGrammar,
+    backend: str = "stack",
+    vectorized: bool = False,
+    cache_budgets: Dict[str, CacheBudget] = None,
+) -> Tuple[object, str]:
+    """
+    The string recognizer of a compiled grammar for a backend, and the
+    backend in use: a grammar that is not LALR(1) falls back to the stack
+    backend, which handles any grammar.
+    """
+    check_backend(backend, vectorized=vectorized)
+    if backend == "lalr":
+        try:
+            recognizer = LalrRecognizer(
+                compiled_grammar.grammar_encoding,
+                compiled_grammar.start_rule_id,
+                rule_offsets=compiled_grammar.rule_offsets,
+            )
+            return recognizer, backend
+        except LalrConflictError as e:
+            logger.info(f"Falling back to the stack backend: {e}")
+            backend = "stack"
+    if backend == "earley":
+        recognizer = EarleyRecognizer(
+            compiled_grammar.grammar_encoding,
+            compiled_grammar.start_rule_id,
+            rule_offsets=compiled_grammar.rule_offsets,
+        )
+        return recognizer, backend
+    recognizer = StringRecognizer(
+        compiled_grammar.grammar_encoding,
+        compiled_grammar.start_rule_id,
+        rule_offsets=compiled_grammar.rule_offsets,
+        vectorized=vectorized,
+        cache_budgets=cache_budgets,
+    )
+    return recognizer, backend
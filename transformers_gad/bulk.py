@@ -0,0 +1,198 @@
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Tuple
+
+from transformers_gad.backends import check_backend, make_recognizer
+from transformers_gad.grammar_cache import load_compiled_grammar
+
+# the verdicts on a string: in the language, a prefix of a string of the
+# language, or neither
+ACCEPT = "accept"
+PREFIX = "prefix"
+REJECT = "reject"
+
+# strings recognized per chunk, a chunk is sorted to share its prefixes and
+# is the unit of work of the process pool
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def make_string_recognizer(
+    grammar_str: str,
+    start_rule_name: str = "root",
+    backend: str = "stack",
+    optimize: bool = False,
+    compile_dfa: bool = False,
+    cache_dir=None,
+    vectorized: bool = False,
+    cache_budgets=None,
+):
+    """
+    The string recognizer of a grammar for a backend, see make_recognizer:
+    a grammar that is not LALR(1) falls back to the stack backend.
+    """
+    check_backend(backend, compile_dfa, vectorized)
+    compiled_grammar = load_compiled_grammar(
+        grammar_str, start_rule_name, cache_dir, optimize, compile_dfa
+    )
+    recognizer, _ = make_recognizer(compiled_grammar, backend, vectorized, cache_budgets)
+    return recognizer
+
+
+def recognize_chunk(recognizer, strings: List[str]) -> List[str]:
+    """
+    The verdicts on the strings, in their order. The strings are recognized
+    in sorted order, keeping the states along the previous string, so that a
+    string only consumes the characters past its common prefix with the
+    previous one, and not past a prefix that is already rejected.
+    """
+    verdicts = [REJECT] * len(strings)
+    # states[i] is the state after the first i characters of `previous`
+    previous = ""
+    states = [recognizer.get_initial_accept_state()]
+    for index in sorted(range(len(strings)), key=strings.__getitem__):
+        string = strings[index]
+        common = 0
+        for char, previous_char in zip(string, previous):
+            if char != previous_char:
+                break
+            common += 1
+        del states[common + 1 :]
+        accept_state = states[-1]
+        for char in string[common:]:
+            if not accept_state.stacks:
+                break
+            accept_state = recognizer._consume_string(char, accept_state)
+            states.append(accept_state)
+        previous = string[: len(states) - 1]
+        if not accept_state.stacks or len(states) <= len(string):
+            continue
+        verdicts[index] = ACCEPT if recognizer._accept_string("", accept_state) else PREFIX
+    return verdicts
+
+
+# the recognizer of a worker process, compiled once by _init_worker
+_worker_recognizer = None
+
+
+def _init_worker(grammar_str, start_rule_name, backend, optimize, compile_dfa, cache_dir):
+    global _worker_recognizer
+    _worker_recognizer = make_string_recognizer(
+        grammar_str, start_rule_name, backend, optimize, compile_dfa, cache_dir
+    )
+
+
+def _recognize_in_worker(strings: List[str]) -> List[str]:
+    return recognize_chunk(_worker_recognizer, strings)
+
+
+def _chunks(strings: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    strings = iter(strings)
+    while True:
+        chunk = list(itertools.islice(strings, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def recognize_strings(
+    grammar_str: str,
+    strings: Iterable[str],
+    start_rule_name: str = "root",
+    backend: str = "stack",
+    optimize: bool = False,
+    compile_dfa: bool = False,
+    num_workers: int = 0,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    cache_dir=None,
+) -> Iterator[Tuple[str, str]]:
+    """
+    Stream the (string, verdict) pairs of the strings in their order, the
+    verdict being ACCEPT, PREFIX or REJECT. The strings are read lazily by
+    chunks of `chunk_size`, the strings of a chunk share their common
+    prefixes, see recognize_chunk, so sorted or clustered input is faster.
+
+    With `num_workers` > 0, the chunks are recognized by a pool of processes
+    that compile the grammar once each, with `cache_dir` they load it from
+    the compiled grammar cache; at most two chunks per worker are pending.
+    """
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+    chunks = _chunks(strings, chunk_size)
+    if num_workers <= 0:
+        recognizer = make_string_recognizer(
+            grammar_str, start_rule_name, backend, optimize, compile_dfa, cache_dir
+        )
+        for chunk in chunks:
+            yield from zip(chunk, recognize_chunk(recognizer, chunk))
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+        initargs=(grammar_str, start_rule_name, backend, optimize, compile_dfa, cache_dir),
+    ) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(_recognize_in_worker, chunk)))
+            if len(pending) >= 2 * num_workers:
+                chunk, future = pending.popleft()
+                yield from zip(chunk, future.result())
+        while pending:
+            chunk, future = pending.popleft()
+            yield from zip(chunk, future.result())
+
+
+def read_strings(path: str) -> Iterator[str]:
+    """
+    The newline-delimited strings of a file, without their line ends.
+    """
+    with open(path, "r", encoding="utf-8", newline="\n") as file:
+        for line in file:
+            yield line[:-1] if line.endswith("\n") else line
+
+
+def recognize_file(grammar_str: str, path: str, **kwargs) -> Iterator[Tuple[str, str]]:
+    """
+    recognize_strings on the newline-delimited strings of a file.
+    """
+    return recognize_strings(grammar_str, read_strings(path), **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recognize newline-delimited strings with an EBNF grammar, "
+        "printing the verdict (accept, prefix or reject) of every string."
+    )
+    parser.add_argument("-g", "--grammar-file", required=True, help="Path to the grammar file")
+    parser.add_argument(
+        "-i", "--input-file", required=True, help="Path to the file of strings, one per line"
+    )
+    parser.add_argument("-s", "--start-rule", default="root", help="Name of the start rule")
+    parser.add_argument(
+        "-b", "--backend", default="stack", choices=["stack", "earley", "lalr"], help="Recognizer backend"
+    )
+    parser.add_argument("-w", "--workers", type=int, default=0, help="Number of worker processes")
+    parser.add_argument(
+        "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Number of strings per chunk"
+    )
+    parser.add_argument("--optimize", action="store_true", help="Optimize the grammar first")
+    parser.add_argument(
+        "--compile-dfa", action="store_true", help="Compile the regular rules into DFAs"
+    )
+    args = parser.parse_args()
+
+    with open(args.grammar_file, "r") as file:
+        input_text = file.read()
+    for string, verdict in recognize_file(
+        input_text,
+        args.input_file,
+        start_rule_name=args.start_rule,
+        backend=args.backend,
+        optimize=args.optimize,
+        compile_dfa=args.compile_dfa,
+        num_workers=args.workers,
+        chunk_size=args.chunk_size,
+    ):
+        print(f"{verdict}\t{string}")
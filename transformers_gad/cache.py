@@ -0,0 +1,177 @@
+import sys
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+@dataclass
+class CacheBudget:
+    """
+    Limits of a BoundedCache: the number of entries and the estimated size
+    of the values in bytes, None for no limit.
+    """
+
+    max_entries: Optional[int] = None
+    max_bytes: Optional[int] = None
+
+
+# the budgets of the caches of the recognizers, by cache name
+DEFAULT_CACHE_BUDGETS: Dict[str, CacheBudget] = {
+    # StringRecognizer: the stacks a stack expands into
+    "advance_stack": CacheBudget(max_entries=32768),
+    # StringRecognizer: the stacks after consuming a code point on a stack
+    "consume_code_point_per_stack": CacheBudget(max_entries=30000),
+    # StringRecognizer: the transitions of the lazy DFA over the parse states,
+    # flushed as a whole when full, see LazyDfa
+    "lazy_dfa": CacheBudget(max_entries=1 << 17),
+    # AbsTokenRecognizer: the token mask of a stack
+    "token_acceptance": CacheBudget(max_entries=32768),
+    # AbsTokenRecognizer: the min completion lengths after the tokens from a stack
+    "token_completion": CacheBudget(max_entries=4096),
+    # AbsTokenRecognizer: the parse state after a token on a parse state
+    "token_transition": CacheBudget(max_entries=65536),
+    # AbsTokenRecognizer: the parse state after a forced prefix of tokens
+    "prefix_state": CacheBudget(max_entries=1024),
+}
+
+
+def cache_budget(name: str, budgets: Optional[Dict[str, CacheBudget]] = None) -> CacheBudget:
+    """
+    The budget of the cache `name` in `budgets`, or its default budget.
+    """
+    if budgets is not None and name in budgets:
+        return budgets[name]
+    return DEFAULT_CACHE_BUDGETS[name]
+
+
+@dataclass
+class CacheStats:
+    name: str
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    bytes: int
+    max_entries: Optional[int]
+    max_bytes: Optional[int]
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        stats = asdict(self)
+        stats["hit_rate"] = self.hit_rate
+        return stats
+
+
+_MISSING = object()
+
+
+class BoundedCache:
+    """
+    LRU cache owned by a single recognizer, so that it is released with the
+    recognizer, or earlier by `close()`, unlike an lru_cache on a method,
+    whose keys hold every recognizer alive.
+
+    The least recently used entries are evicted once the cache holds more
+    than `budget.max_entries` entries, or values of more than
+    `budget.max_bytes` bytes as estimated by `size_of`, by default the
+    shallow size of the value. It counts the hits, misses and evictions,
+    see `stats()`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        budget: CacheBudget = None,
+        size_of: Callable[[Any], int] = sys.getsizeof,
+    ):
+        budget = budget if budget is not None else CacheBudget()
+        for limit in (budget.max_entries, budget.max_bytes):
+            if limit is not None and limit < 0:
+                raise ValueError(f"The budget of the {name} cache cannot be negative: {budget}")
+        self.name = name
+        self.budget = budget
+        self.size_of = size_of
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.sizes: Dict[Hashable, int] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.closed = False
+
+    def get(self, key: Hashable, default=None):
+        value = self.entries.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value):
+        if self.closed:
+            return
+        if key in self.entries:
+            self.bytes -= self.sizes[key]
+        size = self.size_of(value)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.sizes[key] = size
+        self.bytes += size
+        self._evict()
+
+    def _evict(self):
+        max_entries = self.budget.max_entries
+        max_bytes = self.budget.max_bytes
+        while self.entries and (
+            (max_entries is not None and len(self.entries) > max_entries)
+            or (max_bytes is not None and self.bytes > max_bytes)
+        ):
+            key, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(key)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drop the entries, the counters are kept.
+        """
+        self.entries.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def close(self):
+        """
+        Release the entries, the cache stores nothing from then on.
+        """
+        self.clear()
+        self.closed = True
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            name=self.name,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self.entries),
+            bytes=self.bytes,
+            max_entries=self.budget.max_entries,
+            max_bytes=self.budget.max_bytes,
+        )
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def __repr__(self) -> str:
+        return f"BoundedCache({self.name!r}, {len(self.entries)} entries, {self.budget})"
@@ -0,0 +1,72 @@
+from array import array
+from bisect import bisect_right
+from typing import Sequence, Tuple
+
+# Code points below this bound are looked up in a bitmap, the others by
+# binary search over the ranges. 256 covers ASCII and every raw byte value,
+# which is what the token trie walks over.
+BITMAP_SIZE = 256
+
+
+class CharClass:
+    """
+    Compact membership structure for the code points accepted by a terminal
+    element: a bitmap for the code points below BITMAP_SIZE and a sorted array
+    of disjoint ranges searched with bisect for the others.
+
+    Lookups are O(1) below BITMAP_SIZE and O(log r) above, where r is the
+    number of ranges, and the memory is O(r) whatever the size of the ranges,
+    e.g. for a negated class such as [^"].
+    """
+
+    __slots__ = ("bitmap", "starts", "ends")
+
+    def __init__(self, ranges: Sequence[Tuple[int, int]]):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        bitmap = 0
+        for start, end in merged:
+            if start >= BITMAP_SIZE:
+                break
+            end = min(end, BITMAP_SIZE - 1)
+            bitmap |= ((1 << (end - start + 1)) - 1) << start
+        self.bitmap = bitmap
+        self.starts = array("I", [start for start, _ in merged])
+        self.ends = array("I", [end for _, end in merged])
+
+    @classmethod
+    def from_element(cls, grammar_encoding: Sequence[int], element_offset: int):
+        size = grammar_encoding[element_offset]
+        ranges = grammar_encoding[element_offset + 1 : element_offset + 1 + size]
+        return cls(list(zip(ranges[::2], ranges[1::2])))
+
+    def __contains__(self, code_point: int) -> bool:
+        if code_point < BITMAP_SIZE:
+            return bool((self.bitmap >> code_point) & 1)
+        i = bisect_right(self.starts, code_point) - 1
+        return i >= 0 and code_point <= self.ends[i]
+
+    def get(self, code_point: int, default: bool = False) -> bool:
+        # dict-like access, for callers of the former per-code-point dict
+        return code_point in self or default
+
+    def intersects(self, low: int, high: int) -> bool:
+        """
+        Whether any code point in [low, high] is in the class.
+        """
+        i = bisect_right(self.starts, high) - 1
+        return i >= 0 and self.ends[i] >= low
+
+    def ranges(self):
+        return list(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in zip(self.starts, self.ends))
+
+    def __repr__(self):
+        return f"CharClass({self.ranges()})"
@@ -0,0 +1,359 @@
+import argparse
+import logging
+import random
+from typing import Dict, List, Tuple
+
+from transformers_gad.cache import DEFAULT_CACHE_BUDGETS
+from transformers_gad.grammar_analysis import Intervals, rule_alternatives
+from transformers_gad.grammar_cache import CompiledGrammar
+from transformers_gad.optimizer import decode_rules, is_ref, is_repeat
+from transformers_gad.parser import (
+    DFA_REF_MARKER,
+    REF_RULE_MARKER,
+    REPEAT_MARKER,
+    parse_ebnf,
+)
+from transformers_gad.recognizer import StringRecognizer
+from transformers_gad.stack import EMPTY_STACK
+
+logger = logging.getLogger(__name__)
+
+# sampled derivations pick the alternative that terminates the fastest past this depth
+MAX_DEPTH = 12
+# repetitions are sampled up to this many iterations past their min count
+MAX_EXTRA_ITERATIONS = 3
+# default entry budget of the token mask cache of the token recognizers, one
+# token mask of one byte per token per entry
+TOKEN_MASK_CACHE_SIZE = DEFAULT_CACHE_BUDGETS["token_acceptance"].max_entries
+
+
+def min_heights(rules):
+    """
+    The minimum derivation height of every rule, used to steer sampling
+    towards termination.
+    """
+    heights = {}
+    changed = True
+    while changed:
+        changed = False
+        for rule_id, alternatives in rules.items():
+            for alternative in alternatives:
+                refs = [
+                    element[1]
+                    for element in alternative
+                    if is_ref(element) or (is_repeat(element) and element[2] > 0)
+                ]
+                if all(ref in heights for ref in refs):
+                    height = 1 + max((heights[ref] for ref in refs), default=0)
+                    if height < heights.get(rule_id, float("inf")):
+                        heights[rule_id] = height
+                        changed = True
+    return heights
+
+
+def sample_string(rules, heights, rule_id, rng, depth=0):
+    alternatives = rules[rule_id]
+    if depth > MAX_DEPTH:
+        # pick the alternative that terminates the fastest
+        alternatives = [
+            min(
+                alternatives,
+                key=lambda alt: max(
+                    (heights.get(e[1], float("inf")) for e in alt if is_ref(e) or is_repeat(e)),
+                    default=0,
+                ),
+            )
+        ]
+    alternative = rng.choice(alternatives)
+    chars = []
+    for element in alternative:
+        if is_ref(element):
+            chars.append(sample_string(rules, heights, element[1], rng, depth + 1))
+        elif is_repeat(element):
+            _, rule_id, min_count, max_count = element
+            count = rng.randint(min_count, min(max_count, min_count + MAX_EXTRA_ITERATIONS))
+            for _ in range(count):
+                chars.append(sample_string(rules, heights, rule_id, rng, depth + 1))
+        else:
+            start, end = rng.choice(list(zip(element[1::2], element[2::2])))
+            chars.append(chr(rng.randint(start, min(end, start + 255))))
+    return "".join(chars)
+
+
+def count_stacks(recognizer, string):
+    """
+    Consume `string` one char at a time, return the total number of live
+    stacks, the maximum number of live stacks and the total number of stack
+    elements over all the steps.
+    """
+    stacks = recognizer.get_initial_accept_state().stacks
+    total, peak, depth = len(stacks), len(stacks), sum(map(len, stacks))
+    for char in string:
+        stacks = recognizer._consume_code_points([ord(char)], stacks)
+        total += len(stacks)
+        peak = max(peak, len(stacks))
+        depth += sum(map(len, stacks))
+    return total, peak, depth
+
+
+def _intersects(a: Intervals, b: Intervals) -> bool:
+    i, j = 0, 0
+    while i < len(a) and j < len(b):
+        if a[i][1] < b[j][0]:
+            i += 1
+        elif b[j][1] < a[i][0]:
+            j += 1
+        else:
+            return True
+    return False
+
+
+class ComplexityReport:
+    """
+    Static and sampled cost indicators of a grammar, see analyze_grammar:
+    - `num_rules`, `encoding_length`: size of the compiled grammar,
+    - `fan_outs`: for every reference, repetition and DFA reference, keyed by
+      element offset, the number of stacks advance_stack expands it into,
+    - `ambiguous_rules`: for every rule with alternatives that can start with
+      the same character, or that are both nullable, the number of such pairs
+      of alternatives. Every such pair keeps two stacks alive at once,
+    - `peak_stacks`, `average_stacks`: live stacks per consumed character on
+      the sampled strings,
+    - `num_tops`: the terminals and DFA states, i.e. every element that can be
+      on top of a stack, and `observed_tops` the ones seen on the samples,
+    - `distinct_stacks`: the distinct stacks seen on the samples, each of them
+      is an entry of the token mask cache.
+    """
+
+    def __init__(self, rule_names: Dict[int, str], element_rules: Dict[int, int]):
+        self.rule_names = rule_names
+        self.element_rules = element_rules
+        self.num_rules = 0
+        self.encoding_length = 0
+        self.initial_stacks = 0
+        self.fan_outs: Dict[int, int] = {}
+        self.ambiguous_rules: Dict[int, int] = {}
+        self.num_samples = 0
+        self.num_rejected_samples = 0
+        self.peak_stacks = 0
+        self.average_stacks = 0.0
+        self.num_tops = 0
+        self.observed_tops = 0
+        self.distinct_stacks = 0
+        self.vocab_size = 0
+
+    @property
+    def max_fan_out(self) -> int:
+        return max(self.fan_outs.values(), default=0)
+
+    @property
+    def average_fan_out(self) -> float:
+        return sum(self.fan_outs.values()) / len(self.fan_outs) if self.fan_outs else 0.0
+
+    @property
+    def mask_cache_bytes(self) -> int:
+        """
+        Estimated size of the token mask cache once the sampled stacks are in it.
+        """
+        return min(self.distinct_stacks, TOKEN_MASK_CACHE_SIZE) * self.vocab_size
+
+    @property
+    def mask_cache_limit_bytes(self) -> int:
+        """
+        Size of the token mask cache when it is full.
+        """
+        return TOKEN_MASK_CACHE_SIZE * self.vocab_size
+
+    @property
+    def peak_step_bytes(self) -> int:
+        """
+        Size of the per-stack masks stacked together to compute one token mask
+        at the peak number of live stacks.
+        """
+        return self.peak_stacks * self.vocab_size
+
+    def hot_spots(self, top_k: int = 5) -> List[Tuple[str, int, int]]:
+        """
+        The `top_k` elements with the largest fan-out, as (rule name, element
+        offset, fan-out).
+        """
+        ranked = sorted(self.fan_outs.items(), key=lambda item: -item[1])[:top_k]
+        return [
+            (self.rule_names.get(self.element_rules[offset], "?"), offset, fan_out)
+            for offset, fan_out in ranked
+        ]
+
+    def ambiguity_hot_spots(self, top_k: int = 5) -> List[Tuple[str, int]]:
+        """
+        The `top_k` rules with the most overlapping pairs of alternatives, as
+        (rule name, number of pairs).
+        """
+        ranked = sorted(self.ambiguous_rules.items(), key=lambda item: -item[1])[:top_k]
+        return [(self.rule_names.get(rule_id, "?"), pairs) for rule_id, pairs in ranked]
+
+    def print(self, top_k: int = 5):
+        print("Grammar complexity:")
+        print(f"  rules: {self.num_rules}")
+        print(f"  encoding length: {self.encoding_length}")
+        print(f"  initial stacks: {self.initial_stacks}")
+        print(f"  advance_stack fan-out: max {self.max_fan_out}, average {self.average_fan_out:.2f}")
+        for rule_name, offset, fan_out in self.hot_spots(top_k):
+            print(f"    {rule_name} < {offset} >: {fan_out}")
+        print(f"  ambiguous rules: {len(self.ambiguous_rules)}")
+        for rule_name, pairs in self.ambiguity_hot_spots(top_k):
+            print(f"    {rule_name}: {pairs} overlapping pairs of alternatives")
+        print(
+            f"  live stacks on {self.num_samples} samples: "
+            f"max {self.peak_stacks}, average {self.average_stacks:.2f}"
+        )
+        if self.num_rejected_samples:
+            print(f"    {self.num_rejected_samples} samples are not accepted by the grammar")
+        print(f"  stack tops: {self.num_tops}, {self.observed_tops} seen on the samples")
+        print(f"  distinct stacks on the samples: {self.distinct_stacks}")
+        print(f"  token mask cache for a vocab of {self.vocab_size}:")
+        print(f"    sampled stacks: {_format_bytes(self.mask_cache_bytes)}")
+        print(f"    full cache: {_format_bytes(self.mask_cache_limit_bytes)}")
+        print(f"    one step at peak stacks: {_format_bytes(self.peak_step_bytes)}")
+
+
+def _format_bytes(num_bytes: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GiB"
+
+
+def analyze_grammar(
+    grammar_str: str,
+    start_rule_name: str = "root",
+    vocab_size: int = 32000,
+    num_samples: int = 100,
+    seed: int = 0,
+    optimize: bool = False,
+    compile_dfa: bool = False,
+) -> ComplexityReport:
+    """
+    Estimate the cost of a grammar before using it for decoding. The grammar is
+    compiled with the given options, the fan-out and ambiguity of its rules are
+    computed statically, and the live stacks are counted while recognizing
+    `num_samples` strings sampled from the grammar.
+    """
+    compiled_grammar = CompiledGrammar.compile(
+        grammar_str, start_rule_name, optimize, compile_dfa
+    )
+    grammar_encoding = compiled_grammar.grammar_encoding
+    recognizer = StringRecognizer(
+        grammar_encoding,
+        compiled_grammar.start_rule_id,
+        rule_offsets=compiled_grammar.rule_offsets,
+    )
+    tables = recognizer.tables
+
+    rules = {
+        rule_id: rule_alternatives(grammar_encoding, rule_offset)
+        for rule_id, rule_offset in enumerate(compiled_grammar.rule_offsets)
+        if rule_offset >= 0
+    }
+    element_rules = {
+        element_offset: rule_id
+        for rule_id, alternatives in rules.items()
+        for elements in alternatives
+        for element_offset in elements
+    }
+    rule_names = {
+        rule_id: rule_name for rule_name, rule_id in compiled_grammar.symbol_table.items()
+    }
+    report = ComplexityReport(rule_names, element_rules)
+    report.num_rules = len(rules)
+    report.encoding_length = len(grammar_encoding)
+    report.initial_stacks = len(recognizer.get_initial_accept_state().stacks)
+    report.vocab_size = vocab_size
+
+    for element_offset in element_rules:
+        if grammar_encoding[element_offset] in (REF_RULE_MARKER, REPEAT_MARKER, DFA_REF_MARKER):
+            report.fan_outs[element_offset] = len(
+                recognizer.advance_stack(EMPTY_STACK.push(element_offset))
+            )
+        else:
+            report.num_tops += 1
+    report.num_tops += len(tables.dfa_states)
+
+    for rule_id, alternatives in rules.items():
+        firsts = [
+            (tables.element_nullable[elements[0]], tables.element_first[elements[0]])
+            if elements
+            else (True, ())
+            for elements in alternatives
+        ]
+        pairs = sum(
+            1
+            for i, (nullable_i, first_i) in enumerate(firsts)
+            for nullable_j, first_j in firsts[i + 1 :]
+            if (nullable_i and nullable_j) or _intersects(first_i, first_j)
+        )
+        if pairs:
+            report.ambiguous_rules[rule_id] = pairs
+
+    # sample from the grammar as written, the compiled encoding may hold DFAs
+    parsed_grammar = parse_ebnf(grammar_str)
+    sample_rules = decode_rules(parsed_grammar.grammar_encoding)
+    heights = min_heights(sample_rules)
+    rng = random.Random(seed)
+    tops, distinct_stacks = set(), set()
+    total, steps = 0, 0
+    for _ in range(num_samples):
+        sample = sample_string(
+            sample_rules, heights, parsed_grammar.symbol_table[start_rule_name], rng
+        )
+        stacks = recognizer.get_initial_accept_state().stacks
+        for char in sample:
+            stacks = recognizer._consume_code_points([ord(char)], stacks)
+            total += len(stacks)
+            steps += 1
+            report.peak_stacks = max(report.peak_stacks, len(stacks))
+            for stack in stacks:
+                distinct_stacks.add(stack)
+                if stack:
+                    tops.add(stack.top)
+        if not any(tables.stack_can_finish(stack) for stack in stacks):
+            report.num_rejected_samples += 1
+    report.num_samples = num_samples
+    report.average_stacks = total / steps if steps else 0.0
+    report.observed_tops = len(tops)
+    report.distinct_stacks = len(distinct_stacks)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the complexity of an EBNF grammar before using it for decoding."
+    )
+    parser.add_argument("-g", "--grammar-file", required=True, help="Path to the grammar file")
+    parser.add_argument("-s", "--start-rule", default="root", help="Name of the start rule")
+    parser.add_argument(
+        "-v", "--vocab-size", type=int, default=32000, help="Vocab size of the tokenizer"
+    )
+    parser.add_argument(
+        "-n", "--num-samples", type=int, default=100, help="Number of sampled strings"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sampler")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of hot spots to list")
+    parser.add_argument("--optimize", action="store_true", help="Optimize the grammar first")
+    parser.add_argument(
+        "--compile-dfa", action="store_true", help="Compile the regular rules into DFAs"
+    )
+    args = parser.parse_args()
+
+    with open(args.grammar_file, "r") as file:
+        input_text = file.read()
+    report = analyze_grammar(
+        input_text,
+        args.start_rule,
+        args.vocab_size,
+        args.num_samples,
+        args.seed,
+        args.optimize,
+        args.compile_dfa,
+    )
+    report.print(args.top_k)
@@ -0,0 +1,551 @@
+import logging
+from bisect import bisect_left
+from typing import Dict, FrozenSet, List, Optional, Sequence, Set, Tuple
+
+from transformers_gad.optimizer import (
+    Alternative,
+    Rules,
+    decode_rules,
+    encode_rules,
+    is_ref,
+    is_repeat,
+    referenced_rules,
+)
+from transformers_gad.parser import (
+    DFA_REF_MARKER,
+    DFA_STATE_MARKER,
+    REPEAT_UNBOUNDED,
+    ParseState,
+)
+
+logger = logging.getLogger(__name__)
+
+# A rule is kept in the pushdown grammar when its NFA or its minimized DFA
+# would have more states than this
+MAX_NFA_STATES = 20000
+MAX_DFA_STATES = 2000
+# Repetitions with larger bounds stay counters, an automaton would copy their
+# rule once per iteration
+MAX_EXPANDED_REPEAT = 16
+
+# A transition on the closed interval [start, end] of code points to a state
+Transition = Tuple[int, int, int]
+
+
+class _TooLarge(Exception):
+    pass
+
+
+class Dfa:
+    """
+    A minimized character DFA. State 0 is the start state, and every state
+    can reach an accepting state, i.e. there is no dead state: a code point
+    without a transition is rejected.
+    """
+
+    def __init__(self, accepting: List[bool], transitions: List[List[Transition]]):
+        self.accepting = accepting
+        # sorted by code point, the intervals of a state are disjoint
+        self.transitions = transitions
+
+    def __len__(self):
+        return len(self.accepting)
+
+    def encode(self, base: int) -> List[int]:
+        """
+        Encode the states as records laid out from offset `base` of the grammar
+        encoding, each state is
+        [DFA_STATE_MARKER, accepting, 2n, start_1, end_1, ..., start_n, end_n,
+        target_1, ..., target_n] where the targets are the offsets of the
+        target state records. The first record is the start state.
+        """
+        offsets = []
+        offset = base
+        for transitions in self.transitions:
+            offsets.append(offset)
+            offset += 3 + 3 * len(transitions)
+
+        encoding = []
+        for accepting, transitions in zip(self.accepting, self.transitions):
+            encoding += [DFA_STATE_MARKER, int(accepting), 2 * len(transitions)]
+            for start, end, _ in transitions:
+                encoding += [start, end]
+            encoding += [offsets[target] for _, _, target in transitions]
+        return encoding
+
+
+class DfaState:
+    """
+    A DFA state record decoded from the grammar encoding, see Dfa.encode.
+    """
+
+    __slots__ = ("accepting", "starts", "ends", "targets")
+
+    def __init__(self, grammar_encoding: Sequence[int], state_offset: int):
+        assert grammar_encoding[state_offset] == DFA_STATE_MARKER
+        self.accepting = bool(grammar_encoding[state_offset + 1])
+        size = grammar_encoding[state_offset + 2]
+        ranges = grammar_encoding[state_offset + 3 : state_offset + 3 + size]
+        self.starts = list(ranges[::2])
+        self.ends = list(ranges[1::2])
+        targets_offset = state_offset + 3 + size
+        self.targets = list(grammar_encoding[targets_offset : targets_offset + size // 2])
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        return list(zip(self.starts, self.ends))
+
+    def next_state(self, code_point: int) -> int:
+        """
+        Offset of the state reached on `code_point`, or -1 if it is rejected.
+        """
+        i = bisect_left(self.ends, code_point)
+        if i < len(self.starts) and self.starts[i] <= code_point:
+            return self.targets[i]
+        return -1
+
+
+def dfa_states(grammar_encoding: Sequence[int], start_offset: int) -> Dict[int, DfaState]:
+    """
+    Decode every state reachable from the state record at `start_offset`.
+    """
+    states = {}
+    worklist = [start_offset]
+    while worklist:
+        offset = worklist.pop()
+        if offset in states:
+            continue
+        states[offset] = DfaState(grammar_encoding, offset)
+        worklist.extend(states[offset].targets)
+    return states
+
+
+########################
+# Regular rules        #
+########################
+
+
+def _strongly_connected_components(rules: Rules) -> Dict[int, int]:
+    """
+    Tarjan's algorithm, iterative. Maps every rule id to the index of its
+    component in the reference graph.
+    """
+    index: Dict[int, int] = {}
+    lowlink: Dict[int, int] = {}
+    component: Dict[int, int] = {}
+    on_stack: Set[int] = set()
+    stack: List[int] = []
+
+    def successors(rule_id):
+        return [
+            ref
+            for alternative in rules[rule_id]
+            for ref in referenced_rules(alternative)
+            if ref in rules
+        ]
+
+    for root in rules:
+        if root in index:
+            continue
+        work = [(root, iter(successors(root)))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            rule_id, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors(child))))
+                    break
+                if child in on_stack:
+                    lowlink[rule_id] = min(lowlink[rule_id], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[rule_id])
+                if lowlink[rule_id] == index[rule_id]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component[member] = index[rule_id]
+                        if member == rule_id:
+                            break
+    return component
+
+
+def _repeat_bound(element) -> int:
+    _, _, min_count, max_count = element
+    return min_count if max_count == REPEAT_UNBOUNDED else max_count
+
+
+def find_regular_rules(rules: Rules) -> Set[int]:
+    """
+    The rules that derive a regular language by construction: the rules whose
+    references to their own component are all in tail position, i.e. the
+    right-recursive rules generated by `*` and `+` and the non-recursive
+    rules, and whose other references, including repetitions of at most
+    MAX_EXPANDED_REPEAT iterations, are to regular rules.
+    """
+    component = _strongly_connected_components(rules)
+    regular = set()
+    for rule_id, alternatives in rules.items():
+        if all(
+            ref in rules
+            and (
+                component[ref] != component[rule_id]
+                or (is_ref(element) and i == len(alternative) - 1)
+            )
+            and not (is_repeat(element) and _repeat_bound(element) > MAX_EXPANDED_REPEAT)
+            for alternative in alternatives
+            for i, element in enumerate(alternative)
+            if is_ref(element) or is_repeat(element)
+            for ref in [element[1]]
+        ):
+            regular.add(rule_id)
+
+    changed = True
+    while changed:
+        changed = False
+        for rule_id in list(regular):
+            if any(
+                ref not in regular
+                for alternative in rules[rule_id]
+                for ref in referenced_rules(alternative)
+            ):
+                regular.discard(rule_id)
+                changed = True
+    return regular
+
+
+########################
+# Automata             #
+########################
+
+
+class _Nfa:
+    def __init__(self):
+        self.transitions: List[List[Transition]] = []
+        self.epsilons: List[List[int]] = []
+
+    def new_state(self) -> int:
+        if len(self.transitions) >= MAX_NFA_STATES:
+            raise _TooLarge()
+        self.transitions.append([])
+        self.epsilons.append([])
+        return len(self.transitions) - 1
+
+    def add_rule(self, rules: Rules, component: Dict[int, int], rule_id: int, final: int) -> int:
+        """
+        Thompson construction of `rule_id` ending in `final`, return the entry
+        state. A tail reference to the component of `rule_id` jumps to the
+        entry of the referenced rule, any other reference is expanded in place,
+        as are the repetitions, one copy per iteration.
+        """
+        entries: Dict[int, int] = {}
+        pending: List[int] = []
+
+        def entry(ref_rule_id: int) -> int:
+            if ref_rule_id not in entries:
+                entries[ref_rule_id] = self.new_state()
+                pending.append(ref_rule_id)
+            return entries[ref_rule_id]
+
+        start = entry(rule_id)
+        while pending:
+            current_rule_id = pending.pop()
+            for alternative in rules[current_rule_id]:
+                state = entries[current_rule_id]
+                for element in alternative:
+                    if is_ref(element) and component[element[1]] == component[rule_id]:
+                        # a tail reference, by regularity
+                        self.epsilons[state].append(entry(element[1]))
+                        state = None
+                        break
+                    if is_repeat(element):
+                        state = self.add_repeat(rules, component, element, state)
+                        continue
+                    next_state = self.new_state()
+                    if is_ref(element):
+                        self.epsilons[state].append(
+                            self.add_rule(rules, component, element[1], next_state)
+                        )
+                    else:
+                        for start_char, end_char in zip(element[1::2], element[2::2]):
+                            self.transitions[state].append((start_char, end_char, next_state))
+                    state = next_state
+                if state is not None:
+                    self.epsilons[state].append(final)
+        return start
+
+    def add_repeat(self, rules: Rules, component: Dict[int, int], element, state: int) -> int:
+        """
+        Expand a repetition from `state`, return the state after it.
+        """
+        _, rule_id, min_count, max_count = element
+        for _ in range(min_count):
+            next_state = self.new_state()
+            self.epsilons[state].append(self.add_rule(rules, component, rule_id, next_state))
+            state = next_state
+        if max_count == REPEAT_UNBOUNDED:
+            loop_state = self.new_state()
+            self.epsilons[state].append(loop_state)
+            self.epsilons[loop_state].append(self.add_rule(rules, component, rule_id, loop_state))
+            return loop_state
+        end_state = self.new_state()
+        for _ in range(max_count - min_count):
+            self.epsilons[state].append(end_state)
+            next_state = self.new_state()
+            self.epsilons[state].append(self.add_rule(rules, component, rule_id, next_state))
+            state = next_state
+        self.epsilons[state].append(end_state)
+        return end_state
+
+    def closure(self, states) -> FrozenSet[int]:
+        closure = set(states)
+        worklist = list(states)
+        while worklist:
+            for state in self.epsilons[worklist.pop()]:
+                if state not in closure:
+                    closure.add(state)
+                    worklist.append(state)
+        return frozenset(closure)
+
+
+def _partition(transitions: List[Transition]) -> List[Tuple[int, int, FrozenSet[int]]]:
+    """
+    Split overlapping transitions into disjoint intervals, each with the set
+    of its targets. Adjacent intervals with the same targets are merged.
+    """
+    bounds = sorted({start for start, _, _ in transitions} | {end + 1 for _, end, _ in transitions})
+    targets: List[Set[int]] = [set() for _ in bounds]
+    for start, end, target in transitions:
+        for i in range(bisect_left(bounds, start), bisect_left(bounds, end + 1)):
+            targets[i].add(target)
+
+    intervals = []
+    for i in range(len(bounds) - 1):
+        if not targets[i]:
+            continue
+        start, end = bounds[i], bounds[i + 1] - 1
+        target_set = frozenset(targets[i])
+        if intervals and intervals[-1][1] + 1 == start and intervals[-1][2] == target_set:
+            intervals[-1] = (intervals[-1][0], end, target_set)
+        else:
+            intervals.append((start, end, target_set))
+    return intervals
+
+
+def _determinize(nfa: _Nfa, start: int, final: int) -> Optional[Dfa]:
+    """
+    Subset construction, followed by the removal of the states from which no
+    accepting state is reachable. None if the language is empty.
+    """
+    start_set = nfa.closure([start])
+    ids = {start_set: 0}
+    subsets = [start_set]
+    transitions: List[List[Transition]] = []
+    for subset in subsets:
+        state_transitions = []
+        for start_char, end_char, targets in _partition(
+            [t for state in subset for t in nfa.transitions[state]]
+        ):
+            target_set = nfa.closure(targets)
+            if target_set not in ids:
+                if len(subsets) >= MAX_DFA_STATES * 4:
+                    raise _TooLarge()
+                ids[target_set] = len(subsets)
+                subsets.append(target_set)
+            state_transitions.append((start_char, end_char, ids[target_set]))
+        transitions.append(state_transitions)
+    accepting = [final in subset for subset in subsets]
+
+    # trim the dead states
+    predecessors: List[Set[int]] = [set() for _ in subsets]
+    for state, state_transitions in enumerate(transitions):
+        for _, _, target in state_transitions:
+            predecessors[target].add(state)
+    live = {state for state, is_accepting in enumerate(accepting) if is_accepting}
+    worklist = list(live)
+    while worklist:
+        for state in predecessors[worklist.pop()]:
+            if state not in live:
+                live.add(state)
+                worklist.append(state)
+    if 0 not in live:
+        return None
+    transitions = [
+        [t for t in state_transitions if t[2] in live] for state_transitions in transitions
+    ]
+    return _minimize(Dfa(accepting, transitions), live)
+
+
+def _merge_adjacent(transitions: List[Transition]) -> List[Transition]:
+    merged: List[Transition] = []
+    for start, end, target in transitions:
+        if merged and merged[-1][1] + 1 == start and merged[-1][2] == target:
+            merged[-1] = (merged[-1][0], end, target)
+        else:
+            merged.append((start, end, target))
+    return merged
+
+
+def _minimize(dfa: Dfa, live: Set[int]) -> Dfa:
+    """
+    Moore's partition refinement over the `live` states, the states of the
+    result are numbered in breadth-first order from the start state.
+    """
+    states = sorted(live)
+    block = {state: int(dfa.accepting[state]) for state in states}
+    num_blocks = len(set(block.values()))
+    while True:
+        signatures: Dict[tuple, int] = {}
+        new_block = {}
+        for state in states:
+            signature = (
+                block[state],
+                tuple(
+                    _merge_adjacent(
+                        [(start, end, block[target]) for start, end, target in dfa.transitions[state]]
+                    )
+                ),
+            )
+            new_block[state] = signatures.setdefault(signature, len(signatures))
+        block = new_block
+        if len(signatures) == num_blocks:
+            break
+        num_blocks = len(signatures)
+
+    # renumber the blocks from the start state, one representative per block
+    numbers = {block[0]: 0}
+    representatives = [0]
+    for state in representatives:
+        for _, _, target in dfa.transitions[state]:
+            if block[target] not in numbers:
+                numbers[block[target]] = len(representatives)
+                representatives.append(target)
+    if len(representatives) > MAX_DFA_STATES:
+        raise _TooLarge()
+    return Dfa(
+        [dfa.accepting[state] for state in representatives],
+        [
+            _merge_adjacent(
+                [(start, end, numbers[block[target]]) for start, end, target in dfa.transitions[state]]
+            )
+            for state in representatives
+        ],
+    )
+
+
+def build_dfa(rules: Rules, rule_id: int, component: Dict[int, int] = None) -> Optional[Dfa]:
+    """
+    The minimized DFA of the language of the regular rule `rule_id`, or None
+    if it is empty or if the automaton would be too large.
+    """
+    if component is None:
+        component = _strongly_connected_components(rules)
+    nfa = _Nfa()
+    try:
+        final = nfa.new_state()
+        start = nfa.add_rule(rules, component, rule_id, final)
+        return _determinize(nfa, start, final)
+    except _TooLarge:
+        logger.debug(f"rule {rule_id} is too large to be compiled into a DFA")
+        return None
+
+
+########################
+# Compilation          #
+########################
+
+
+def compile_regular_rules(rules: Rules, start_rule_id: int) -> List[int]:
+    """
+    Compile the regular rules reachable from the start rule into DFAs and
+    return the resulting grammar encoding. Every reference to a compiled rule
+    becomes a (DFA_REF_MARKER, state_offset) element of the same size, the
+    state records are appended after END_OF_GRAMMAR_MARKER, and the compiled
+    rules only used from other compiled rules are dropped. A compiled start
+    rule is kept with a single alternative referencing its DFA. Repetitions
+    in the kept rules stay counters over their rule.
+    """
+    regular = find_regular_rules(rules)
+    component = _strongly_connected_components(rules)
+
+    dfas: Dict[int, Dfa] = {}
+    kept: Set[int] = set()
+    visited: Set[Tuple[int, bool]] = set()
+    # the rules of repetitions are iterated by the recognizer, they keep their body
+    worklist = [(start_rule_id, False)]
+    while worklist:
+        rule_id, repeated = worklist.pop()
+        if (rule_id, repeated) in visited:
+            continue
+        visited.add((rule_id, repeated))
+        if not repeated and rule_id in regular:
+            if rule_id not in dfas:
+                dfa = build_dfa(rules, rule_id, component)
+                if dfa is not None:
+                    dfas[rule_id] = dfa
+            if rule_id in dfas:
+                continue
+        kept.add(rule_id)
+        for alternative in rules.get(rule_id, []):
+            for element in alternative:
+                if is_ref(element) or is_repeat(element):
+                    worklist.append((element[1], is_repeat(element)))
+
+    def compiled_alternative(alternative: Alternative, offsets: Dict[int, int]) -> Alternative:
+        return tuple(
+            (DFA_REF_MARKER, offsets[element[1]])
+            if is_ref(element) and element[1] in dfas
+            else element
+            for element in alternative
+        )
+
+    def compiled_rules(offsets: Dict[int, int]) -> Rules:
+        compiled = {}
+        if start_rule_id in dfas:
+            compiled[start_rule_id] = [((DFA_REF_MARKER, offsets[start_rule_id]),)]
+        for rule_id in sorted(kept):
+            compiled[rule_id] = [
+                compiled_alternative(alternative, offsets) for alternative in rules[rule_id]
+            ]
+        return compiled
+
+    # the rules have the same size whatever the offsets, lay out the DFAs after them
+    base = len(encode_rules(compiled_rules({rule_id: 0 for rule_id in dfas})))
+    offsets: Dict[int, int] = {}
+    dfa_encoding: List[int] = []
+    for rule_id, dfa in dfas.items():
+        offsets[rule_id] = base + len(dfa_encoding)
+        dfa_encoding += dfa.encode(offsets[rule_id])
+
+    logger.debug(
+        f"compiled {len(dfas)} regular rules into DFAs with "
+        f"{sum(len(dfa) for dfa in dfas.values())} states"
+    )
+    return encode_rules(compiled_rules(offsets)) + dfa_encoding
+
+
+def compile_dfa_grammar(state: ParseState, start_rule_name: str = "root") -> ParseState:
+    """
+    Compile the regular rules of a parsed grammar into DFAs, see
+    compile_regular_rules. This should run after optimize_grammar, which
+    does not know about DFAs.
+    """
+    start_rule_id = state.symbol_table[start_rule_name]
+    rules = decode_rules(state.grammar_encoding)
+    grammar_encoding = compile_regular_rules(rules, start_rule_id)
+
+    compiled_rule_ids = set(decode_rules(grammar_encoding))
+    compiled_state = ParseState()
+    compiled_state.symbol_table = {
+        name: rule_id
+        for name, rule_id in state.symbol_table.items()
+        if rule_id in compiled_rule_ids
+    }
+    compiled_state.grammar_encoding = grammar_encoding
+    return compiled_state
@@ -0,0 +1,355 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from transformers_gad.cache import CacheStats
+from transformers_gad.char_class import CharClass
+from transformers_gad.grammar_analysis import (
+    GrammarTables,
+    next_element_offset,
+    repeat_frame,
+    split_repeat_frame,
+)
+from transformers_gad.lazy_dfa import code_point_boundaries
+from transformers_gad.parser import (
+    END_OF_ALTERNATE_MARKER,
+    END_OF_RULE_MARKER,
+    REF_RULE_MARKER,
+    REPEAT_MARKER,
+    REPEAT_UNBOUNDED,
+)
+from transformers_gad.recognizer import AcceptState, get_rule_offsets, step_bytes
+from transformers_gad.utf8_automaton import UTF8_START, Utf8Automaton
+
+logger = logging.getLogger(__name__)
+
+# An Earley item: the rule, the dot, i.e. the offset of the next element of
+# the alternative, a repeat_frame for a repetition in progress, or the offset
+# of its END_OF_ALTERNATE_MARKER once it is complete, and the column where
+# the item started
+Item = Tuple[int, int, "Column"]
+
+
+class Column:
+    """
+    The Earley set of the items after a prefix of the input, closed under
+    prediction and completion. A column is never modified once it is built,
+    the items of the later columns point back to the columns they started in.
+
+    - `scannable`: the items with a terminal after the dot,
+    - `waiting`: for every rule, the items of the column with a reference or
+      a repetition of the rule after the dot, they are advanced when the rule
+      is completed from this column,
+    - `accepting`: whether the start rule is complete from the first column.
+    """
+
+    __slots__ = ("items", "scannable", "waiting", "accepting", "first_bytes")
+
+    def __init__(self):
+        self.items: Dict[Item, None] = {}
+        self.scannable: List[Item] = []
+        self.waiting: Dict[int, List[Item]] = {}
+        self.accepting = False
+        self.first_bytes = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return f"Column({len(self.items)} items, accepting={self.accepting})"
+
+
+# The column of a finished parse, it plays the part of the empty stack of
+# StringRecognizer: it can stop, consumes nothing and its token mask only
+# allows EOS
+FINISHED = Column()
+FINISHED.accepting = True
+
+
+class EarleyRecognizer:
+    """
+    Earley recognizer with the AcceptState interface of StringRecognizer, for
+    the grammars the stack recognizer handles badly: ambiguous grammars,
+    whose stacks can multiply at every character, and left-recursive ones,
+    whose expansion by advance_stack never ends, see ClosureTable.
+
+    The `stacks` of an accept state hold the current Column, see _live. A column has O(|G| n) items after n characters, so
+    a character costs O(|G| n^2) in the worst case and O(|G|) on unambiguous
+    grammars. Nullable rules are handled as in Aycock and Horspool's
+    "Practical Earley Parsing": a reference to a nullable rule is also
+    skipped as soon as it is predicted. Repetitions keep their count in the
+    dot, see repeat_frame, as in the stack recognizer.
+
+    Grammars compiled into DFAs are not supported, the DFAs are a stack
+    recognizer optimization.
+    """
+
+    def __init__(
+        self,
+        grammar_encoding: List[int],
+        start_rule_id: int = None,
+        rule_offsets: List[int] = None,
+    ):
+        self.grammar_encoding = grammar_encoding
+        if rule_offsets is not None:
+            self.rule_offsets = rule_offsets
+        else:
+            if start_rule_id is None:
+                raise ValueError("start_rule_id cannot be None if rule_offsets is None")
+            self.rule_offsets = get_rule_offsets(grammar_encoding, start_rule_id)
+        self.start_rule_id = start_rule_id
+        self.tables = GrammarTables(self.grammar_encoding, self.rule_offsets)
+        if self.tables.dfa_states:
+            raise ValueError("the Earley recognizer does not support grammars compiled into DFAs")
+        self.char_classes = self.tables.char_classes
+        self.utf8 = Utf8Automaton(code_point_boundaries(self.char_classes.values()))
+        self.element_classes: Dict[int, int] = {
+            element_offset: self.utf8.class_mask(char_class)
+            for element_offset, char_class in self.char_classes.items()
+        }
+
+        # the first dot of every alternative of every rule
+        self.rule_dots: Dict[int, List[int]] = {}
+        for rule_id, rule_offset in enumerate(self.rule_offsets):
+            if rule_offset < 0:
+                continue
+            dots = []
+            pos = rule_offset + 1
+            while self.grammar_encoding[pos] != END_OF_RULE_MARKER:
+                dots.append(pos + 1)
+                pos += self.grammar_encoding[pos] + 1
+            self.rule_dots[rule_id] = dots
+
+        # the column before the first character, where the start rule is predicted
+        self._start_column = Column()
+        self._initial_accept_state = None
+
+    def get_initial_accept_state(self) -> AcceptState:
+        if self._initial_accept_state is None:
+            column = self._start_column
+            items = [(self.start_rule_id, dot, column) for dot in self.rule_dots[self.start_rule_id]]
+            self._close(column, items)
+            self._initial_accept_state = AcceptState(self._live(column), UTF8_START)
+        return self._initial_accept_state
+
+    def get_termination_accept_state(self) -> AcceptState:
+        return AcceptState((), UTF8_START)
+
+    def cache_stats(self) -> List[CacheStats]:
+        return []
+
+    def close(self):
+        """
+        Nothing is cached, the columns are released with the accept states.
+        """
+
+    ##########################
+    #
+    # Earley sets
+    #
+    ##########################
+
+    def _advance(self, rule_id: int, dot: int, origin: "Column") -> Optional[Item]:
+        """
+        The item with the dot past the element at `dot`, None if the rest of
+        the alternative can never be completed.
+        """
+        element_offset, _ = split_repeat_frame(dot)
+        next_dot = next_element_offset(self.grammar_encoding, element_offset)
+        if self.grammar_encoding[next_dot] != END_OF_ALTERNATE_MARKER and self.tables.is_dead(
+            next_dot
+        ):
+            return None
+        return rule_id, next_dot, origin
+
+    def _close(self, column: Column, agenda: List[Item]):
+        """
+        Add the items of `agenda` to the column, along with everything they
+        predict and complete.
+        """
+        encoding = self.grammar_encoding
+        items = column.items
+        while agenda:
+            item = agenda.pop()
+            if item is None or item in items:
+                continue
+            items[item] = None
+            rule_id, dot, origin = item
+            element_offset, count = split_repeat_frame(dot)
+            marker = encoding[element_offset]
+
+            if marker == END_OF_ALTERNATE_MARKER:
+                # completion: advance the items waiting for the rule where it started
+                if rule_id == self.start_rule_id and origin is self._start_column:
+                    column.accepting = True
+                if origin is column:
+                    # an empty derivation, the waiting items of this column
+                    # already skipped the rule when it was predicted
+                    continue
+                for parent in origin.waiting.get(rule_id, ()):
+                    agenda.append(self._complete(parent))
+            elif marker == REF_RULE_MARKER:
+                ref_rule_id = encoding[element_offset + 1]
+                column.waiting.setdefault(ref_rule_id, []).append(item)
+                self._predict(column, ref_rule_id, agenda)
+                if self.tables.rule_nullable.get(ref_rule_id, False):
+                    agenda.append(self._advance(rule_id, dot, origin))
+            elif marker == REPEAT_MARKER:
+                _, ref_rule_id, min_count, max_count = encoding[element_offset : element_offset + 4]
+                if count < max_count:
+                    column.waiting.setdefault(ref_rule_id, []).append(item)
+                    self._predict(column, ref_rule_id, agenda)
+                if count >= min_count or self.tables.rule_nullable.get(ref_rule_id, False):
+                    agenda.append(self._advance(rule_id, dot, origin))
+            else:
+                column.scannable.append(item)
+                column.first_bytes |= self.tables.element_first_bytes[element_offset]
+
+    def _predict(self, column: Column, rule_id: int, agenda: List[Item]):
+        for dot in self.rule_dots[rule_id]:
+            if self.grammar_encoding[dot] != END_OF_ALTERNATE_MARKER and self.tables.is_dead(dot):
+                continue
+            agenda.append((rule_id, dot, column))
+
+    def _complete(self, parent: Item) -> Optional[Item]:
+        """
+        The parent item once the rule after its dot is complete.
+        """
+        rule_id, dot, origin = parent
+        element_offset, count = split_repeat_frame(dot)
+        if self.grammar_encoding[element_offset] != REPEAT_MARKER:
+            return self._advance(rule_id, dot, origin)
+        _, _, min_count, max_count = self.grammar_encoding[element_offset : element_offset + 4]
+        # past the min count, the iterations of an unbounded repetition are all alike
+        if max_count == REPEAT_UNBOUNDED:
+            next_frame = repeat_frame(element_offset, min(count + 1, min_count))
+        else:
+            next_frame = repeat_frame(element_offset, count + 1)
+        if self.tables.is_dead(next_frame):
+            return None
+        return rule_id, next_frame, origin
+
+    def _scan(self, column: Column, code_point: int) -> Column:
+        new_column = Column()
+        if code_point == 0:
+            return new_column
+        agenda = [
+            self._advance(rule_id, dot, origin)
+            for rule_id, dot, origin in column.scannable
+            if code_point in self.char_classes[dot]
+        ]
+        self._close(new_column, agenda)
+        return new_column
+
+    @staticmethod
+    def _live(column: Column) -> Tuple[Column, ...]:
+        """
+        The stacks of the accept state of a column: the column if it can
+        consume more, and FINISHED if the input can stop here, nothing if the
+        input is rejected.
+        """
+        if column.scannable:
+            return (column, FINISHED) if column.accepting else (column,)
+        return (FINISHED,) if column.accepting else ()
+
+    ##########################
+    #
+    # AcceptState interface
+    #
+    ##########################
+
+    def _step_stacks(self, code_point: int, stacks) -> List[Column]:
+        new_stacks = []
+        for column in stacks:
+            new_stacks.extend(self._live(self._scan(column, code_point)))
+        return new_stacks
+
+    def _first_bytes(self, stacks) -> int:
+        first_bytes = 0
+        for column in stacks:
+            first_bytes |= column.first_bytes
+        return first_bytes
+
+    def _consume_code_points(self, code_points: List[int], stacks, verbose=False):
+        for code_point in code_points:
+            if not stacks:
+                break
+            stacks = self._step_stacks(code_point, stacks)
+        return list(stacks)
+
+    def _consume_string(self, string: str, accept_state: AcceptState):
+        code_points = [ord(char) for char in string]
+        stacks = self._consume_code_points(code_points, accept_state.stacks)
+        return AcceptState(tuple(stacks), UTF8_START)
+
+    def _keep_partial(self, stacks, utf8_state: int) -> List[Column]:
+        """
+        The columns with a terminal that accepts a character starting with
+        the pending bytes of `utf8_state`, FINISHED accepts no character.
+        """
+        reachable = self.utf8.reachable[utf8_state]
+        return [
+            column
+            for column in stacks
+            if any(self.element_classes[dot] & reachable for _, dot, _ in column.scannable)
+        ]
+
+    def _probe_bytes(self, byte_seq: bytes, stacks, utf8_state: int = UTF8_START, verbose=True):
+        new_stacks, _ = step_bytes(self, byte_seq, stacks, utf8_state)
+        return bool(new_stacks)
+
+    def _consume_bytes(
+        self,
+        byte_seq: bytes,
+        accept_state: AcceptState = None,
+        verbose=True,
+    ):
+        if accept_state is None:
+            accept_state = self.get_initial_accept_state()
+        accept_state = self._feed_bytes(byte_seq, accept_state)
+        if verbose:
+            logger.debug(f"stacks: {accept_state.stacks}; utf8_state: {accept_state.utf8_state}")
+        # as in the stack recognizer, an input that can only finish is dropped
+        new_stacks = [column for column in accept_state.stacks if column.scannable]
+        return AcceptState(tuple(new_stacks), accept_state.utf8_state)
+
+    def _feed_bytes(self, byte_seq: bytes, accept_state: AcceptState) -> AcceptState:
+        """
+        Consume raw bytes, keeping the columns that can only finish.
+        """
+        new_stacks, utf8_state = step_bytes(
+            self, byte_seq, accept_state.stacks, accept_state.utf8_state
+        )
+        return AcceptState(tuple(new_stacks), utf8_state)
+
+    def _next_code_points(self, stacks) -> CharClass:
+        """
+        The code points that the terminals after the dots of the scannable
+        items of the columns accept.
+        """
+        return CharClass(
+            [
+                code_point_range
+                for column in stacks
+                for _, dot, _ in column.scannable
+                for code_point_range in self.char_classes[dot].ranges()
+            ]
+        )
+
+    def _accept_prefix(self, string: str, accept_state: AcceptState = None):
+        if accept_state is None:
+            accept_state = self.get_initial_accept_state()
+        return len(self._consume_string(string, accept_state).stacks) > 0
+
+    def _accept_string(self, string: str, accept_state: AcceptState = None):
+        if accept_state is None:
+            accept_state = self.get_initial_accept_state()
+        new_accept_state = self._consume_string(string, accept_state)
+        return any(column.accepting for column in new_accept_state.stacks)
+
+    def _can_stop(self, stacks):
+        if len(stacks) == 0:
+            return True
+        return any(column.accepting for column in stacks)
+
+    def _must_stop(self, stacks):
+        return not any(column.scannable for column in stacks)
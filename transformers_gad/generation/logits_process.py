@@ -1,4 +1,3 @@
-import copy
 import math
 import torch.nn.functional as F
 
@@ -13,12 +12,24 @@ from transformers_gad.grammar_utils import IncrementalGrammarConstraint
 from transformers_gad.oracle.oracle_trie import Trie
 
 class GrammarConstrainedLogitsProcessor(LogitsProcessor):
-    def __init__(self, grammar_constraint, parse_start_index=None, save_log=False):
+    def __init__(
+        self, grammar_constraint, parse_start_index=None, save_log=False, max_new_tokens=None
+    ):
         # Parser variables
         self.grammar_constraint = grammar_constraint
         self.batch_parsing_states = None
         self.parse_start_index = parse_start_index
 
+        # Length budget: with max_new_tokens, the tokens after which the output
+        # cannot be completed within the remaining tokens are masked
+        if max_new_tokens is not None and not grammar_constraint.supports_length_budget:
+            raise ValueError(
+                f"max_new_tokens is only supported by the stack backend, not {grammar_constraint.backend}."
+            )
+        self.max_new_tokens = max_new_tokens
+        self.prompt_length = None
+        self.remaining_tokens = None
+
         # To start with a longer prefix in enumerative search
         self.generate_start_index = None
         self.generated_tokens = None
@@ -38,6 +49,7 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
 
         self.generate_start_index = None
         self.generated_tokens = None
+        self.prompt_length = None
 
     def reset_history(self):
         self.history = []
@@ -49,7 +61,7 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
         """
         masked_scores = scores.clone()
         acceptance = self.grammar_constraint.batch_filter_vocab(
-            self.batch_parsing_states, device
+            self.batch_parsing_states, device, self.remaining_tokens
         )
         
         if self.save_log:
@@ -63,12 +75,10 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
     def process_scores(self, input_ids, scores):
         # we dynamically create stacks at the first call, so that we know the batch size and beam size
         if self.batch_parsing_states is None:
-            self.batch_parsing_states = [
-                copy.deepcopy(
-                    self.grammar_constraint.string_recognizer.get_initial_accept_state()
-                )
-                for _ in range(len(input_ids))
-            ]
+            # accept states are immutable, the rows share the initial state
+            initial_state = self.grammar_constraint.string_recognizer.get_initial_accept_state()
+            self.batch_parsing_states = [initial_state] * len(input_ids)
+            self.prompt_length = input_ids.size(1)
 
         # assume the generation starts from the same index
         if self.generate_start_index is None:
@@ -76,6 +86,10 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
             self.generate_start_index = self.parse_start_index \
                 if self.parse_start_index else input_ids.size(1)
         self.generated_tokens = input_ids[:, self.generate_start_index:]
+        if self.max_new_tokens is not None:
+            self.remaining_tokens = self.max_new_tokens - (input_ids.size(1) - self.prompt_length)
+        else:
+            self.remaining_tokens = None
 
         # Advance parser states
         self.batch_parsing_states = self.grammar_constraint.advance_token_ids(
@@ -159,12 +173,29 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
         self.history.append(batch_accepted_info)
 
 class GrammarAlignedOracleLogitsProcessor(LogitsProcessor):
-    def __init__(self, grammar_constraint, oracle_trie=Trie(), parse_start_index=None, save_log=False):
+    def __init__(
+        self,
+        grammar_constraint,
+        oracle_trie=Trie(),
+        parse_start_index=None,
+        save_log=False,
+        max_new_tokens=None,
+    ):
         # Parser variables
         self.grammar_constraint = grammar_constraint
         self.batch_parsing_states = None
         self.parse_start_index = parse_start_index
 
+        # Length budget: with max_new_tokens, the tokens after which the output
+        # cannot be completed within the remaining tokens are masked
+        if max_new_tokens is not None and not grammar_constraint.supports_length_budget:
+            raise ValueError(
+                f"max_new_tokens is only supported by the stack backend, not {grammar_constraint.backend}."
+            )
+        self.max_new_tokens = max_new_tokens
+        self.prompt_length = None
+        self.remaining_tokens = None
+
         # ASAp oracle trie
         self.oracle_trie = oracle_trie
 
@@ -182,7 +213,7 @@ class GrammarAlignedOracleLogitsProcessor(LogitsProcessor):
         indicating acceptance
         """
         acceptance = self.grammar_constraint.batch_filter_vocab(
-            self.batch_parsing_states, device
+            self.batch_parsing_states, device, self.remaining_tokens
         )
 
         current_parent = self.oracle_trie.search_last_parent(self.generated_tokens)
@@ -235,12 +266,10 @@ class GrammarAlignedOracleLogitsProcessor(LogitsProcessor):
     def process_scores(self, input_ids, scores):
         # we dynamically create stacks at the first call, so that we know the batch size and beam size
         if self.batch_parsing_states is None:
-            self.batch_parsing_states = [
-                copy.deepcopy(
-                    self.grammar_constraint.string_recognizer.get_initial_accept_state()
-                )
-                for _ in range(len(input_ids))
-            ]
+            # accept states are immutable, the rows share the initial state
+            initial_state = self.grammar_constraint.string_recognizer.get_initial_accept_state()
+            self.batch_parsing_states = [initial_state] * len(input_ids)
+            self.prompt_length = input_ids.size(1)
 
         # assume the generation starts from the same index
         if self.generate_start_index is None:
@@ -248,6 +277,10 @@ class GrammarAlignedOracleLogitsProcessor(LogitsProcessor):
             self.generate_start_index = self.parse_start_index \
                 if self.parse_start_index else input_ids.size(1)
         self.generated_tokens = input_ids[:, self.generate_start_index:]
+        if self.max_new_tokens is not None:
+            self.remaining_tokens = self.max_new_tokens - (input_ids.size(1) - self.prompt_length)
+        else:
+            self.remaining_tokens = None
 
         # Advance parser states
         self.batch_parsing_states = self.grammar_constraint.advance_token_ids(
@@ -275,6 +308,7 @@ class GrammarAlignedOracleLogitsProcessor(LogitsProcessor):
 
         self.generate_start_index = None
         self.generated_tokens = None
+        self.prompt_length = None
 
     def reset_history(self):
         self.history = []
@@ -0,0 +1,615 @@
+import logging
+import math
+from typing import Dict, Generator, List, NamedTuple, Optional, Sequence, Tuple
+
+from transformers_gad.char_class import CharClass
+from transformers_gad.dfa import DfaState, dfa_states
+from transformers_gad.parser import (
+    DFA_REF_MARKER,
+    DFA_STATE_MARKER,
+    END_OF_ALTERNATE_MARKER,
+    END_OF_RULE_MARKER,
+    REF_RULE_MARKER,
+    REPEAT_MARKER,
+    REPEAT_UNBOUNDED,
+)
+
+logger = logging.getLogger(__name__)
+
+# A set of code points as sorted, disjoint and non-adjacent closed intervals
+Intervals = Tuple[Tuple[int, int], ...]
+EMPTY: Intervals = ()
+
+# A repetition in progress is a single stack value: the offset of its REPEAT
+# element plus the number of iterations done, shifted by REPEAT_COUNT_SHIFT.
+# With no iteration done, it is the element offset itself.
+REPEAT_COUNT_SHIFT = 32
+_OFFSET_MASK = (1 << REPEAT_COUNT_SHIFT) - 1
+
+
+def repeat_frame(element_offset: int, count: int) -> int:
+    return (count << REPEAT_COUNT_SHIFT) | element_offset
+
+
+def split_repeat_frame(stack_value: int) -> Tuple[int, int]:
+    """
+    The element offset and the repetition count of a stack value.
+    """
+    return stack_value & _OFFSET_MASK, stack_value >> REPEAT_COUNT_SHIFT
+
+
+def union_intervals(*interval_lists: Intervals) -> Intervals:
+    ranges = sorted(pair for intervals in interval_lists for pair in intervals)
+    if not ranges:
+        return EMPTY
+    merged = [list(ranges[0])]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return tuple((start, end) for start, end in merged)
+
+
+def byte_mask(intervals: Intervals) -> int:
+    """
+    Bitmask of the code points below 256 in `intervals`, bit i is set iff i is in the set.
+    """
+    mask = 0
+    for start, end in intervals:
+        if start > 0xFF:
+            break
+        end = min(end, 0xFF)
+        mask |= ((1 << (end - start + 1)) - 1) << start
+    return mask
+
+
+def rule_alternatives(grammar_encoding: Sequence[int], rule_offset: int) -> List[List[int]]:
+    """
+    The element offsets of every alternative of the rule at `rule_offset`.
+    """
+    alternatives = []
+    pos = rule_offset + 1
+    while grammar_encoding[pos] != END_OF_RULE_MARKER:
+        element_offset = pos + 1
+        elements = []
+        while grammar_encoding[element_offset] != END_OF_ALTERNATE_MARKER:
+            elements.append(element_offset)
+            element_offset = next_element_offset(grammar_encoding, element_offset)
+        alternatives.append(elements)
+        pos += grammar_encoding[pos] + 1
+    return alternatives
+
+
+def next_element_offset(grammar_encoding: Sequence[int], element_offset: int) -> int:
+    if grammar_encoding[element_offset] in (REF_RULE_MARKER, DFA_REF_MARKER):
+        return element_offset + 2
+    if grammar_encoding[element_offset] == REPEAT_MARKER:
+        return element_offset + 4
+    return element_offset + grammar_encoding[element_offset] + 1
+
+
+class GrammarTables:
+    """
+    Static analysis of a grammar encoding, computed once at load time.
+
+    For every element offset, i.e. every value a stack can hold, it records:
+    - `element_nullable`: whether the rest of the alternative starting at the
+      element can derive the empty string,
+    - `element_productive`: whether the rest of the alternative starting at
+      the element can derive any string at all,
+    - `element_first`: the code points that can start a string derived from
+      the rest of the alternative starting at the element,
+    - `element_first_bytes`: the same set restricted to code points below 256,
+      as a bitmask,
+    - `element_min_length`: the minimum number of code points of a string
+      derived from the rest of the alternative starting at the element,
+      math.inf if it derives none.
+    It also holds the CharClass of every terminal element in `char_classes`.
+    The states of the compiled DFAs, see transformers_gad/dfa.py, are stack
+    elements too: they are in `dfa_states` and in all the tables above, a
+    state is nullable iff it is accepting. The entries of the repetitions in
+    progress, see repeat_frame, are computed on first access.
+    A stack can derive the empty string iff all its elements are nullable, and
+    the code points it can consume next are the FIRST sets of its elements
+    from the top down to the first non-nullable one. The shortest completion
+    of a stack is the sum of the min lengths of its elements.
+    """
+
+    def __init__(self, grammar_encoding: Sequence[int], rule_offsets: Sequence[int]):
+        self.grammar_encoding = grammar_encoding
+        self.rule_offsets = rule_offsets
+
+        rules: Dict[int, List[List[int]]] = {
+            rule_id: rule_alternatives(grammar_encoding, rule_offset)
+            for rule_id, rule_offset in enumerate(rule_offsets)
+            if rule_offset >= 0
+        }
+
+        element_offsets = [
+            element_offset
+            for alternatives in rules.values()
+            for elements in alternatives
+            for element_offset in elements
+        ]
+        self.dfa_states: Dict[int, DfaState] = {}
+        for element_offset in element_offsets:
+            if grammar_encoding[element_offset] == DFA_REF_MARKER:
+                state_offset = grammar_encoding[element_offset + 1]
+                if state_offset not in self.dfa_states:
+                    self.dfa_states.update(dfa_states(grammar_encoding, state_offset))
+
+        self.char_classes: Dict[int, CharClass] = {
+            element_offset: CharClass.from_element(grammar_encoding, element_offset)
+            for element_offset in element_offsets
+            if grammar_encoding[element_offset]
+            not in (REF_RULE_MARKER, DFA_REF_MARKER, REPEAT_MARKER)
+        }
+        for state_offset, state in self.dfa_states.items():
+            self.char_classes[state_offset] = CharClass(state.ranges())
+
+        self.rule_nullable: Dict[int, bool] = self._compute_rule_flags(
+            rules, lambda e: self._element_tables(e)[0]
+        )
+        self.rule_productive: Dict[int, bool] = self._compute_rule_flags(
+            rules, lambda e: True
+        )
+        self.rule_first: Dict[int, Intervals] = self._compute_rule_first(rules)
+        self.dfa_min_length: Dict[int, float] = self._compute_dfa_min_length()
+        self.rule_min_length: Dict[int, float] = self._compute_rule_min_length(rules)
+
+        self.element_nullable: Dict[int, bool] = _RepeatFrameTable(self)
+        self.element_productive: Dict[int, bool] = _RepeatFrameTable(self)
+        self.element_first: Dict[int, Intervals] = _RepeatFrameTable(self)
+        self.element_first_bytes: Dict[int, int] = _RepeatFrameTable(self)
+        self.element_min_length: Dict[int, float] = _RepeatFrameTable(self)
+        for alternatives in rules.values():
+            for elements in alternatives:
+                nullable, productive, first, min_length = True, True, EMPTY, 0
+                # walk the alternative backwards, accumulating the suffix tables
+                for element_offset in reversed(elements):
+                    element_nullable, element_first = self._element_tables(element_offset)
+                    if element_nullable:
+                        first = union_intervals(element_first, first)
+                    else:
+                        first = element_first
+                    nullable = nullable and element_nullable
+                    productive = productive and self._element_productive(element_offset)
+                    min_length += self._element_min_length(element_offset)
+                    self.element_nullable[element_offset] = nullable
+                    self.element_productive[element_offset] = productive
+                    self.element_first[element_offset] = first
+                    self.element_first_bytes[element_offset] = byte_mask(first)
+                    self.element_min_length[element_offset] = min_length
+        for state_offset in self.dfa_states:
+            # every state of a compiled DFA can reach an accepting state
+            nullable, first = self._element_tables(state_offset)
+            self.element_nullable[state_offset] = nullable
+            self.element_productive[state_offset] = True
+            self.element_first[state_offset] = first
+            self.element_first_bytes[state_offset] = byte_mask(first)
+            self.element_min_length[state_offset] = self.dfa_min_length[state_offset]
+
+    def _add_repeat_frame(self, stack_value: int):
+        """
+        Table entries of a repetition with some iterations done: it can be left
+        once the min count is reached, and iterated until the max count.
+        """
+        element_offset, count = split_repeat_frame(stack_value)
+        if count == 0 or self.grammar_encoding[element_offset] != REPEAT_MARKER:
+            raise KeyError(stack_value)
+        _, rule_id, min_count, max_count = self.grammar_encoding[element_offset : element_offset + 4]
+        rest_offset = element_offset + 4
+        if self.grammar_encoding[rest_offset] == END_OF_ALTERNATE_MARKER:
+            rest_nullable, rest_productive, rest_first, rest_min_length = True, True, EMPTY, 0
+        else:
+            rest_nullable = self.element_nullable[rest_offset]
+            rest_productive = self.element_productive[rest_offset]
+            rest_first = self.element_first[rest_offset]
+            rest_min_length = self.element_min_length[rest_offset]
+
+        can_leave = count >= min_count or self.rule_nullable.get(rule_id, False)
+        first = self.rule_first.get(rule_id, EMPTY) if count < max_count else EMPTY
+        if can_leave:
+            first = union_intervals(first, rest_first)
+        self.element_nullable[stack_value] = can_leave and rest_nullable
+        self.element_productive[stack_value] = rest_productive and (
+            count >= min_count or self.rule_productive.get(rule_id, False)
+        )
+        self.element_first[stack_value] = first
+        self.element_first_bytes[stack_value] = byte_mask(first)
+        self.element_min_length[stack_value] = rest_min_length + _repeat_min_length(
+            max(min_count - count, 0), self.rule_min_length.get(rule_id, math.inf)
+        )
+
+    def _element_tables(self, element_offset: int) -> Tuple[bool, Intervals]:
+        """
+        nullable flag and FIRST set of a single element, not of the suffix
+        """
+        if self.grammar_encoding[element_offset] == REF_RULE_MARKER:
+            rule_id = self.grammar_encoding[element_offset + 1]
+            return self.rule_nullable.get(rule_id, False), self.rule_first.get(rule_id, EMPTY)
+        if self.grammar_encoding[element_offset] == REPEAT_MARKER:
+            _, rule_id, min_count, max_count = self.grammar_encoding[element_offset : element_offset + 4]
+            return (
+                min_count == 0 or self.rule_nullable.get(rule_id, False),
+                self.rule_first.get(rule_id, EMPTY) if max_count > 0 else EMPTY,
+            )
+        if self.grammar_encoding[element_offset] == DFA_REF_MARKER:
+            element_offset = self.grammar_encoding[element_offset + 1]
+        first = tuple(self.char_classes[element_offset].ranges())
+        if self.grammar_encoding[element_offset] == DFA_STATE_MARKER:
+            return self.dfa_states[element_offset].accepting, first
+        return False, first
+
+    def _element_productive(self, element_offset: int) -> bool:
+        if self.grammar_encoding[element_offset] == REF_RULE_MARKER:
+            rule_id = self.grammar_encoding[element_offset + 1]
+            return self.rule_productive.get(rule_id, False)
+        if self.grammar_encoding[element_offset] == REPEAT_MARKER:
+            rule_id = self.grammar_encoding[element_offset + 1]
+            min_count = self.grammar_encoding[element_offset + 2]
+            return min_count == 0 or self.rule_productive.get(rule_id, False)
+        if self.grammar_encoding[element_offset] == DFA_REF_MARKER:
+            return True
+        return self.grammar_encoding[element_offset] > 0
+
+    def _element_min_length(self, element_offset: int) -> float:
+        """
+        min length of a single element, not of the suffix
+        """
+        if self.grammar_encoding[element_offset] == REF_RULE_MARKER:
+            rule_id = self.grammar_encoding[element_offset + 1]
+            return self.rule_min_length.get(rule_id, math.inf)
+        if self.grammar_encoding[element_offset] == REPEAT_MARKER:
+            _, rule_id, min_count, _ = self.grammar_encoding[element_offset : element_offset + 4]
+            return _repeat_min_length(min_count, self.rule_min_length.get(rule_id, math.inf))
+        if self.grammar_encoding[element_offset] == DFA_REF_MARKER:
+            return self.dfa_min_length[self.grammar_encoding[element_offset + 1]]
+        return 1 if self.grammar_encoding[element_offset] > 0 else math.inf
+
+    def _compute_dfa_min_length(self) -> Dict[int, float]:
+        """
+        The number of code points from every DFA state to the nearest
+        accepting state.
+        """
+        min_length = {
+            state_offset: 0 if state.accepting else math.inf
+            for state_offset, state in self.dfa_states.items()
+        }
+        changed = True
+        while changed:
+            changed = False
+            for state_offset, state in self.dfa_states.items():
+                for target in state.targets:
+                    if min_length[target] + 1 < min_length[state_offset]:
+                        min_length[state_offset] = min_length[target] + 1
+                        changed = True
+        return min_length
+
+    def _compute_rule_min_length(self, rules) -> Dict[int, float]:
+        """
+        Greatest fixpoint from math.inf of: the min length of a rule is the
+        least sum of the min lengths of the elements of one of its
+        alternatives. Unproductive rules keep math.inf.
+        """
+        min_length: Dict[int, float] = {rule_id: math.inf for rule_id in rules}
+        self.rule_min_length = min_length
+        changed = True
+        while changed:
+            changed = False
+            for rule_id, alternatives in rules.items():
+                for elements in alternatives:
+                    length = sum(self._element_min_length(e) for e in elements)
+                    if length < min_length[rule_id]:
+                        min_length[rule_id] = length
+                        changed = True
+        return min_length
+
+    def _compute_rule_flags(self, rules, terminal_flag) -> Dict[int, bool]:
+        """
+        Least fixpoint of: a rule has the flag iff one of its alternatives is
+        made only of terminals for which `terminal_flag` holds and of rules
+        with the flag. This gives nullable rules for a flag that holds on the
+        nullable terminals, i.e. only on the DFA references whose start state
+        is accepting, and productive rules for a flag that is true on terminals.
+        A repetition has the flag if its min count is 0 or its rule has it.
+        """
+        flags = {rule_id: False for rule_id in rules}
+
+        def has_flag(e: int) -> bool:
+            if self.grammar_encoding[e] == REF_RULE_MARKER:
+                return flags.get(self.grammar_encoding[e + 1], False)
+            if self.grammar_encoding[e] == REPEAT_MARKER:
+                return self.grammar_encoding[e + 2] == 0 or flags.get(
+                    self.grammar_encoding[e + 1], False
+                )
+            return terminal_flag(e)
+
+        changed = True
+        while changed:
+            changed = False
+            for rule_id, alternatives in rules.items():
+                if flags[rule_id]:
+                    continue
+                for elements in alternatives:
+                    if all(has_flag(e) for e in elements):
+                        flags[rule_id] = True
+                        changed = True
+                        break
+        return flags
+
+    def _compute_rule_first(self, rules) -> Dict[int, Intervals]:
+        first: Dict[int, Intervals] = {rule_id: EMPTY for rule_id in rules}
+        changed = True
+        while changed:
+            changed = False
+            for rule_id, alternatives in rules.items():
+                rule_first = first[rule_id]
+                for elements in alternatives:
+                    for e in elements:
+                        if self.grammar_encoding[e] in (REF_RULE_MARKER, REPEAT_MARKER):
+                            ref_rule_id = self.grammar_encoding[e + 1]
+                            rule_first = union_intervals(
+                                rule_first, first.get(ref_rule_id, EMPTY)
+                            )
+                            repeat_nullable = (
+                                self.grammar_encoding[e] == REPEAT_MARKER
+                                and self.grammar_encoding[e + 2] == 0
+                            )
+                            if not (self.rule_nullable.get(ref_rule_id, False) or repeat_nullable):
+                                break
+                        else:
+                            nullable, element_first = self._element_tables(e)
+                            rule_first = union_intervals(rule_first, element_first)
+                            if not nullable:
+                                break
+                if rule_first != first[rule_id]:
+                    first[rule_id] = rule_first
+                    changed = True
+        return first
+
+    def is_dead(self, element_offset: int) -> bool:
+        """
+        Whether no stack with this element can ever be accepted, e.g. the rest
+        of the alternative references an unproductive rule.
+        """
+        return not self.element_productive[element_offset]
+
+    def stack_can_finish(self, stack: Sequence[int]) -> bool:
+        """
+        Whether the rest of the stack can derive the empty string.
+        """
+        return all(self.element_nullable[element_offset] for element_offset in reversed(stack))
+
+    def stack_can_continue(self, stack: Sequence[int]) -> bool:
+        """
+        Whether the stack can consume at least one more code point.
+        """
+        for element_offset in reversed(stack):
+            if self.element_first[element_offset]:
+                return True
+            if not self.element_nullable[element_offset]:
+                break
+        return False
+
+    def stack_min_length(self, stack: Sequence[int]) -> float:
+        """
+        The minimum number of code points the stack needs to be accepted,
+        math.inf if it can never be.
+        """
+        return sum(self.element_min_length[element_offset] for element_offset in stack)
+
+    def stack_first(self, stack: Sequence[int]) -> Intervals:
+        """
+        The code points that the stack can consume next.
+        """
+        first = EMPTY
+        for element_offset in reversed(stack):
+            first = union_intervals(first, self.element_first[element_offset])
+            if not self.element_nullable[element_offset]:
+                break
+        return first
+
+    def stack_first_bytes(self, stack: Sequence[int]) -> int:
+        """
+        Bitmask of the code points below 256 that the stack can consume next.
+        """
+        mask = 0
+        for element_offset in reversed(stack):
+            mask |= self.element_first_bytes[element_offset]
+            if not self.element_nullable[element_offset]:
+                break
+        return mask
+
+
+def _repeat_min_length(count: int, rule_min_length: float) -> float:
+    # no iteration left costs nothing, even of an unproductive rule
+    return count * rule_min_length if count > 0 else 0
+
+
+class _RepeatFrameTable(dict):
+    """
+    Element table that computes the entries of the repetitions in progress
+    on first access, there is one per repetition count actually reached.
+    """
+
+    def __init__(self, tables: GrammarTables):
+        super().__init__()
+        self.tables = tables
+
+    def __missing__(self, stack_value: int):
+        self.tables._add_repeat_frame(stack_value)
+        return self[stack_value]
+
+
+class Closure(NamedTuple):
+    """
+    The expansion of a stack value by advance_stack: the sequences of stack
+    values, bottom first, that replace it on top of the rest of the stack,
+    each ending with a terminal or a DFA state, and whether it can also be
+    popped, in which case the rest of the stack is expanded in turn.
+    """
+
+    sequences: Tuple[Tuple[int, ...], ...]
+    nullable: bool
+
+
+DEAD_CLOSURE = Closure((), False)
+
+
+class ClosureTable(dict):
+    """
+    The Closure of every element offset of a grammar, computed once at load
+    time, so that advancing a stack only pushes precomputed sequences onto
+    its rest, whatever is below. The entries of the repetitions in progress,
+    see repeat_frame, are computed on first access.
+
+    The closures are computed without recursion, by an explicit agenda of
+    expansions waiting for the closures they need. A stack value whose
+    expansion needs itself, i.e. on a left-recursive rule, which the stacks
+    cannot handle, gets None.
+    """
+
+    def __init__(
+        self,
+        grammar_encoding: Sequence[int],
+        rule_offsets: Sequence[int],
+        tables: GrammarTables,
+    ):
+        super().__init__()
+        self.grammar_encoding = grammar_encoding
+        self.tables = tables
+        # the first element of every alternative of every rule, None for an empty alternative
+        self.rule_starts: Dict[int, List[Optional[int]]] = {
+            rule_id: [
+                elements[0] if elements else None
+                for elements in rule_alternatives(grammar_encoding, rule_offset)
+            ]
+            for rule_id, rule_offset in enumerate(rule_offsets)
+            if rule_offset >= 0
+        }
+        # the element tables hold an entry for every element offset and DFA state
+        for element_offset in list(tables.element_nullable):
+            self[element_offset]
+
+    def __missing__(self, stack_value: int) -> Optional[Closure]:
+        in_progress = {stack_value}
+        agenda = [(stack_value, self._expand(stack_value))]
+        closure = None
+        while agenda:
+            value, expansion = agenda[-1]
+            try:
+                needed = expansion.send(closure)
+            except StopIteration as stop:
+                agenda.pop()
+                in_progress.discard(value)
+                self[value] = closure = stop.value
+                continue
+            if needed in self:
+                closure = self[needed]
+            elif needed in in_progress:
+                # left recursion
+                closure = None
+            else:
+                in_progress.add(needed)
+                agenda.append((needed, self._expand(needed)))
+                closure = None
+        return self[stack_value]
+
+    def _expand(self, stack_value: int) -> Generator[int, Optional[Closure], Optional[Closure]]:
+        """
+        The Closure of a stack value, it yields the stack values whose
+        closures it needs and is sent them back, None for a left recursion.
+        """
+        element_offset, count = split_repeat_frame(stack_value)
+        marker = self.grammar_encoding[element_offset]
+        if marker == REPEAT_MARKER:
+            return (yield from self._expand_repeat(stack_value, element_offset, count))
+        # a DFA state stays on the stack, and it may be left if it is accepting
+        if marker == DFA_STATE_MARKER:
+            state = self.tables.dfa_states[element_offset]
+            return Closure(((element_offset,),) if state.targets else (), state.accepting)
+        if marker not in (REF_RULE_MARKER, DFA_REF_MARKER):
+            return Closure(((element_offset,),), False)
+        # the rest of the alternative can never be completed, the stack is dead
+        if self.tables.is_dead(element_offset):
+            return DEAD_CLOSURE
+
+        # the reference is replaced by the element that follows it, if any,
+        # with the start of the referenced rule or DFA on top
+        next_offset = element_offset + 2
+        if self.grammar_encoding[next_offset] == END_OF_ALTERNATE_MARKER:
+            base = ()
+        else:
+            base = (next_offset,)
+        if marker == DFA_REF_MARKER:
+            starts = [self.grammar_encoding[element_offset + 1]]
+        else:
+            starts = self.rule_starts[self.grammar_encoding[element_offset + 1]]
+        sequences = []
+        nullable = False
+        for start in starts:
+            if start is None:
+                start_closure = Closure((), True)
+            elif self.tables.is_dead(start):
+                # skip the alternatives that can never be completed
+                continue
+            else:
+                start_closure = yield start
+                if start_closure is None:
+                    return None
+            sequences.extend(base + sequence for sequence in start_closure.sequences)
+            if not start_closure.nullable:
+                continue
+            if not base:
+                nullable = True
+                continue
+            next_closure = yield next_offset
+            if next_closure is None:
+                return None
+            sequences.extend(next_closure.sequences)
+            nullable = nullable or next_closure.nullable
+        return Closure(tuple(dict.fromkeys(sequences)), nullable)
+
+    def _expand_repeat(
+        self, stack_value: int, element_offset: int, count: int
+    ) -> Generator[int, Optional[Closure], Optional[Closure]]:
+        """
+        A repetition with `count` iterations done is left if the min count is
+        reached, and another iteration is started on top of the next frame if
+        the max count is not. An iteration deriving the empty string is
+        covered by leaving the repetition.
+        """
+        # the rest of the alternative can never be completed, the stack is dead
+        if self.tables.is_dead(stack_value):
+            return DEAD_CLOSURE
+        _, rule_id, min_count, max_count = self.grammar_encoding[element_offset : element_offset + 4]
+        sequences = []
+        nullable = False
+        if count >= min_count or self.tables.rule_nullable.get(rule_id, False):
+            next_offset = element_offset + 4
+            if self.grammar_encoding[next_offset] == END_OF_ALTERNATE_MARKER:
+                nullable = True
+            else:
+                next_closure = yield next_offset
+                if next_closure is None:
+                    return None
+                sequences.extend(next_closure.sequences)
+                nullable = next_closure.nullable
+
+        if count < max_count:
+            # past the min count, the iterations of an unbounded repetition are
+            # all alike, so the count stops there
+            if max_count == REPEAT_UNBOUNDED:
+                next_frame = repeat_frame(element_offset, min(count + 1, min_count))
+            else:
+                next_frame = repeat_frame(element_offset, count + 1)
+            for start in self.rule_starts.get(rule_id, ()):
+                if start is None or self.tables.is_dead(start):
+                    continue
+                start_closure = yield start
+                if start_closure is None:
+                    return None
+                sequences.extend((next_frame,) + sequence for sequence in start_closure.sequences)
+        return Closure(tuple(dict.fromkeys(sequences)), nullable)
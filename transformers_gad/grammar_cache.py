@@ -0,0 +1,219 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from typing import Dict, List, Optional
+
+from transformers_gad.dfa import compile_dfa_grammar
+from transformers_gad.optimizer import optimize_grammar
+from transformers_gad.parser import parse_ebnf
+from transformers_gad.recognizer import get_rule_offsets
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the artifact layout or the grammar encoding changes,
+# so that stale artifacts are never loaded.
+ARTIFACT_VERSION = 4
+ARTIFACT_MAGIC = b"GADG"
+# magic, version, header length
+_PREAMBLE = struct.Struct("<4sII")
+# environment variable for the default cache directory
+CACHE_DIR_ENV = "GAD_GRAMMAR_CACHE_DIR"
+
+
+class CompiledGrammar:
+    """
+    A grammar compiled into everything the recognizer needs: the flat grammar
+    encoding, the symbol table, the rule offsets and the start rule.
+
+    The encoding and the rule offsets are kept as packed integer arrays so that
+    they can be written to and read from disk without any re-parsing.
+    """
+
+    def __init__(
+        self,
+        grammar_encoding: array,
+        symbol_table: Dict[str, int],
+        rule_offsets: array,
+        start_rule_id: int,
+    ):
+        self.grammar_encoding = grammar_encoding
+        self.symbol_table = symbol_table
+        self.rule_offsets = rule_offsets
+        self.start_rule_id = start_rule_id
+
+    @classmethod
+    def compile(
+        cls,
+        grammar_str: str,
+        start_rule_name: str = "root",
+        optimize: bool = False,
+        compile_dfa: bool = False,
+    ):
+        parsed_grammar = parse_ebnf(grammar_str)
+        start_rule_id = parsed_grammar.symbol_table.get(start_rule_name)
+        if start_rule_id is None:
+            raise ValueError(f"start rule {start_rule_name} is not defined in the grammar")
+        if optimize:
+            parsed_grammar = optimize_grammar(parsed_grammar, start_rule_name)
+        if compile_dfa:
+            parsed_grammar = compile_dfa_grammar(parsed_grammar, start_rule_name)
+        rule_offsets = get_rule_offsets(parsed_grammar.grammar_encoding, start_rule_id)
+        return cls(
+            array("I", parsed_grammar.grammar_encoding),
+            parsed_grammar.symbol_table,
+            array("i", rule_offsets),
+            start_rule_id,
+        )
+
+    def save(self, path: str):
+        """
+        Write the artifact to `path` atomically, a reader never sees a partial file.
+        """
+        header = json.dumps(
+            {
+                "symbol_table": self.symbol_table,
+                "start_rule_id": self.start_rule_id,
+                "byteorder": sys.byteorder,
+                "encoding_length": len(self.grammar_encoding),
+                "rule_offsets_length": len(self.rule_offsets),
+            }
+        ).encode("utf-8")
+        # pad the header so that the arrays start 4-byte aligned
+        header += b" " * (-(_PREAMBLE.size + len(header)) % 4)
+
+        dir_name = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_PREAMBLE.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, len(header)))
+                f.write(header)
+                self.grammar_encoding.tofile(f)
+                self.rule_offsets.tofile(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        buffer = memoryview(data)
+
+        magic, version, header_length = _PREAMBLE.unpack_from(buffer)
+        if magic != ARTIFACT_MAGIC or version != ARTIFACT_VERSION:
+            raise ValueError(f"{path} is not a compiled grammar of version {ARTIFACT_VERSION}")
+        offset = _PREAMBLE.size
+        header = json.loads(bytes(buffer[offset : offset + header_length]))
+        offset += header_length
+
+        grammar_encoding = array("I")
+        end = offset + header["encoding_length"] * grammar_encoding.itemsize
+        grammar_encoding.frombytes(buffer[offset:end])
+        offset = end
+
+        rule_offsets = array("i")
+        end = offset + header["rule_offsets_length"] * rule_offsets.itemsize
+        rule_offsets.frombytes(buffer[offset:end])
+        if end != len(buffer):
+            raise ValueError(f"{path} is truncated or corrupted")
+
+        if header["byteorder"] != sys.byteorder:
+            grammar_encoding.byteswap()
+            rule_offsets.byteswap()
+
+        return cls(
+            grammar_encoding,
+            header["symbol_table"],
+            rule_offsets,
+            header["start_rule_id"],
+        )
+
+
+def grammar_hash(
+    grammar_str: str,
+    start_rule_name: str,
+    optimize: bool = False,
+    compile_dfa: bool = False,
+) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(
+        f"v{ARTIFACT_VERSION}\0{start_rule_name}\0{int(optimize)}\0{int(compile_dfa)}\0".encode(
+            "utf-8"
+        )
+    )
+    hasher.update(grammar_str.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class GrammarCache:
+    """
+    On-disk cache of compiled grammars, keyed by the hash of the grammar text,
+    the start rule name and the compilation options.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(
+        self,
+        grammar_str: str,
+        start_rule_name: str = "root",
+        optimize: bool = False,
+        compile_dfa: bool = False,
+    ) -> str:
+        return os.path.join(
+            self.cache_dir,
+            grammar_hash(grammar_str, start_rule_name, optimize, compile_dfa) + ".gad",
+        )
+
+    def get(
+        self,
+        grammar_str: str,
+        start_rule_name: str = "root",
+        optimize: bool = False,
+        compile_dfa: bool = False,
+    ) -> CompiledGrammar:
+        """
+        Load the compiled grammar from the cache, compiling and storing it on a miss.
+        """
+        path = self.path(grammar_str, start_rule_name, optimize, compile_dfa)
+        if os.path.exists(path):
+            try:
+                return CompiledGrammar.load(path)
+            except (ValueError, OSError, struct.error) as err:
+                logger.warning(f"ignoring unreadable compiled grammar {path}: {err}")
+
+        compiled_grammar = CompiledGrammar.compile(
+            grammar_str, start_rule_name, optimize, compile_dfa
+        )
+        try:
+            compiled_grammar.save(path)
+        except OSError as err:
+            logger.warning(f"could not write compiled grammar {path}: {err}")
+        return compiled_grammar
+
+
+def load_compiled_grammar(
+    grammar_str: str,
+    start_rule_name: str = "root",
+    cache_dir: Optional[str] = None,
+    optimize: bool = False,
+    compile_dfa: bool = False,
+) -> CompiledGrammar:
+    """
+    Compile a grammar, going through the on-disk cache if `cache_dir` is given
+    or if the GAD_GRAMMAR_CACHE_DIR environment variable is set.
+    """
+    if cache_dir is None:
+        cache_dir = os.getenv(CACHE_DIR_ENV)
+    if cache_dir is None:
+        return CompiledGrammar.compile(grammar_str, start_rule_name, optimize, compile_dfa)
+    return GrammarCache(cache_dir).get(grammar_str, start_rule_name, optimize, compile_dfa)
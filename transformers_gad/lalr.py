@@ -0,0 +1,600 @@
+import logging
+from bisect import bisect_right
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from transformers_gad.char_class import BITMAP_SIZE, CharClass
+from transformers_gad.cache import CacheStats
+from transformers_gad.grammar_analysis import GrammarTables, rule_alternatives
+from transformers_gad.lazy_dfa import code_point_boundaries
+from transformers_gad.parser import REF_RULE_MARKER, REPEAT_MARKER, REPEAT_UNBOUNDED
+from transformers_gad.recognizer import AcceptState, get_rule_offsets, step_bytes
+from transformers_gad.stack import EMPTY_STACK, Stack
+from transformers_gad.utf8_automaton import MAX_CODE_POINT, UTF8_START, Utf8Automaton
+
+logger = logging.getLogger(__name__)
+
+# the action of reducing the augmented start production, i.e. ~0
+ACCEPT = -1
+
+# An LR(0) item: the production and the position of the dot in its right-hand side
+Item = Tuple[int, int]
+
+
+class LalrConflictError(ValueError):
+    """
+    The grammar is not LALR(1), the table construction found a state with
+    two actions on the same lookahead.
+    """
+
+
+def _bits(mask: int) -> Iterator[int]:
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class LalrRecognizer:
+    """
+    LALR(1) recognizer with the AcceptState interface of StringRecognizer,
+    for the deterministic grammars: the parse state of a sequence is a single
+    LR stack of automaton states, a hash-consed Stack, instead of a set of
+    pushdown stacks.
+
+    The terminals of the tables are the code point classes of the grammar,
+    see code_point_boundaries, plus an end of input class, so a character
+    class of the grammar is a set of terminals. Every rule alternative is a
+    production, and a repetition x{m,n} is expanded into productions over
+    auxiliary nonterminals: m copies of x followed by a left-recursive x*
+    when unbounded, or by n - m nested optional x otherwise.
+
+    The LR(0) automaton is built first, and its lookaheads are computed by
+    propagation as in the Dragon book. A grammar with a shift/reduce or a
+    reduce/reduce conflict raises LalrConflictError, the caller is expected
+    to fall back to another recognizer. Grammars compiled into DFAs are not
+    supported either.
+
+    An accept state holds the LR stack if it can consume more, and
+    EMPTY_STACK, like the empty stack of StringRecognizer, if the input can
+    stop there.
+    """
+
+    def __init__(
+        self,
+        grammar_encoding: List[int],
+        start_rule_id: int = None,
+        rule_offsets: List[int] = None,
+    ):
+        self.grammar_encoding = grammar_encoding
+        if rule_offsets is not None:
+            self.rule_offsets = rule_offsets
+        else:
+            if start_rule_id is None:
+                raise ValueError("start_rule_id cannot be None if rule_offsets is None")
+            self.rule_offsets = get_rule_offsets(grammar_encoding, start_rule_id)
+        self.start_rule_id = start_rule_id
+        tables = GrammarTables(self.grammar_encoding, self.rule_offsets)
+        if tables.dfa_states:
+            raise ValueError("the LALR recognizer does not support grammars compiled into DFAs")
+
+        self.char_classes = tables.char_classes
+        self.boundaries: List[int] = code_point_boundaries(self.char_classes.values())
+        self.byte_classes: List[int] = [
+            bisect_right(self.boundaries, code_point) for code_point in range(BITMAP_SIZE)
+        ]
+        self.num_classes = len(self.boundaries) + 1
+        # the lookahead at the end of the input
+        self.end_class = self.num_classes
+        # the code points below 256 of every class, as a bitmask
+        self.class_bytes: List[int] = [0] * self.num_classes
+        for code_point in range(min(BITMAP_SIZE, 256)):
+            self.class_bytes[self.byte_classes[code_point]] |= 1 << code_point
+        # the bytes are read over the same classes
+        self.utf8 = Utf8Automaton(self.boundaries)
+
+        self._build_productions()
+        self._build_first()
+        self._build_automaton()
+        self._build_lookaheads()
+        self._build_actions()
+        logger.debug(
+            f"LALR(1) tables: {len(self.productions)} productions, {len(self.kernels)} states, "
+            f"{self.num_classes} code point classes"
+        )
+
+        self._initial_accept_state = None
+
+    ##########################
+    #
+    # Table construction
+    #
+    ##########################
+
+    def _build_productions(self):
+        """
+        The productions, as (lhs, rhs) pairs where a symbol of the rhs is a
+        nonterminal id, or ~k for the terminal with the classes `terminals[k]`.
+        Production 0 is the augmented start production.
+        """
+        self.terminals: List[int] = []
+        self._terminal_ids: Dict[int, int] = {}
+        self._repeat_symbols: Dict[Tuple[int, int, int], int] = {}
+        self.num_nonterminals = len(self.rule_offsets)
+        augmented_start = self._new_nonterminal()
+        self.productions: List[Tuple[int, Tuple[int, ...]]] = [
+            (augmented_start, (self.start_rule_id,))
+        ]
+        for rule_id, rule_offset in enumerate(self.rule_offsets):
+            if rule_offset < 0:
+                continue
+            for elements in rule_alternatives(self.grammar_encoding, rule_offset):
+                rhs = tuple(self._element_symbol(element_offset) for element_offset in elements)
+                self.productions.append((rule_id, rhs))
+
+        self.productions_of: Dict[int, List[int]] = {}
+        for production, (lhs, _) in enumerate(self.productions):
+            self.productions_of.setdefault(lhs, []).append(production)
+
+    def _new_nonterminal(self) -> int:
+        self.num_nonterminals += 1
+        return self.num_nonterminals - 1
+
+    def _element_symbol(self, element_offset: int) -> int:
+        marker = self.grammar_encoding[element_offset]
+        if marker == REF_RULE_MARKER:
+            return self.grammar_encoding[element_offset + 1]
+        if marker == REPEAT_MARKER:
+            return self._repeat_symbol(*self.grammar_encoding[element_offset + 1 : element_offset + 4])
+        classes = 0
+        for start, end in self.char_classes[element_offset].ranges():
+            for code_point_class in range(
+                bisect_right(self.boundaries, start), bisect_right(self.boundaries, end) + 1
+            ):
+                classes |= 1 << code_point_class
+        terminal = self._terminal_ids.get(classes)
+        if terminal is None:
+            terminal = self._terminal_ids[classes] = len(self.terminals)
+            self.terminals.append(classes)
+        return ~terminal
+
+    def _repeat_symbol(self, rule_id: int, min_count: int, max_count: int) -> int:
+        key = (rule_id, min_count, max_count)
+        symbol = self._repeat_symbols.get(key)
+        if symbol is not None:
+            return symbol
+        symbol = self._repeat_symbols[key] = self._new_nonterminal()
+        if max_count == REPEAT_UNBOUNDED:
+            # rest ::= rest x | ""
+            rest = self._new_nonterminal()
+            self.productions.append((rest, (rest, rule_id)))
+            self.productions.append((rest, ()))
+            self.productions.append((symbol, (rule_id,) * min_count + (rest,)))
+            return symbol
+        # rest_k ::= x rest_(k-1) | "", for the n - m optional iterations
+        rest = None
+        for _ in range(max_count - min_count):
+            optional = self._new_nonterminal()
+            self.productions.append((optional, (rule_id,) if rest is None else (rule_id, rest)))
+            self.productions.append((optional, ()))
+            rest = optional
+        self.productions.append(
+            (symbol, (rule_id,) * min_count + (() if rest is None else (rest,)))
+        )
+        return symbol
+
+    def _build_first(self):
+        """
+        The nullable flag and the FIRST classes of every nonterminal, and of
+        every suffix of every production in `suffix_first`.
+        """
+        self.nullable = [False] * self.num_nonterminals
+        self.first = [0] * self.num_nonterminals
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs in self.productions:
+                first, nullable = self._sequence_first(rhs)
+                if (first | self.first[lhs]) != self.first[lhs]:
+                    self.first[lhs] |= first
+                    changed = True
+                if nullable and not self.nullable[lhs]:
+                    self.nullable[lhs] = True
+                    changed = True
+        self.suffix_first: List[List[Tuple[int, bool]]] = [
+            [self._sequence_first(rhs[dot:]) for dot in range(len(rhs) + 1)]
+            for _, rhs in self.productions
+        ]
+
+    def _sequence_first(self, symbols) -> Tuple[int, bool]:
+        first = 0
+        for symbol in symbols:
+            if symbol < 0:
+                return first | self.terminals[~symbol], False
+            first |= self.first[symbol]
+            if not self.nullable[symbol]:
+                return first, False
+        return first, True
+
+    def _closure(self, kernel) -> List[Item]:
+        items = list(kernel)
+        seen = set(items)
+        for production, dot in items:
+            rhs = self.productions[production][1]
+            if dot < len(rhs) and rhs[dot] >= 0:
+                for predicted in self.productions_of.get(rhs[dot], ()):
+                    if (predicted, 0) not in seen:
+                        seen.add((predicted, 0))
+                        items.append((predicted, 0))
+        return items
+
+    def _build_automaton(self):
+        """
+        The LR(0) automaton: the kernel of every state, the nonterminal
+        transitions in `gotos`, and the terminal transitions in
+        `class_gotos` as (classes, target) pairs with disjoint classes.
+        """
+        self.kernels: List[Tuple[Item, ...]] = [((0, 0),)]
+        state_ids: Dict[Tuple[Item, ...], int] = {self.kernels[0]: 0}
+        self.gotos: List[Dict[int, int]] = []
+        self.class_gotos: List[List[Tuple[int, int]]] = []
+
+        def state_id(kernel) -> int:
+            kernel = tuple(sorted(kernel))
+            if kernel not in state_ids:
+                state_ids[kernel] = len(self.kernels)
+                self.kernels.append(kernel)
+            return state_ids[kernel]
+
+        state = 0
+        while state < len(self.kernels):
+            nonterminal_kernels: Dict[int, List[Item]] = {}
+            terminal_items: List[Tuple[Item, int]] = []
+            for production, dot in self._closure(self.kernels[state]):
+                rhs = self.productions[production][1]
+                if dot == len(rhs):
+                    continue
+                if rhs[dot] >= 0:
+                    nonterminal_kernels.setdefault(rhs[dot], []).append((production, dot + 1))
+                else:
+                    terminal_items.append(((production, dot + 1), self.terminals[~rhs[dot]]))
+
+            self.gotos.append(
+                {symbol: state_id(kernel) for symbol, kernel in nonterminal_kernels.items()}
+            )
+            # the classes that lead to the same kernel share a transition
+            kernel_classes: Dict[Tuple[Item, ...], int] = {}
+            all_classes = 0
+            for _, classes in terminal_items:
+                all_classes |= classes
+            for code_point_class in _bits(all_classes):
+                kernel = tuple(item for item, classes in terminal_items if classes >> code_point_class & 1)
+                kernel_classes[kernel] = kernel_classes.get(kernel, 0) | 1 << code_point_class
+            self.class_gotos.append(
+                [(classes, state_id(kernel)) for kernel, classes in kernel_classes.items()]
+            )
+            state += 1
+
+    def _closure_lookaheads(self, lookaheads: Dict[Item, int]) -> Dict[Item, int]:
+        """
+        LR(1) closure of items with their lookahead classes.
+        """
+        lookaheads = dict(lookaheads)
+        agenda = list(lookaheads)
+        while agenda:
+            item = agenda.pop()
+            production, dot = item
+            rhs = self.productions[production][1]
+            if dot == len(rhs) or rhs[dot] < 0:
+                continue
+            first, nullable = self.suffix_first[production][dot + 1]
+            if nullable:
+                first |= lookaheads[item]
+            for predicted in self.productions_of.get(rhs[dot], ()):
+                old = lookaheads.get((predicted, 0), 0)
+                if first & ~old:
+                    lookaheads[(predicted, 0)] = old | first
+                    agenda.append((predicted, 0))
+        return lookaheads
+
+    def _targets(self, state: int, symbol: int) -> List[int]:
+        if symbol >= 0:
+            return [self.gotos[state][symbol]]
+        classes = self.terminals[~symbol]
+        return [target for target_classes, target in self.class_gotos[state] if target_classes & classes]
+
+    def _build_lookaheads(self):
+        """
+        The lookahead classes of the kernel items, by propagation: a dummy
+        lookahead marks the lookaheads that propagate from a kernel item to
+        the items it advances to, the other ones are spontaneous.
+        """
+        dummy = 1 << (self.end_class + 1)
+        self.kernel_lookaheads: List[Dict[Item, int]] = [
+            {item: 0 for item in kernel} for kernel in self.kernels
+        ]
+        self.kernel_lookaheads[0][(0, 0)] = 1 << self.end_class
+        propagation: Dict[Tuple[int, Item], List[Tuple[int, Item]]] = {}
+        for state, kernel in enumerate(self.kernels):
+            for kernel_item in kernel:
+                closure = self._closure_lookaheads({kernel_item: dummy})
+                for (production, dot), lookaheads in closure.items():
+                    rhs = self.productions[production][1]
+                    if dot == len(rhs):
+                        continue
+                    for target in self._targets(state, rhs[dot]):
+                        advanced = (production, dot + 1)
+                        self.kernel_lookaheads[target][advanced] |= lookaheads & ~dummy
+                        if lookaheads & dummy:
+                            propagation.setdefault((state, kernel_item), []).append(
+                                (target, advanced)
+                            )
+
+        changed = True
+        while changed:
+            changed = False
+            for (state, kernel_item), targets in propagation.items():
+                lookaheads = self.kernel_lookaheads[state][kernel_item]
+                for target, advanced in targets:
+                    old = self.kernel_lookaheads[target][advanced]
+                    if lookaheads & ~old:
+                        self.kernel_lookaheads[target][advanced] = old | lookaheads
+                        changed = True
+
+    def _build_actions(self):
+        """
+        The action of every state on every class: a target state for a shift,
+        ~production for a reduction, ACCEPT at the end of a complete input.
+        """
+        self.reductions: List[Tuple[int, int]] = [
+            (lhs, len(rhs)) for lhs, rhs in self.productions
+        ]
+        self.actions: List[Dict[int, int]] = []
+        for state in range(len(self.kernels)):
+            actions: Dict[int, int] = {}
+            for classes, target in self.class_gotos[state]:
+                for code_point_class in _bits(classes):
+                    actions[code_point_class] = target
+            closure = self._closure_lookaheads(self.kernel_lookaheads[state])
+            for (production, dot), lookaheads in closure.items():
+                if dot != len(self.productions[production][1]):
+                    continue
+                for code_point_class in _bits(lookaheads):
+                    if code_point_class in actions:
+                        raise LalrConflictError(
+                            f"{self._conflict_kind(actions[code_point_class])}/reduce conflict "
+                            f"in state {state} on {self._describe_class(code_point_class)}"
+                        )
+                    actions[code_point_class] = ~production
+            self.actions.append(actions)
+
+        # the classes with an action, except the end of input
+        self.action_classes: List[List[int]] = [
+            [code_point_class for code_point_class in actions if code_point_class != self.end_class]
+            for actions in self.actions
+        ]
+        self.state_first_bytes: List[int] = []
+        for code_point_classes in self.action_classes:
+            first_bytes = 0
+            for code_point_class in code_point_classes:
+                first_bytes |= self.class_bytes[code_point_class]
+            self.state_first_bytes.append(first_bytes)
+
+    @staticmethod
+    def _conflict_kind(action: int) -> str:
+        return "shift" if action >= 0 else "reduce"
+
+    def _describe_class(self, code_point_class: int) -> str:
+        if code_point_class == self.end_class:
+            return "the end of the input"
+        start = self.boundaries[code_point_class - 1] if code_point_class > 0 else 0
+        return f"{chr(start)!r}"
+
+    ##########################
+    #
+    # LR stacks
+    #
+    ##########################
+
+    def _code_point_class(self, code_point: int) -> int:
+        if code_point < BITMAP_SIZE:
+            return self.byte_classes[code_point]
+        return bisect_right(self.boundaries, code_point)
+
+    def _step_class(self, stack: Stack, code_point_class: int) -> Optional[Stack]:
+        """
+        The LR stack after the reductions and the shift of a class, None if
+        the class is rejected. At the end of the input, the stack is returned
+        as it is once the input is accepted.
+        """
+        actions = self.actions
+        # the stack is `stack` with the states of `tops` on top, the states
+        # pushed by the reductions are only interned once the class is shifted
+        tops = []
+        state = stack.top
+        while True:
+            action = actions[state].get(code_point_class)
+            if action is None:
+                return None
+            if action >= 0:
+                return stack.push_all(tops).push(action)
+            if action == ACCEPT:
+                return stack.push_all(tops)
+            lhs, length = self.reductions[~action]
+            if length <= len(tops):
+                del tops[len(tops) - length :]
+            else:
+                for _ in range(length - len(tops)):
+                    stack = stack.rest
+                tops.clear()
+            state = self.gotos[tops[-1] if tops else stack.top][lhs]
+            tops.append(state)
+
+    def _can_continue(self, stack: Stack) -> bool:
+        return any(
+            self._step_class(stack, code_point_class) is not None
+            for code_point_class in self.action_classes[stack.top]
+        )
+
+    def _can_finish(self, stack: Stack) -> bool:
+        return self._step_class(stack, self.end_class) is not None
+
+    def _live(self, stack: Optional[Stack]) -> Tuple[Stack, ...]:
+        """
+        The stacks of an accept state for an LR stack: the stack if it can
+        shift more, and EMPTY_STACK if the input can stop here, which stays
+        as it is, nothing if the input is rejected.
+        """
+        if stack is None:
+            return ()
+        if stack is EMPTY_STACK:
+            return (EMPTY_STACK,)
+        stacks = (stack,) if self._can_continue(stack) else ()
+        if self._can_finish(stack):
+            stacks += (EMPTY_STACK,)
+        return stacks
+
+    def _keep_partial(self, stacks, utf8_state: int) -> List[Stack]:
+        """
+        The LR stacks that shift a class of a character starting with the
+        pending bytes of `utf8_state`, the empty stack shifts nothing.
+        """
+        reachable = self.utf8.reachable[utf8_state]
+        return [
+            stack
+            for stack in stacks
+            if stack is not EMPTY_STACK
+            and any(
+                (reachable >> code_point_class) & 1
+                and self._step_class(stack, code_point_class) is not None
+                for code_point_class in self.action_classes[stack.top]
+            )
+        ]
+
+    ##########################
+    #
+    # AcceptState interface
+    #
+    ##########################
+
+    def get_initial_accept_state(self) -> AcceptState:
+        if self._initial_accept_state is None:
+            initial_stack = EMPTY_STACK.push(0)
+            self._initial_accept_state = AcceptState(self._live(initial_stack), UTF8_START)
+        return self._initial_accept_state
+
+    def get_termination_accept_state(self) -> AcceptState:
+        return AcceptState((), UTF8_START)
+
+    def cache_stats(self) -> List[CacheStats]:
+        return []
+
+    def close(self):
+        """
+        Nothing is cached, the LR stacks are released with the accept states.
+        """
+
+    def _step_stacks(self, code_point: int, stacks) -> List[Stack]:
+        code_point_class = self._code_point_class(code_point)
+        new_stacks = []
+        for stack in stacks:
+            if stack is EMPTY_STACK:
+                continue
+            new_stack = self._step_class(stack, code_point_class)
+            if new_stack is not None:
+                new_stacks.append(new_stack)
+        return new_stacks
+
+    def _first_bytes(self, stacks) -> int:
+        first_bytes = 0
+        for stack in stacks:
+            if stack is not EMPTY_STACK:
+                first_bytes |= self.state_first_bytes[stack.top]
+        return first_bytes
+
+    def _consume_code_points(self, code_points: List[int], stacks, verbose=False):
+        for code_point in code_points:
+            if not stacks:
+                break
+            stacks = self._step_stacks(code_point, stacks)
+        return list(stacks)
+
+    def _consume_string(self, string: str, accept_state: AcceptState):
+        code_points = [ord(char) for char in string]
+        new_stacks = []
+        for stack in self._consume_code_points(code_points, accept_state.stacks):
+            new_stacks.extend(self._live(stack))
+        return AcceptState(tuple(new_stacks), UTF8_START)
+
+    def _probe_bytes(self, byte_seq: bytes, stacks, utf8_state: int = UTF8_START, verbose=True):
+        new_stacks, _ = step_bytes(self, byte_seq, stacks, utf8_state)
+        return bool(new_stacks)
+
+    def _consume_bytes(
+        self,
+        byte_seq: bytes,
+        accept_state: AcceptState = None,
+        verbose=True,
+    ):
+        if accept_state is None:
+            accept_state = self.get_initial_accept_state()
+        accept_state = self._feed_bytes(byte_seq, accept_state)
+        utf8_state = accept_state.utf8_state
+        if verbose:
+            logger.debug(f"stacks: {accept_state.stacks}; utf8_state: {utf8_state}")
+        # as in the stack recognizer, an input that can only finish is dropped
+        new_stacks = [
+            stack
+            for stack in accept_state.stacks
+            if stack is not EMPTY_STACK
+            and (utf8_state != UTF8_START or self._can_continue(stack))
+        ]
+        return AcceptState(tuple(new_stacks), utf8_state)
+
+    def _feed_bytes(self, byte_seq: bytes, accept_state: AcceptState) -> AcceptState:
+        """
+        Consume raw bytes, keeping the LR stacks that can only finish.
+        """
+        new_stacks, utf8_state = step_bytes(
+            self, byte_seq, accept_state.stacks, accept_state.utf8_state
+        )
+        return AcceptState(tuple(new_stacks), utf8_state)
+
+    def _next_code_points(self, stacks) -> CharClass:
+        """
+        The code points of the classes that at least one of the LR stacks shifts.
+        """
+        ranges = []
+        for stack in stacks:
+            if stack is EMPTY_STACK:
+                continue
+            for code_point_class in self.action_classes[stack.top]:
+                if code_point_class == self.end_class:
+                    continue
+                if self._step_class(stack, code_point_class) is not None:
+                    start = self.boundaries[code_point_class - 1] if code_point_class > 0 else 0
+                    end = (
+                        self.boundaries[code_point_class] - 1
+                        if code_point_class < len(self.boundaries)
+                        else MAX_CODE_POINT
+                    )
+                    ranges.append((start, end))
+        return CharClass(ranges)
+
+    def _accept_prefix(self, string: str, accept_state: AcceptState = None):
+        if accept_state is None:
+            accept_state = self.get_initial_accept_state()
+        return len(self._consume_string(string, accept_state).stacks) > 0
+
+    def _accept_string(self, string: str, accept_state: AcceptState = None):
+        if accept_state is None:
+            accept_state = self.get_initial_accept_state()
+        new_accept_state = self._consume_string(string, accept_state)
+        return EMPTY_STACK in new_accept_state.stacks
+
+    def _can_stop(self, stacks):
+        if len(stacks) == 0:
+            return True
+        return any(stack is EMPTY_STACK or self._can_finish(stack) for stack in stacks)
+
+    def _must_stop(self, stacks):
+        return not any(stack is not EMPTY_STACK and self._can_continue(stack) for stack in stacks)
@@ -0,0 +1,177 @@
+import logging
+import sys
+from bisect import bisect_right
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from transformers_gad.cache import CacheBudget, CacheStats, cache_budget
+from transformers_gad.char_class import BITMAP_SIZE, CharClass
+
+logger = logging.getLogger(__name__)
+
+# estimated size of a transition: its key and its slot in the table, the
+# target states are interned and not owned by the table
+TRANSITION_SIZE = sys.getsizeof((0, 0)) + 3 * 8
+
+
+def code_point_boundaries(char_classes: Iterable[CharClass]) -> List[int]:
+    """
+    The sorted code points where some CharClass starts or stops, the class of
+    a code point is `bisect_right(boundaries, code_point)`: two code points
+    are in the same class iff every CharClass contains both or none of them.
+    """
+    # code point 0 is never accepted, it gets a class of its own
+    boundaries = {1}
+    for char_class in char_classes:
+        for start, end in char_class.ranges():
+            boundaries.add(start)
+            boundaries.add(end + 1)
+    return sorted(boundaries)
+
+
+class LazyDfa:
+    """
+    Character-level DFA over the interned parse states of a recognizer, see
+    ParseStateTable, built lazily: the transition from a state on a code
+    point is computed by `step` on first use and then looked up in a table
+    keyed by (state id, code point class).
+
+    Two code points are in the same class iff every CharClass of the grammar
+    either contains both or none of them, so they lead to the same state and
+    share a single transition. The class of a code point below BITMAP_SIZE is
+    read from a list, the others are found by binary search.
+
+    The table is the "lazy_dfa" cache of the recognizer, see
+    DEFAULT_CACHE_BUDGETS: once it holds as many transitions as its budget
+    allows, it is flushed and refilled on demand, as lazy DFA regex engines
+    do, so that a hit is a single dict lookup with no LRU bookkeeping; the
+    flushed transitions are counted as evictions. The table holds the target
+    states alive.
+    """
+
+    def __init__(
+        self,
+        char_classes: Iterable[CharClass],
+        step: Callable,
+        budget: CacheBudget = None,
+    ):
+        self.boundaries: List[int] = code_point_boundaries(char_classes)
+        self.byte_classes: List[int] = [
+            bisect_right(self.boundaries, code_point) for code_point in range(BITMAP_SIZE)
+        ]
+        self.step = step
+        budget = budget if budget is not None else cache_budget("lazy_dfa")
+        for limit in (budget.max_entries, budget.max_bytes):
+            if limit is not None and limit < 0:
+                raise ValueError(f"The budget of the lazy_dfa cache cannot be negative: {budget}")
+        self.budget = budget
+        self.max_transitions = budget.max_entries if budget.max_entries is not None else sys.maxsize
+        if budget.max_bytes is not None:
+            self.max_transitions = min(self.max_transitions, budget.max_bytes // TRANSITION_SIZE)
+        self.transitions: Dict[Tuple[int, int], object] = {}
+        # the hits are the lookups that are not misses
+        self.lookups = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.closed = False
+
+    def code_point_class(self, code_point: int) -> int:
+        if code_point < BITMAP_SIZE:
+            return self.byte_classes[code_point]
+        return bisect_right(self.boundaries, code_point)
+
+    @property
+    def num_classes(self) -> int:
+        return len(self.boundaries) + 1
+
+    def next_state(self, accept_state, code_point: int):
+        return self.next_class_state(accept_state, self.code_point_class(code_point))
+
+    def next_class_state(self, accept_state, code_point_class: int):
+        """
+        The state reached on any code point of the class, e.g. the class of
+        a character read by a Utf8Automaton built over the same boundaries.
+        """
+        self.lookups += 1
+        next_state = self.transitions.get((accept_state.state_id, code_point_class))
+        if next_state is None:
+            next_state = self._add_transition(accept_state, code_point_class)
+        return next_state
+
+    def representative(self, code_point_class: int) -> int:
+        """
+        The smallest code point of the class.
+        """
+        return self.boundaries[code_point_class - 1] if code_point_class > 0 else 0
+
+    def run(self, accept_state, code_points: Iterable[int]):
+        """
+        The state reached from `accept_state` on `code_points`, it stops early
+        at a state with no stacks left.
+        """
+        transitions = self.transitions
+        byte_classes = self.byte_classes
+        lookups = 0
+        for code_point in code_points:
+            lookups += 1
+            if code_point < BITMAP_SIZE:
+                code_point_class = byte_classes[code_point]
+            else:
+                code_point_class = bisect_right(self.boundaries, code_point)
+            next_state = transitions.get((accept_state.state_id, code_point_class))
+            if next_state is None:
+                next_state = self._add_transition(accept_state, code_point_class)
+                # the table may have been flushed
+                transitions = self.transitions
+            accept_state = next_state
+            if not accept_state.stacks:
+                break
+        self.lookups += lookups
+        return accept_state
+
+    def _add_transition(self, accept_state, code_point_class: int):
+        self.misses += 1
+        next_state = self.step(accept_state, self.representative(code_point_class))
+        if self.closed or self.max_transitions == 0:
+            return next_state
+        if len(self.transitions) >= self.max_transitions:
+            logger.debug(f"flushing the {len(self.transitions)} transitions of the lazy DFA")
+            self.evictions += len(self.transitions)
+            self.transitions = {}
+            self.flushes += 1
+        self.transitions[(accept_state.state_id, code_point_class)] = next_state
+        return next_state
+
+    def clear(self):
+        """
+        Drop the transitions, the counters are kept.
+        """
+        self.transitions = {}
+
+    def close(self):
+        """
+        Release the transitions, the table stores nothing from then on.
+        """
+        self.clear()
+        self.closed = True
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            name="lazy_dfa",
+            hits=self.lookups - self.misses,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self.transitions),
+            bytes=len(self.transitions) * TRANSITION_SIZE,
+            max_entries=self.budget.max_entries,
+            max_bytes=self.budget.max_bytes,
+        )
+
+    def __len__(self) -> int:
+        return len(self.transitions)
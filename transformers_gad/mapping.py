@@ -62,6 +62,19 @@ class Mapping:
             log.debug(f"token_id: {token_id}, token: {token}")
         return bytes(token, "utf-8")
 
+    def context(self):
+        """
+        What `map` depends on besides the token id, None if nothing: the bytes
+        of a token are cached under its context too.
+        """
+        return None
+
+    def skip(self, token_id: int):
+        """
+        Record the token as mapped when its bytes come from a cache, so that
+        the context of the next token is the same as if it had been mapped.
+        """
+
 
 class BBPEMapping(Mapping):
     def __init__(self, *args, **kwargs):
@@ -122,6 +135,15 @@ class BPEMapping(Mapping):
                 raw_token = raw_token[1:]
         return raw_token
 
+    def context(self):
+        # whether the next token is at the beginning of the sentence
+        return self.last_token_id is not None and self.last_token_id == self.bos_token_id
+
+    def skip(self, token_id: int):
+        if hasattr(token_id, "item"):
+            token_id = token_id.item()
+        self.last_token_id = token_id
+
 
 class LlamaBPEMapping(BPEMapping):
     def __init__(self, tokenizer):
@@ -0,0 +1,418 @@
+import logging
+from collections import Counter
+from typing import Dict, List, Set, Tuple
+
+from transformers_gad.parser import (
+    DFA_REF_MARKER,
+    END_OF_ALTERNATE_MARKER,
+    END_OF_GRAMMAR_MARKER,
+    END_OF_RULE_MARKER,
+    REF_RULE_MARKER,
+    REPEAT_MARKER,
+    ParseState,
+)
+
+logger = logging.getLogger(__name__)
+
+# An element is a tuple of ints in the same layout as in the grammar encoding,
+# i.e. (REF_RULE_MARKER, rule_id), (REPEAT_MARKER, rule_id, min, max) or
+# (size, start_1, end_1, ..., start_n, end_n).
+Element = Tuple[int, ...]
+Alternative = Tuple[Element, ...]
+Rules = Dict[int, List[Alternative]]
+
+# Placeholder for a self reference when comparing rules structurally
+SELF_REF = (REF_RULE_MARKER, -1)
+# Inlining is only done for rules used once or with bodies up to this many elements
+MAX_INLINE_SIZE = 1
+MAX_ITERATIONS = 100
+
+
+########################
+# Grammar IR           #
+########################
+
+
+def is_ref(element: Element) -> bool:
+    return element[0] == REF_RULE_MARKER
+
+
+def is_repeat(element: Element) -> bool:
+    return element[0] == REPEAT_MARKER
+
+
+def decode_rules(grammar_encoding: List[int]) -> Rules:
+    """
+    Decode the flat grammar encoding into a dict from rule id to the list of
+    alternatives of the rule, in the order of the encoding.
+    """
+    rules: Rules = {}
+    pos = 0
+    while grammar_encoding[pos] != END_OF_GRAMMAR_MARKER:
+        rule_id = grammar_encoding[pos]
+        pos += 1
+        alternatives = []
+        while grammar_encoding[pos] != END_OF_RULE_MARKER:
+            end_of_alternate = pos + grammar_encoding[pos]
+            pos += 1
+            elements = []
+            while pos < end_of_alternate:
+                if grammar_encoding[pos] in (REF_RULE_MARKER, DFA_REF_MARKER):
+                    size = 2
+                elif grammar_encoding[pos] == REPEAT_MARKER:
+                    size = 4
+                else:
+                    size = grammar_encoding[pos] + 1
+                elements.append(tuple(grammar_encoding[pos : pos + size]))
+                pos += size
+            alternatives.append(tuple(elements))
+            # skip END_OF_ALTERNATE_MARKER
+            pos += 1
+        rules[rule_id] = alternatives
+        # skip END_OF_RULE_MARKER
+        pos += 1
+    return rules
+
+
+def encode_rules(rules: Rules) -> List[int]:
+    grammar_encoding = []
+    for rule_id, alternatives in rules.items():
+        grammar_encoding.append(rule_id)
+        for alternative in alternatives:
+            size_offset = len(grammar_encoding)
+            grammar_encoding.append(0)
+            for element in alternative:
+                grammar_encoding.extend(element)
+            grammar_encoding[size_offset] = len(grammar_encoding) - size_offset
+            grammar_encoding.append(END_OF_ALTERNATE_MARKER)
+        grammar_encoding.append(END_OF_RULE_MARKER)
+    grammar_encoding.append(END_OF_GRAMMAR_MARKER)
+    return grammar_encoding
+
+
+def referenced_rules(alternative: Alternative) -> List[int]:
+    return [element[1] for element in alternative if is_ref(element) or is_repeat(element)]
+
+
+def repeated_rules(rules: Rules) -> Set[int]:
+    return {
+        element[1]
+        for alternatives in rules.values()
+        for alternative in alternatives
+        for element in alternative
+        if is_repeat(element)
+    }
+
+
+def reachable_rules(rules: Rules, start_rule_id: int) -> Set[int]:
+    reachable = {start_rule_id}
+    worklist = [start_rule_id]
+    while worklist:
+        rule_id = worklist.pop()
+        for alternative in rules.get(rule_id, []):
+            for ref_rule_id in referenced_rules(alternative):
+                if ref_rule_id not in reachable:
+                    reachable.add(ref_rule_id)
+                    worklist.append(ref_rule_id)
+    return reachable
+
+
+def reference_counts(rules: Rules) -> Counter:
+    counts = Counter()
+    for alternatives in rules.values():
+        for alternative in alternatives:
+            counts.update(referenced_rules(alternative))
+    return counts
+
+
+def _replace_refs(rules: Rules, mapping: Dict[int, int]) -> Rules:
+    return {
+        rule_id: [
+            tuple(
+                (element[0], mapping.get(element[1], element[1])) + element[2:]
+                if is_ref(element) or is_repeat(element)
+                else element
+                for element in alternative
+            )
+            for alternative in alternatives
+        ]
+        for rule_id, alternatives in rules.items()
+    }
+
+
+def _dedupe_alternatives(alternatives: List[Alternative]) -> List[Alternative]:
+    return list(dict.fromkeys(alternatives))
+
+
+########################
+# Optimization passes  #
+########################
+
+
+def merge_char_ranges(rules: Rules) -> Rules:
+    """
+    Sort the ranges of every char class and merge the overlapping or adjacent ones.
+    """
+
+    def merge(element: Element) -> Element:
+        if is_ref(element) or is_repeat(element):
+            return element
+        ranges = sorted(zip(element[1::2], element[2::2]))
+        merged = [list(ranges[0])]
+        for start, end in ranges[1:]:
+            if start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return (2 * len(merged),) + tuple(bound for pair in merged for bound in pair)
+
+    return {
+        rule_id: _dedupe_alternatives(
+            [tuple(merge(element) for element in alternative) for alternative in alternatives]
+        )
+        for rule_id, alternatives in rules.items()
+    }
+
+
+def remove_unproductive_rules(rules: Rules) -> Rules:
+    """
+    Remove the alternatives that reference rules deriving no finite string,
+    e.g. `a ::= "x" a`, or rules that are referenced but never defined. A
+    repetition with a min count of 0 does not need its rule to be productive.
+    """
+
+    def required_rules(alternative: Alternative) -> List[int]:
+        return [
+            element[1]
+            for element in alternative
+            if is_ref(element) or (is_repeat(element) and element[2] > 0)
+        ]
+
+    productive: Set[int] = set()
+    changed = True
+    while changed:
+        changed = False
+        for rule_id, alternatives in rules.items():
+            if rule_id in productive:
+                continue
+            if any(
+                all(ref in productive for ref in required_rules(alternative))
+                for alternative in alternatives
+            ):
+                productive.add(rule_id)
+                changed = True
+
+    return {
+        rule_id: [
+            alternative
+            for alternative in alternatives
+            if all(ref in productive for ref in required_rules(alternative))
+        ]
+        for rule_id, alternatives in rules.items()
+    }
+
+
+def inline_trivial_rules(rules: Rules, start_rule_id: int) -> Rules:
+    """
+    Inline the non-recursive rules with a single alternative, when they are
+    referenced once or their body is at most MAX_INLINE_SIZE elements long.
+    Alternatives made of a single reference to a rule used only there are
+    replaced with the alternatives of that rule. The rules of repetitions are
+    never inlined.
+    """
+    rules = dict(rules)
+    for _ in range(MAX_ITERATIONS):
+        counts = reference_counts(rules)
+        repeated = repeated_rules(rules)
+        target = None
+        for rule_id, alternatives in rules.items():
+            if rule_id == start_rule_id or counts[rule_id] == 0 or rule_id in repeated:
+                continue
+            if len(alternatives) == 1:
+                body = alternatives[0]
+                if rule_id in referenced_rules(body):
+                    continue
+                if counts[rule_id] == 1 or len(body) <= MAX_INLINE_SIZE:
+                    target = rule_id
+                    break
+        if target is not None:
+            body = rules.pop(target)[0]
+            rules = {
+                rule_id: [
+                    tuple(
+                        inlined
+                        for element in alternative
+                        for inlined in (
+                            body if element == (REF_RULE_MARKER, target) else (element,)
+                        )
+                    )
+                    for alternative in alternatives
+                ]
+                for rule_id, alternatives in rules.items()
+            }
+            continue
+
+        # splice rules used only as a whole alternative of another rule
+        spliced = False
+        for rule_id, alternatives in rules.items():
+            for i, alternative in enumerate(alternatives):
+                if len(alternative) != 1 or not is_ref(alternative[0]):
+                    continue
+                ref_rule_id = alternative[0][1]
+                if (
+                    ref_rule_id == rule_id
+                    or ref_rule_id == start_rule_id
+                    or counts[ref_rule_id] != 1
+                    or ref_rule_id not in rules
+                ):
+                    continue
+                rules[rule_id] = _dedupe_alternatives(
+                    alternatives[:i] + rules.pop(ref_rule_id) + alternatives[i + 1 :]
+                )
+                spliced = True
+                break
+            if spliced:
+                break
+        if not spliced:
+            break
+    return rules
+
+
+def dedupe_rules(rules: Rules, start_rule_id: int) -> Rules:
+    """
+    Merge rules with structurally identical alternatives, e.g. the rules
+    generated for two occurrences of `[0-9]+`, into a single rule.
+    """
+    for _ in range(MAX_ITERATIONS):
+        canonical: Dict[tuple, int] = {}
+        mapping: Dict[int, int] = {}
+        # visit the start rule first so that it is never merged away
+        order = sorted(rules, key=lambda rule_id: rule_id != start_rule_id)
+        for rule_id in order:
+            key = tuple(
+                tuple(
+                    SELF_REF if element == (REF_RULE_MARKER, rule_id) else element
+                    for element in alternative
+                )
+                for alternative in sorted(set(rules[rule_id]))
+            )
+            if key in canonical:
+                mapping[rule_id] = canonical[key]
+            else:
+                canonical[key] = rule_id
+        if not mapping:
+            break
+        rules = _replace_refs(
+            {rule_id: alts for rule_id, alts in rules.items() if rule_id not in mapping},
+            mapping,
+        )
+        rules = {
+            rule_id: _dedupe_alternatives(alternatives)
+            for rule_id, alternatives in rules.items()
+        }
+    return rules
+
+
+def _common_prefix_length(alternatives: List[Alternative]) -> int:
+    length = 0
+    for elements in zip(*alternatives):
+        if any(element != elements[0] for element in elements[1:]):
+            break
+        length += 1
+    return length
+
+
+def left_factor_rules(rules: Rules, symbol_table: Dict[str, int]) -> Rules:
+    """
+    Factor the common prefixes out of the alternatives of every rule:
+        a ::= x y b | x y c | d  -->  a ::= x y a_N | d,  a_N ::= b | c
+    so that the recognizer consumes a shared prefix with one stack instead of
+    one stack per alternative. The rules created for the suffixes are added to
+    `symbol_table`, named after the factored rule as for generated rules.
+    """
+    rules = dict(rules)
+    rule_names = {rule_id: name for name, rule_id in symbol_table.items()}
+    worklist = list(rules)
+    while worklist:
+        rule_id = worklist.pop()
+        groups: Dict[Element, List[Alternative]] = {}
+        for alternative in rules[rule_id]:
+            key = alternative[0] if alternative else None
+            groups.setdefault(key, []).append(alternative)
+        if all(key is None or len(group) == 1 for key, group in groups.items()):
+            continue
+
+        factored_alternatives = []
+        for key, group in groups.items():
+            if key is None or len(group) == 1:
+                factored_alternatives.extend(group)
+                continue
+            prefix_length = _common_prefix_length(group)
+            suffix_rule_id = len(symbol_table)
+            suffix_rule_name = f"{rule_names[rule_id]}_{suffix_rule_id}"
+            symbol_table[suffix_rule_name] = suffix_rule_id
+            rule_names[suffix_rule_id] = suffix_rule_name
+            rules[suffix_rule_id] = [alternative[prefix_length:] for alternative in group]
+            factored_alternatives.append(
+                group[0][:prefix_length] + ((REF_RULE_MARKER, suffix_rule_id),)
+            )
+            worklist.append(suffix_rule_id)
+        rules[rule_id] = factored_alternatives
+    return rules
+
+
+def remove_unreachable_rules(rules: Rules, start_rule_id: int) -> Rules:
+    reachable = reachable_rules(rules, start_rule_id)
+    return {rule_id: alts for rule_id, alts in rules.items() if rule_id in reachable}
+
+
+def optimize_rules(
+    rules: Rules, start_rule_id: int, symbol_table: Dict[str, int] = None
+) -> Rules:
+    """
+    Run the optimization passes until the rules do not change anymore. When
+    `symbol_table` is given, the alternatives are also left-factored and the
+    rules created by the factoring are added to it.
+    """
+    for _ in range(MAX_ITERATIONS):
+        previous = rules
+        rules = merge_char_ranges(rules)
+        rules = remove_unproductive_rules(rules)
+        rules = remove_unreachable_rules(rules, start_rule_id)
+        rules = inline_trivial_rules(rules, start_rule_id)
+        rules = dedupe_rules(rules, start_rule_id)
+        rules = remove_unreachable_rules(rules, start_rule_id)
+        if symbol_table is not None:
+            rules = left_factor_rules(rules, symbol_table)
+        if rules == previous:
+            break
+    return rules
+
+
+def optimize_grammar(
+    state: ParseState, start_rule_name: str = "root", left_factor: bool = True
+) -> ParseState:
+    """
+    Optimize a parsed grammar for recognition, without changing the language
+    derived from the start rule. Rules not reachable from the start rule are
+    dropped, the remaining rules keep their ids.
+    """
+    start_rule_id = state.symbol_table[start_rule_name]
+    symbol_table = dict(state.symbol_table)
+    rules = optimize_rules(
+        decode_rules(state.grammar_encoding),
+        start_rule_id,
+        symbol_table if left_factor else None,
+    )
+
+    optimized_state = ParseState()
+    optimized_state.symbol_table = {
+        name: rule_id for name, rule_id in symbol_table.items() if rule_id in rules
+    }
+    optimized_state.grammar_encoding = encode_rules(rules)
+    logger.debug(
+        f"optimized grammar from {len(state.grammar_encoding)} to "
+        f"{len(optimized_state.grammar_encoding)} ints, "
+        f"{len(state.symbol_table)} to {len(optimized_state.symbol_table)} rules"
+    )
+    return optimized_state
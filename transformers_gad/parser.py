@@ -1,7 +1,7 @@
 import argparse
 import logging
 import sys
-from typing import List
+from typing import List, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +11,15 @@ END_OF_GRAMMAR_MARKER = 0xFFFF
 TO_BE_FILLED_MARKER = 0
 REF_RULE_MARKER = 1
 LITERAL_MARKER = 2
+# reference to the start state of a compiled DFA, see transformers_gad/dfa.py
+DFA_REF_MARKER = 3
+# a DFA state record, stored after END_OF_GRAMMAR_MARKER
+DFA_STATE_MARKER = 5
+# bounded repetition of a rule, [REPEAT_MARKER, rule_id, min, max]
+REPEAT_MARKER = 7
+# max of an unbounded repetition, e.g. S{2,}
+REPEAT_UNBOUNDED = 0xFFFFFFFF
+MAX_CODE_POINT = 0x10FFFF
 
 
 ########################
@@ -64,177 +73,207 @@ def hex_to_int(c: str) -> int:
     return -1
 
 
-def remove_leading_white_space(src, rm_leading_newline):
+def remove_leading_white_space(src: str, pos: int, rm_leading_newline: bool) -> int:
     """
     Skips over whitespace and comments in the input string.
 
-    This function processes the input string, skipping over any spaces, tabs,
-    and content following a '#' character, which denotes a comment. The parsing
-    of a comment continues until the end of the line (denoted by newline characters
-    '\r' or '\n'). If the 'rm_leading_newline' parameter is set to False, the function
-    will stop processing and return the remaining string upon encountering a
-    newline character, otherwise it will skip over newline characters as well.
+    This function processes the input string from position `pos`, skipping over any
+    spaces, tabs, and content following a '#' character, which denotes a comment. The
+    parsing of a comment continues until the end of the line (denoted by newline
+    characters '\r' or '\n'). If the 'rm_leading_newline' parameter is set to False,
+    the function will stop upon encountering a newline character, otherwise it will
+    skip over newline characters as well.
 
     Parameters:
     src (str): The input string to be processed.
+    pos (int): The position in `src` to start skipping from.
     rm_leading_newline (bool): A flag indicating whether encountering a newline character
                        should stop the parsing (False) or if it should be skipped (True).
 
     Returns:
-    str: The remaining portion of the input string after skipping whitespace and comments.
+    int: The position of the first char after the skipped whitespace and comments.
     """
-    pos = 0
-    while pos < len(src) and (src[pos].isspace() or src[pos] == "#"):
+    end = len(src)
+    while pos < end and (src[pos].isspace() or src[pos] == "#"):
         if src[pos] == "#":
-            while pos < len(src) and src[pos] not in ("\r", "\n"):
+            while pos < end and src[pos] not in ("\r", "\n"):
                 pos += 1
         else:
             if not rm_leading_newline and src[pos] in ("\r", "\n"):
                 break
             pos += 1
-    return src[pos:]
+    return pos
 
 
-def parse_name(src) -> (str, str):
+def parse_name(src: str, pos: int) -> (str, int):
     """
-    parse the leading name from the input string
+    parse the name starting at `pos` in the input string
     Args:
         src:  the input grammar string
+        pos:  the position of the first char of the name
 
     Returns:
-        name, remaining_src
+        name, position after the name
     """
-    pos = 0
-    while pos < len(src) and is_word_char(src[pos]):
+    start = pos
+    end = len(src)
+    while pos < end and is_word_char(src[pos]):
         pos += 1
-    if pos == 0:
-        raise RuntimeError("expecting name at " + src)
-    return src[:pos], src[pos:]
+    if pos == start:
+        raise RuntimeError("expecting name at " + src[start:])
+    return src[start:pos], pos
 
 
-def parse_char(src) -> (str, str):
+def parse_char(src: str, pos: int) -> (str, int):
     """
-    parse the leading char from the input string
-    :param src:
-    :return: char, remaining_src
+    parse the char starting at `pos` in the input string
+    :param src: the input grammar string
+    :param pos: the position of the char, or of the backslash of an escape
+    :return: char, position after the char
     """
+    if pos >= len(src):
+        raise RuntimeError("unexpected end of input")
 
     # if we have a backslash, it's maybe an escape
-    if src[0] == "\\":
-        esc = src[1]
+    if src[pos] == "\\":
+        esc = src[pos + 1] if pos + 1 < len(src) else ""
         if esc == "x":
-            first = hex_to_int(src[2])
+            first = hex_to_int(src[pos + 2]) if pos + 2 < len(src) else -1
             if first > -1:
-                second = hex_to_int(src[3])
+                second = hex_to_int(src[pos + 3]) if pos + 3 < len(src) else -1
                 if second > -1:
-                    return (first << 4) + second, src[4:]
-            raise RuntimeError("expecting \\xNN at " + src)
+                    return chr((first << 4) + second), pos + 4
+            raise RuntimeError("expecting \\xNN at " + src[pos:])
         elif esc in ('"', "[", "]"):
-            return esc, src[2:]
+            return esc, pos + 2
         elif esc == "r":
-            return "\r", src[2:]
+            return "\r", pos + 2
         elif esc == "n":
-            return "\n", src[2:]
+            return "\n", pos + 2
         elif esc == "t":
-            return "\t", src[2:]
+            return "\t", pos + 2
         elif esc == "\\":
-            return "\\", src[2:]
+            return "\\", pos + 2
         elif esc == "/":
-            return "\\", src[1:]
-        raise RuntimeError("unknown escape at " + src)
-    elif src:
-        return src[0], src[1:]
-    raise RuntimeError("unexpected end of input")
+            return "\\", pos + 1
+        raise RuntimeError("unknown escape at " + src[pos:])
+    return src[pos], pos + 1
 
 
-def _parse_rhs_literal_string(src: str, outbuf: List[int]) -> str:
-    assert src[0] == '"', f"rule should start with '\"', but got {src[0]}"
-    remaining_src = src[1:]
+def _parse_rhs_literal_string(src: str, pos: int, outbuf: List[int]) -> int:
+    assert src[pos] == '"', f"rule should start with '\"', but got {src[pos]}"
+    start = pos
+    end = len(src)
+    pos += 1
 
     # advance until we get an end quote or run out of input
-    while remaining_src and remaining_src[0] != '"':
-        char, remaining_src = parse_char(remaining_src)
+    while pos < end and src[pos] != '"':
+        char, pos = parse_char(src, pos)
         outbuf.append(LITERAL_MARKER)
-        # print(f"char: {char}")
         outbuf.append(ord(char))
         outbuf.append(ord(char))
 
     # in case we ran out of input before finding the end quote
-    if not remaining_src:
-        raise RuntimeError(f"expecting an end quote at {src},but not found")
+    if pos >= end:
+        raise RuntimeError(f"expecting an end quote at {src[start:]},but not found")
 
-    # remove the end quote and return the remaining string
-    return remaining_src[1:]
+    # skip the end quote
+    return pos + 1
 
 
-def _parse_rhs_char_ranges(src: str, outbuf: List[int]) -> str:
-    assert src[0] == "[", f"rule should start with '[', but got {src[0]}"
-    remaining_src = src[1:]
-    start_idx = len(outbuf)
-    # num chars in range - replaced at end of loop
-    outbuf.append(TO_BE_FILLED_MARKER)
-    while remaining_src and remaining_src[0] != "]":
-        char, remaining_src = parse_char(remaining_src)
+def _parse_rhs_char_ranges(src: str, pos: int, outbuf: List[int]) -> int:
+    assert src[pos] == "[", f"rule should start with '[', but got {src[pos]}"
+    start = pos
+    end = len(src)
+    pos += 1
+    # a leading ^ negates the class, e.g. [^"\\]
+    negated = pos < end and src[pos] == "^"
+    if negated:
+        pos += 1
+    ranges = []
+    while pos < end and src[pos] != "]":
+        char, pos = parse_char(src, pos)
 
-        outbuf.append(ord(char))
-        if remaining_src[0] == "-" and remaining_src[1] != "]":
-            endchar_pair, remaining_src = parse_char(remaining_src[1:])
-            outbuf.append(ord(endchar_pair))
+        if pos + 1 < end and src[pos] == "-" and src[pos + 1] != "]":
+            endchar_pair, pos = parse_char(src, pos + 1)
+            ranges.append((ord(char), ord(endchar_pair)))
         else:
             # This is the case for enumerate, e.g., [0123456789], [abcdef]
             # Each char is considered as a range of itself, i.e., c-c
-            outbuf.append(ord(char))
-    if not remaining_src:
+            ranges.append((ord(char), ord(char)))
+    if pos >= end:
         raise RuntimeError(
-            f"expecting an ] at {src},but not found, is the char range closed?"
+            f"expecting an ] at {src[start:]},but not found, is the char range closed?"
         )
-    # replace num chars with actual
-    outbuf[start_idx] = len(outbuf) - start_idx - 1
-    return remaining_src[1:]
+    if negated:
+        ranges = _complement_ranges(ranges)
+    # num chars in range
+    outbuf.append(2 * len(ranges))
+    for range_start, range_end in ranges:
+        outbuf.append(range_start)
+        outbuf.append(range_end)
+    return pos + 1
 
 
-def _parse_rhs_symbol_reference(src: str, state: ParseState, outbuf: List[int]) -> str:
-    assert is_word_char(src[0]), f"rule should start with a word char, but got {src[0]}"
-    name, remaining_src = parse_name(src)
+def _complement_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    The ranges of the code points in [0, MAX_CODE_POINT] not covered by `ranges`.
+    """
+    complement = []
+    next_start = 0
+    for range_start, range_end in sorted(ranges):
+        if range_start > next_start:
+            complement.append((next_start, range_start - 1))
+        next_start = max(next_start, range_end + 1)
+    if next_start <= MAX_CODE_POINT:
+        complement.append((next_start, MAX_CODE_POINT))
+    return complement
+
+
+def _parse_rhs_symbol_reference(
+    src: str, pos: int, state: ParseState, outbuf: List[int]
+) -> int:
+    assert is_word_char(
+        src[pos]
+    ), f"rule should start with a word char, but got {src[pos]}"
+    name, pos = parse_name(src, pos)
     ref_rule_id = get_symbol_id(state, name)
     outbuf.append(REF_RULE_MARKER)
     outbuf.append(ref_rule_id)
-    return remaining_src
+    return pos
 
 
 def _parse_rhs_grouping(
-    remaining_src: str, state: ParseState, rule_name: str, outbuf: List[int]
-) -> str:
-    assert (
-        remaining_src[0] == "("
-    ), f"rule should start with '(', but got {remaining_src[0]}"
-    remaining_src = remove_leading_white_space(remaining_src[1:], True)
+    src: str, pos: int, state: ParseState, rule_name: str, outbuf: List[int]
+) -> int:
+    assert src[pos] == "(", f"rule should start with '(', but got {src[pos]}"
+    pos = remove_leading_white_space(src, pos + 1, True)
     # parse nested alternates into synthesized rule
     synthetic_rule_id = generate_symbol_id(state, rule_name)
-    remaining_src = parse_rhs(state, remaining_src, rule_name, synthetic_rule_id, True)
+    pos = parse_rhs(state, src, pos, rule_name, synthetic_rule_id, True)
     # output reference to synthesized rule
     outbuf.append(REF_RULE_MARKER)
     outbuf.append(synthetic_rule_id)
 
-    if not remaining_src or remaining_src[0] != ")":
-        raise RuntimeError("expecting ')' at " + remaining_src)
-    return remaining_src[1:]
+    if pos >= len(src) or src[pos] != ")":
+        raise RuntimeError("expecting ')' at " + src[pos:])
+    return pos + 1
 
 
 def _parse_rhs_repetition_operators(
-    remaining_src: str,
+    src: str,
+    pos: int,
     state: ParseState,
     rule_name: str,
     last_sym_start: int,
     outbuf: List[int],
-) -> str:
-    assert remaining_src[0] in (
+) -> int:
+    assert src[pos] in (
         "*",
         "+",
         "?",
-    ), f"rule should start with '*', '+', or '?', but got {remaining_src[0]}"
+    ), f"rule should start with '*', '+', or '?', but got {src[pos]}"
     out_grammar = state.grammar_encoding
-    # last_sym_start = len(outbuf)
 
     # apply transformation to previous symbol (last_sym_start -
     # end) according to rewrite rules:
@@ -248,7 +287,7 @@ def _parse_rhs_repetition_operators(
     out_grammar.append(TO_BE_FILLED_MARKER)
     # add preceding symbol to generated rule
     out_grammar.extend(outbuf[last_sym_start:])
-    if remaining_src[0] in ("*", "+"):
+    if src[pos] in ("*", "+"):
         # cause generated rule to recurse
         out_grammar.append(REF_RULE_MARKER)
         out_grammar.append(sub_rule_id)
@@ -259,7 +298,7 @@ def _parse_rhs_repetition_operators(
     sub_rule_offset = len(out_grammar)
     # placeholder for size of 2nd alternate
     out_grammar.append(TO_BE_FILLED_MARKER)
-    if remaining_src[0] == "+":
+    if src[pos] == "+":
         # add preceding symbol as alternate only for '+'
         out_grammar.extend(outbuf[last_sym_start:])
     # apply actual size of 2nd alternate
@@ -270,124 +309,176 @@ def _parse_rhs_repetition_operators(
 
     # in original rule, replace previous symbol with reference to generated rule
     outbuf[last_sym_start:] = [REF_RULE_MARKER, sub_rule_id]
-    return remaining_src[1:]
+    return pos + 1
+
+
+def _parse_int(src: str, pos: int) -> Tuple[int, int]:
+    start = pos
+    while pos < len(src) and src[pos].isdigit():
+        pos += 1
+    if pos == start:
+        raise RuntimeError("expecting an integer at " + src[start:])
+    return int(src[start:pos]), pos
+
+
+def _parse_rhs_bounded_repetition(
+    src: str,
+    pos: int,
+    state: ParseState,
+    rule_name: str,
+    last_sym_start: int,
+    outbuf: List[int],
+) -> int:
+    assert src[pos] == "{", f"rule should start with '{{', but got {src[pos]}"
+    pos = remove_leading_white_space(src, pos + 1, True)
+    min_count, pos = _parse_int(src, pos)
+    max_count = min_count
+    pos = remove_leading_white_space(src, pos, True)
+    if pos < len(src) and src[pos] == ",":
+        pos = remove_leading_white_space(src, pos + 1, True)
+        if pos < len(src) and src[pos] == "}":
+            max_count = REPEAT_UNBOUNDED
+        else:
+            max_count, pos = _parse_int(src, pos)
+            pos = remove_leading_white_space(src, pos, True)
+    if pos >= len(src) or src[pos] != "}":
+        raise RuntimeError("expecting '}' at " + src[pos:])
+    if max_count < min_count or min_count >= REPEAT_UNBOUNDED:
+        raise RuntimeError(f"invalid repetition bounds {{{min_count},{max_count}}}")
+
+    # the previous symbol is repeated by a counter instead of being copied:
+    # S{m,n} --> [REPEAT_MARKER, S', m, n] with S' ::= S
+    # S{0} is dropped and S{1} is kept as is
+    symbol = outbuf[last_sym_start:]
+    if max_count == 0:
+        outbuf[last_sym_start:] = []
+    elif max_count != 1 or min_count != 1:
+        if len(symbol) == 2 and symbol[0] == REF_RULE_MARKER:
+            repeated_rule_id = symbol[1]
+        else:
+            repeated_rule_id = generate_symbol_id(state, rule_name)
+            state.grammar_encoding.append(repeated_rule_id)
+            state.grammar_encoding.append(len(symbol) + 1)
+            state.grammar_encoding.extend(symbol)
+            state.grammar_encoding.append(END_OF_ALTERNATE_MARKER)
+            state.grammar_encoding.append(END_OF_RULE_MARKER)
+        outbuf[last_sym_start:] = [REPEAT_MARKER, repeated_rule_id, min_count, max_count]
+    return pos + 1
 
 
-def parse_simple_rhs(state, rhs: str, rule_name: str, outbuf, is_nested):
+def parse_simple_rhs(state, src: str, pos: int, rule_name: str, outbuf, is_nested):
     simple_rhs_offset = len(outbuf)
 
     # sequence size, will be replaced at end when known
     outbuf.append(TO_BE_FILLED_MARKER)
 
     last_sym_start = len(outbuf)
-    remaining_rhs = rhs
-    while remaining_rhs:
-        if remaining_rhs[0] == '"':  # literal string
+    end = len(src)
+    while pos < end:
+        c = src[pos]
+        if c == '"':  # literal string
             # mark the start of the last symbol, for repetition operator
             last_sym_start = len(outbuf)
-            remaining_rhs = _parse_rhs_literal_string(remaining_rhs, outbuf)
-        elif remaining_rhs[0] == "[":  # char range(s)
+            pos = _parse_rhs_literal_string(src, pos, outbuf)
+        elif c == "[":  # char range(s)
             # mark the start of the last symbol, for repetition operator
             last_sym_start = len(outbuf)
-            remaining_rhs = _parse_rhs_char_ranges(remaining_rhs, outbuf)
-        elif is_word_char(remaining_rhs[0]):  # rule reference
+            pos = _parse_rhs_char_ranges(src, pos, outbuf)
+        elif is_word_char(c):  # rule reference
             # mark the start of the last symbol, for repetition operator
             last_sym_start = len(outbuf)
-            remaining_rhs = _parse_rhs_symbol_reference(remaining_rhs, state, outbuf)
-        elif remaining_rhs[0] == "(":  # grouping
+            pos = _parse_rhs_symbol_reference(src, pos, state, outbuf)
+        elif c == "(":  # grouping
             # mark the start of the last symbol, for repetition operator
             last_sym_start = len(outbuf)
-            remaining_rhs = _parse_rhs_grouping(remaining_rhs, state, rule_name, outbuf)
-        elif remaining_rhs[0] in ("*", "+", "?"):  # repetition operator
+            pos = _parse_rhs_grouping(src, pos, state, rule_name, outbuf)
+        elif c in ("*", "+", "?"):  # repetition operator
             # No need to mark the start of the last symbol, because we already did it
             if len(outbuf) - simple_rhs_offset - 1 == 0:
-                raise RuntimeError(
-                    "expecting preceeding item to */+/? at " + remaining_rhs
-                )
-            remaining_rhs = _parse_rhs_repetition_operators(
-                remaining_rhs, state, rule_name, last_sym_start, outbuf
+                raise RuntimeError("expecting preceeding item to */+/? at " + src[pos:])
+            pos = _parse_rhs_repetition_operators(
+                src, pos, state, rule_name, last_sym_start, outbuf
+            )
+        elif c == "{":  # bounded repetition
+            if len(outbuf) - simple_rhs_offset - 1 == 0:
+                raise RuntimeError("expecting preceeding item to {m,n} at " + src[pos:])
+            pos = _parse_rhs_bounded_repetition(
+                src, pos, state, rule_name, last_sym_start, outbuf
             )
         else:
             # case for newline, i.e., end of rule
-            assert remaining_rhs[0] in [
+            assert c in [
+                "\r",
                 "\n",
                 "|",
                 ")",
-            ], f"rule should end with newline or '|', but got {remaining_rhs[0]}"
+            ], f"rule should end with newline or '|', but got {c}"
             # we break here so that we call parse_rule again to parse the next rule
             break
         # Here we do not rm newline deliberately so that we know the rhs is ended
-        remaining_rhs = remove_leading_white_space(
-            remaining_rhs, rm_leading_newline=is_nested
-        )
+        pos = remove_leading_white_space(src, pos, rm_leading_newline=is_nested)
 
     # apply actual size of this alternate sequence
     outbuf[simple_rhs_offset] = len(outbuf) - simple_rhs_offset
     # mark end of alternate
     outbuf.append(END_OF_ALTERNATE_MARKER)
-    return remaining_rhs
+    return pos
 
 
-def parse_rhs(state, rhs: str, rule_name, rule_id, is_nested):
+def parse_rhs(state, src: str, pos: int, rule_name, rule_id, is_nested) -> int:
     outbuf = []
-    remaining_rhs = parse_simple_rhs(state, rhs, rule_name, outbuf, is_nested)
-    while remaining_rhs and remaining_rhs[0] == "|":
-        remaining_rhs = remove_leading_white_space(remaining_rhs[1:], True)
-        remaining_rhs = parse_simple_rhs(
-            state, remaining_rhs, rule_name, outbuf, is_nested
-        )
+    pos = parse_simple_rhs(state, src, pos, rule_name, outbuf, is_nested)
+    while pos < len(src) and src[pos] == "|":
+        pos = remove_leading_white_space(src, pos + 1, True)
+        pos = parse_simple_rhs(state, src, pos, rule_name, outbuf, is_nested)
 
     # Now we have finished parsing the rhs, we can add the rule to the grammar_encoding
     state.grammar_encoding.append(rule_id)
     state.grammar_encoding.extend(outbuf)
     state.grammar_encoding.append(END_OF_RULE_MARKER)
-    return remaining_rhs
+    return pos
 
 
-def parse_rule(state: ParseState, rule_text: str) -> str:
-    name, remaining_rule_text = parse_name(rule_text)
-    remaining_rule_text = remove_leading_white_space(remaining_rule_text, False)
+def parse_rule(state: ParseState, src: str, pos: int) -> int:
+    name, pos = parse_name(src, pos)
+    pos = remove_leading_white_space(src, pos, False)
     # check if the rule is already defined, TODO: what will happen if the rule is already defined?
     rule_id = get_symbol_id(state, name)
 
-    if remaining_rule_text[:3] != "::=":
-        raise RuntimeError("expecting ::= at " + remaining_rule_text)
-    remaining_rule_text = remove_leading_white_space(remaining_rule_text[3:], True)
+    if not src.startswith("::=", pos):
+        raise RuntimeError("expecting ::= at " + src[pos:])
+    pos = remove_leading_white_space(src, pos + 3, True)
 
-    remaining_rule_text = parse_rhs(state, remaining_rule_text, name, rule_id, False)
+    pos = parse_rhs(state, src, pos, name, rule_id, False)
 
-    if remaining_rule_text and remaining_rule_text[0] == "\r":
-        remaining_rule_text = (
-            remaining_rule_text[2:]
-            if remaining_rule_text[1] == "\n"
-            else remaining_rule_text[1:]
-        )
-    elif remaining_rule_text and remaining_rule_text[0] == "\n":
-        remaining_rule_text = remaining_rule_text[1:]
-    elif remaining_rule_text:
-        raise RuntimeError("expecting newline or end at " + remaining_rule_text)
-    return remove_leading_white_space(remaining_rule_text, True)
+    if pos < len(src) and src[pos] == "\r":
+        pos += 2 if src.startswith("\n", pos + 1) else 1
+    elif pos < len(src) and src[pos] == "\n":
+        pos += 1
+    elif pos < len(src):
+        raise RuntimeError("expecting newline or end at " + src[pos:])
+    return remove_leading_white_space(src, pos, True)
 
 
 def parse_ebnf(grammar_text: str) -> ParseState:
+    """
+    Parse an EBNF grammar into its flat integer encoding.
+
+    The parser keeps a single cursor into `grammar_text` instead of slicing off the
+    consumed prefix, so parsing time is linear in the size of the grammar.
+    """
     try:
         state = ParseState()
-        remaining_grammar_text = remove_leading_white_space(grammar_text, True)
-        last_grammar_repr = ""
-        while remaining_grammar_text:
-            if last_grammar_repr:
-                last_parsed_rule_len = len(last_grammar_repr) - len(
-                    remaining_grammar_text
-                )
-                logger.debug(
-                    f"last_parsed_rule: {last_grammar_repr[:last_parsed_rule_len]}"
-                )
-            last_grammar_repr = remaining_grammar_text
-            remaining_grammar_text = parse_rule(state, remaining_grammar_text)
+        pos = remove_leading_white_space(grammar_text, 0, True)
+        while pos < len(grammar_text):
+            last_pos = pos
+            pos = parse_rule(state, grammar_text, pos)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"last_parsed_rule: {grammar_text[last_pos:pos]}")
         state.grammar_encoding.append(END_OF_GRAMMAR_MARKER)
         return state
     except RuntimeError as err:
-        logger.warning("error parsing grammar:", err)
+        logger.warning("error parsing grammar: %s", err)
         return ParseState()
 
 
@@ -452,6 +543,19 @@ def _print_annotated_grammar(file, grammar_encoding, symbol_id_names, index=0):
                     file=file,
                 )
                 pos += 2
+            elif grammar_encoding[pos] == REPEAT_MARKER:
+                _, ref_rule_id, min_count, max_count = grammar_encoding[pos : pos + 4]
+                if max_count == REPEAT_UNBOUNDED:
+                    max_count = ""
+                print(
+                    f"<{pos}>{symbol_id_names[ref_rule_id]}{{{min_count},{max_count}}}",
+                    end=" ",
+                    file=file,
+                )
+                pos += 4
+            elif grammar_encoding[pos] == DFA_REF_MARKER:
+                print(f"<{pos}>dfa@{grammar_encoding[pos + 1]}", end=" ", file=file)
+                pos += 2
             else:
                 print("<{}>[".format(pos), end="", file=file)
                 num_chars = grammar_encoding[pos]
@@ -520,6 +624,17 @@ if __name__ == "__main__":
         default="/nobackup2/yf/mila/GD/examples/sygus/PRE_100_bare.ebnf",
         help="Path to the grammar file",
     )
+    parser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="Also report the complexity of the grammar, see transformers_gad/complexity.py",
+    )
+    parser.add_argument(
+        "--vocab-size",
+        type=int,
+        default=32000,
+        help="Vocab size of the tokenizer, for the token mask cache estimate of --analyze",
+    )
 
     args = parser.parse_args()
 
@@ -531,6 +646,10 @@ if __name__ == "__main__":
     parsed_grammar = parse_ebnf(input_text)
     print("parse state:")
     parsed_grammar.print()
+    if args.analyze:
+        from transformers_gad.complexity import analyze_grammar
+
+        analyze_grammar(input_text, vocab_size=args.vocab_size).print()
     # print(f"symbol_ids: \n{parsed_grammar.symbol_table}")
 
     # start_rule_id = parsed_grammar.symbol_table["root"]
@@ -1,27 +1,172 @@
-import copy
 import logging
-from functools import lru_cache
-from typing import List, Tuple, Dict
+import math
+import weakref
+from typing import Dict, List, Tuple
 
+import numpy as np
+
+from transformers_gad.array_grammar import ArrayGrammar
+from transformers_gad.cache import BoundedCache, CacheBudget, CacheStats, cache_budget
+from transformers_gad.char_class import CharClass
+from transformers_gad.lazy_dfa import LazyDfa
+from transformers_gad.grammar_analysis import ClosureTable, GrammarTables
 from transformers_gad.parser import (
+    DFA_STATE_MARKER,
     END_OF_RULE_MARKER,
     END_OF_ALTERNATE_MARKER,
-    parse_ebnf,
-    REF_RULE_MARKER,
 )
-from transformers_gad.utf8_utils import PartialUTF8, decode_utf8
-from transformers_gad.utils import intervals_intersect
-import logging
+from transformers_gad.stack import EMPTY_STACK, Stack, canonical_stacks, make_stack
+from transformers_gad.utf8_automaton import UTF8_REJECT, UTF8_START, Utf8Automaton
+
+# below this many stacks, the per-stack path is faster than a vectorized step
+VECTORIZE_MIN_STACKS = 8
+
+
+def step_bytes(recognizer, byte_seq: bytes, stacks, utf8_state: int):
+    """
+    The stacks and the Utf8Automaton state of `recognizer` after the bytes,
+    for the recognizers that step their stacks with `_step_stacks` and
+    `_keep_partial` rather than through a lazy DFA. It stops early once no
+    stack is left.
+    """
+    utf8 = recognizer.utf8
+    for byte in byte_seq:
+        code_point_class = utf8.classes[utf8_state][byte]
+        utf8_state = utf8.next_states[utf8_state][byte]
+        if code_point_class >= 0:
+            stacks = recognizer._step_stacks(utf8.representatives[code_point_class], stacks)
+        elif utf8_state == UTF8_REJECT:
+            return [], UTF8_START
+        else:
+            stacks = recognizer._keep_partial(stacks, utf8_state)
+        if not stacks:
+            break
+    return list(stacks), utf8_state
 
 
 class AcceptState:
-    def __init__(self, stacks, partial_utf8):
-        self.stacks = stacks
-        self.partial_utf8 = partial_utf8
+    """
+    Immutable parse state of a sequence: the tuple of its stacks and the
+    state of the Utf8Automaton in the bytes of a multi-byte character,
+    UTF8_START between two characters. The stacks are hash-consed Stacks,
+    LR stacks or Earley columns, which are never modified either, so a state
+    can be shared by any number of sequences and is never copied, and its
+    hash is computed once, so it can be used directly as a cache key.
+
+    `state_id` is its id in the ParseStateTable of the recognizer, None if
+    it is not interned; it takes no part in equality.
+    """
+
+    __slots__ = ("stacks", "utf8_state", "state_id", "_hash", "__weakref__")
+
+    def __init__(self, stacks, utf8_state=UTF8_START, state_id=None):
+        stacks = tuple(stacks)
+        object.__setattr__(self, "stacks", stacks)
+        object.__setattr__(self, "utf8_state", utf8_state)
+        object.__setattr__(self, "state_id", state_id)
+        object.__setattr__(self, "_hash", hash((stacks, utf8_state)))
 
     @staticmethod
     def empty_state():
-        return AcceptState([], PartialUTF8())
+        return AcceptState((), UTF8_START)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"AcceptState is immutable, cannot set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"AcceptState is immutable, cannot delete {name}")
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, AcceptState):
+            return NotImplemented
+        return (
+            self._hash == other._hash
+            and self.utf8_state == other.utf8_state
+            and self.stacks == other.stacks
+        )
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return AcceptState, (self.stacks, self.utf8_state)
+
+    def __repr__(self):
+        return f"AcceptState({len(self.stacks)} stacks, utf8_state={self.utf8_state})"
+
+
+class ParseStateTable:
+    """
+    Interned parse states of a grammar. A parse state is a canonical set of
+    stacks, see canonical_stacks, and a Utf8Automaton state; the table
+    holds a single AcceptState per parse state, with an integer `state_id`,
+    so that the rows of a batch or the beams that reach the same parse state
+    share the state object and the work done on it.
+
+    The states are held weakly, a state is dropped with its last reference,
+    and state ids are never reused.
+    """
+
+    def __init__(self):
+        self._states = weakref.WeakValueDictionary()
+        self._states_by_id = weakref.WeakValueDictionary()
+        self._next_id = 0
+
+    def intern(self, stacks, utf8_state: int = UTF8_START) -> AcceptState:
+        stacks = canonical_stacks(stacks)
+        key = (stacks, utf8_state)
+        accept_state = self._states.get(key)
+        if accept_state is None:
+            accept_state = AcceptState(stacks, utf8_state, self._next_id)
+            self._states[key] = accept_state
+            self._states_by_id[self._next_id] = accept_state
+            self._next_id += 1
+        return accept_state
+
+    def __getitem__(self, state_id: int) -> AcceptState:
+        return self._states_by_id[state_id]
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+
+def get_rule_offsets(grammar_encoding: List[int], start_rule_id: int) -> List[int]:
+    _rule_offset = 0
+    rule_offsets = []
+    # Build `rules` as an array of rule IDs to their positions in `grammar_src`
+    while grammar_encoding[_rule_offset] != 0xFFFF:
+        rule_id = grammar_encoding[_rule_offset]
+        # store the offset idx
+        if len(rule_offsets) <= rule_id:
+            rule_offsets.extend([-1] * (rule_id - len(rule_offsets) + 1))
+        rule_offsets[rule_id] = _rule_offset
+
+        # Skip rule ID
+        # _rule_offset += 1
+        simple_rhs_offset = _rule_offset + 1
+
+        # Skip rule alternates
+        while grammar_encoding[simple_rhs_offset] != END_OF_RULE_MARKER:
+            simple_rhs_offset = (
+                simple_rhs_offset + 1 + grammar_encoding[simple_rhs_offset]
+            )
+
+        # Skip 0 denoting end of rule
+        # _rule_offset += 1
+        _rule_offset = simple_rhs_offset + 1
+
+    retrieved_start_rule_id = grammar_encoding[rule_offsets[start_rule_id]]
+    assert retrieved_start_rule_id == start_rule_id
+
+    return rule_offsets
 
 
 class StringRecognizer:
@@ -31,6 +176,8 @@ class StringRecognizer:
         start_rule_id: int = None,
         rule_offsets: List[int] = None,
         stacks: List[List[int]] = None,
+        vectorized: bool = False,
+        cache_budgets: Dict[str, CacheBudget] = None,
     ):
         # strictly speaking, we don't need to copy grammar_encoding because we don't modify it
         # but we do it anyway to be safe
@@ -42,138 +189,179 @@ class StringRecognizer:
             if start_rule_id is None:
                 raise ValueError("start_rule_id cannot be None if rule_offsets is None")
             self.rule_offsets = self.init_rules(start_rule_id)
-        # each stack is a list of indices into grammar_encoding
+        self.tables = GrammarTables(self.grammar_encoding, self.rule_offsets)
+        # how every element expands on top of a stack, see advance_stack
+        self.closures = ClosureTable(self.grammar_encoding, self.rule_offsets, self.tables)
+        # the memoized methods, their caches go away with the recognizer,
+        # see DEFAULT_CACHE_BUDGETS for their names and default budgets
+        self.caches: Dict[str, BoundedCache] = {
+            name: BoundedCache(name, cache_budget(name, cache_budgets))
+            for name in (
+                "advance_stack",
+                "consume_code_point_per_stack",
+            )
+        }
+        # membership structure of every terminal element, keyed by element offset
+        self.char_classes = self.tables.char_classes
+        # the parse states reached with this recognizer, and the transitions
+        # between them on code points, filled in as they are taken
+        self.states = ParseStateTable()
+        # a DFA state goes to a different target on each of its ranges, the
+        # ranges split the code point classes too, so that all the code points
+        # of a class, e.g. its representative, take the same transition
+        transition_classes = [
+            CharClass([code_point_range])
+            for state in self.tables.dfa_states.values()
+            for code_point_range in state.ranges()
+        ]
+        self.state_dfa = LazyDfa(
+            list(self.char_classes.values()) + transition_classes,
+            self._next_state,
+            cache_budget("lazy_dfa", cache_budgets),
+        )
+        # the bytes of the tokens are read by an automaton over the UTF-8
+        # encodings of the code point classes of the lazy DFA, and the pending
+        # bytes of a character are checked against the classes of the stack tops
+        self.utf8 = Utf8Automaton(self.state_dfa.boundaries)
+        self.element_classes: Dict[int, int] = {
+            element_offset: self.utf8.class_mask(char_class)
+            for element_offset, char_class in self.char_classes.items()
+        }
+        # in the vectorized mode, a code point is consumed on all the stacks at
+        # once over the struct-of-arrays form of the grammar
+        self.arrays = (
+            ArrayGrammar(self.grammar_encoding, self.rule_offsets, self.tables)
+            if vectorized
+            else None
+        )
+        # each stack is a persistent Stack of indices into grammar_encoding
         # each index points to a rule's
         if stacks is not None:
-            self.stacks = stacks
+            self.stacks = [make_stack(stack) for stack in stacks]
         else:
             if start_rule_id is None:
                 raise ValueError("start_rule_id cannot be None if stacks is None")
-            self.stacks: List[List[int]] = self.init_stack(start_rule_id)
+            self.stacks: List[Stack] = self.init_stack(start_rule_id)
         self.start_rule_id = start_rule_id
+        # the initial state is kept alive, so that its transitions in the lazy
+        # DFA are not lost between two strings
+        self._initial_accept_state = None
 
     def init_rules(self, start_rule_id: int) -> List[int]:
-        _rule_offset = 0
-        rule_offsets = []
-        # Build `rules` as an array of rule IDs to their positions in `grammar_src`
-        while self.grammar_encoding[_rule_offset] != 0xFFFF:
-            rule_id = self.grammar_encoding[_rule_offset]
-            # store the offset idx
-            if len(rule_offsets) <= rule_id:
-                rule_offsets.extend([-1] * (rule_id - len(rule_offsets) + 1))
-            rule_offsets[rule_id] = _rule_offset
-
-            # Skip rule ID
-            # _rule_offset += 1
-            simple_rhs_offset = _rule_offset + 1
-
-            # Skip rule alternates
-            while self.grammar_encoding[simple_rhs_offset] != END_OF_RULE_MARKER:
-                simple_rhs_offset = (
-                    simple_rhs_offset + 1 + self.grammar_encoding[simple_rhs_offset]
-                )
-
-            # Skip 0 denoting end of rule
-            # _rule_offset += 1
-            _rule_offset = simple_rhs_offset + 1
+        return get_rule_offsets(self.grammar_encoding, start_rule_id)
 
-        retrieved_start_rule_id = self.grammar_encoding[rule_offsets[start_rule_id]]
-        assert retrieved_start_rule_id == start_rule_id
-
-        return rule_offsets
-
-    def init_stack(self, start_rule_id: int) -> List[List[int]]:
+    def init_stack(self, start_rule_id: int) -> List[Stack]:
 
         stacks = []
         # Loop over alternates of start rule to build initial stacks
         sub_rhs_offset = self.rule_offsets[start_rule_id] + 1
         while self.grammar_encoding[sub_rhs_offset]:
-            stack: List[int] = []
+            stack = EMPTY_STACK
             # If alternate is nonempty, add to stack
             element_offset = sub_rhs_offset + 1
             if self.grammar_encoding[element_offset] != END_OF_ALTERNATE_MARKER:
-                stack.append(element_offset)
-            stacks.extend(self.advance_stack(tuple(stack)))
+                stack = stack.push(element_offset)
+            stacks.extend(self.advance_stack(stack))
             sub_rhs_offset += 1 + self.grammar_encoding[sub_rhs_offset]
-        return stacks
+        return list(canonical_stacks(stacks))
 
     def get_initial_accept_state(self) -> AcceptState:
-        return AcceptState(self.init_stack(self.start_rule_id), PartialUTF8())
+        if self._initial_accept_state is None:
+            self._initial_accept_state = self.states.intern(
+                self.init_stack(self.start_rule_id), UTF8_START
+            )
+        return self._initial_accept_state
 
     def get_termination_accept_state(self) -> AcceptState:
-        return AcceptState([], PartialUTF8())
+        return self.states.intern([], UTF8_START)
 
-    @lru_cache(maxsize=32768)
-    def advance_stack(self, stack: Tuple[int]) -> List[List[int]]:
-        stack = list(stack)
-        if len(stack) == 0:
-            return [stack]
+    def cache_stats(self) -> List[CacheStats]:
+        return [cache.stats() for cache in self.caches.values()] + [self.state_dfa.stats()]
 
-        # we get the last element of the stack, which is the element we are currently processing
-        cur_element_offset = stack[-1]
+    def clear_caches(self):
+        """
+        Drop the memoized results and the transitions of the lazy DFA.
+        """
+        for cache in self.caches.values():
+            cache.clear()
+        self.state_dfa.clear()
 
-        # if the element is a terminal, we don't need to advance the stack
-        if self.grammar_encoding[cur_element_offset] != REF_RULE_MARKER:
-            return [stack]
-        # the remaining case is that the element is a non-terminal, i.e. a reference to another rule
-        else:
-            ref_rule_id = self.grammar_encoding[cur_element_offset + 1]
-            # find the offset of the referenced rule
-            ref_subrule_offset = self.rule_offsets[ref_rule_id] + 1
-            new_stacks: List[List[int]] = []
-            # Loop over alternates of referenced rule to build new stacks
-            while self.grammar_encoding[ref_subrule_offset] != END_OF_RULE_MARKER:
-                # copy the original stack without the last element
-                new_stack = stack[:-1]
-                # if the rule ref is followed by another element, we add it to the stack
-                next_element_offset = cur_element_offset + 2
-                if (
-                    self.grammar_encoding[next_element_offset]
-                    != END_OF_ALTERNATE_MARKER
-                ):
-                    new_stack.append(next_element_offset)
-
-                # if the referenced rule is not empty, we add its element offset to the stack
-                ref_element_offset = ref_subrule_offset + 1
-                if self.grammar_encoding[ref_element_offset] != END_OF_ALTERNATE_MARKER:
-                    new_stack.append(ref_element_offset)
-
-                new_stacks.extend(self.advance_stack(tuple(new_stack)))
-                ref_subrule_offset += self.grammar_encoding[ref_subrule_offset] + 1
+    def close(self):
+        """
+        Release the memoized results and the transitions of the lazy DFA once
+        the recognizer is done with. It still works, but the caches store
+        nothing from then on.
+        """
+        for cache in self.caches.values():
+            cache.close()
+        self.state_dfa.close()
+
+    def advance_stack(self, stack: Stack) -> List[Stack]:
+        cache = self.caches["advance_stack"]
+        new_stacks = cache.get(stack)
+        if new_stacks is None:
+            new_stacks = self._advance_stack(stack)
+            cache.put(stack, new_stacks)
+        return new_stacks
 
-            return new_stacks
+    def _advance_stack(self, stack: Stack) -> List[Stack]:
+        """
+        Expand the top of the stack until every stack has a terminal or a DFA
+        state on top, by pushing the precomputed sequences of its Closure onto
+        the rest of the stack, and going down the stack while the top can be
+        popped. The empty stack is kept, the input can stop there.
+        """
+        new_stacks: List[Stack] = []
+        while stack:
+            closure = self.closures[stack.top]
+            if closure is None:
+                raise ValueError(
+                    f"The rule at element {stack.top} is left-recursive, which the stack "
+                    "recognizer does not support, use backend='earley' instead."
+                )
+            rest = stack.rest
+            for sequence in closure.sequences:
+                new_stacks.append(rest.push_all(sequence))
+            if not closure.nullable:
+                return new_stacks
+            stack = rest
+        new_stacks.append(stack)
+        return new_stacks
 
     def _consume_byte(self, byte: int, accept_state: AcceptState):
         # suppose we have code point 一, ord('一') = 19968, we need to match 3 bytes
         # we need to match 3 bytes, so we need to call _consume_byte_partial_match 3 times
         self._consume_bytes(bytes([byte]), accept_state)
 
-    # @lru_cache(maxsize=32768)
     def _probe_bytes(
         self,
         byte_seq: bytes,
-        stacks: List[List[int]],
-        partial_utf8: PartialUTF8,
+        stacks: List[Stack],
+        utf8_state: int = UTF8_START,
         verbose=True,
     ):
-        if type(byte_seq) is list:
-            byte_seq = bytes(byte_seq)
-        code_points, new_partial_utf8 = decode_utf8(byte_seq, partial_utf8)
+        """
+        Whether the stacks, which are not a parse state of their own, e.g. a
+        single stack, accept the bytes after the pending bytes of `utf8_state`.
+        """
+        stacks = canonical_stacks(stacks)
+        next_states = self.utf8.next_states
+        classes = self.utf8.classes
+        representatives = self.utf8.representatives
+        for byte in byte_seq:
+            code_point_class = classes[utf8_state][byte]
+            utf8_state = next_states[utf8_state][byte]
+            if code_point_class >= 0:
+                stacks = self._consume_code_point(representatives[code_point_class], stacks)
+            elif utf8_state == UTF8_REJECT:
+                return False
+            else:
+                stacks = self._keep_partial(stacks, utf8_state)
+            if not stacks:
+                return False
         if verbose:
-            logging.debug(
-                f"code_points: {code_points}; new_partial_utf8: {new_partial_utf8}"
-            )
-        new_stacks = self._consume_code_points(code_points, stacks)
-
-        for stack in new_stacks:
-
-            # stack is empty, meaning that the variables are all consumed
-            if len(stack) == 0:
-                return True
-            element_offset = stack[-1]
-            if self.partial_utf8_accept_at_element(element_offset, new_partial_utf8):
-                return True
-        return False
+            logging.debug(f"stacks: {stacks}; utf8_state: {utf8_state}")
+        return True
 
     def _consume_bytes(
         self,
@@ -181,27 +369,50 @@ class StringRecognizer:
         accept_state: AcceptState = None,
         verbose=True,
     ):
+        """
+        Consume raw bytes, see _feed_bytes, the stacks that are done are
+        dropped at the end.
+        """
         if accept_state is None:
             accept_state = self.get_initial_accept_state()
-        stacks = accept_state.stacks
-        partial_utf8 = accept_state.partial_utf8
-        if type(byte_seq) is list:
-            byte_seq = bytes(byte_seq)
-        code_points, new_partial_utf8 = decode_utf8(byte_seq, partial_utf8)
+        accept_state = self._feed_bytes(byte_seq, accept_state)
         if verbose:
             logging.debug(
-                f"code_points: {code_points}; new_partial_utf8: {new_partial_utf8}"
+                f"stacks: {accept_state.stacks}; utf8_state: {accept_state.utf8_state}"
+            )
+        # the stacks that are done are dropped, the input can only go on
+        if any(not stack for stack in accept_state.stacks):
+            accept_state = self.states.intern(
+                [stack for stack in accept_state.stacks if stack], accept_state.utf8_state
             )
-        new_stacks = self._consume_code_points(code_points, stacks)
+        return accept_state
 
-        new_new_stacks = []
-        for stack in new_stacks:
-            if len(stack) == 0:
-                continue
-            element_offset = stack[-1]
-            if self.partial_utf8_accept_at_element(element_offset, new_partial_utf8):
-                new_new_stacks.append(stack)
-        return AcceptState(new_new_stacks, new_partial_utf8)
+    def _feed_bytes(self, byte_seq: bytes, accept_state: AcceptState) -> AcceptState:
+        """
+        Consume raw bytes through the Utf8Automaton: a byte that completes a
+        character takes the transition of its class in the lazy DFA, the other
+        bytes of a character only keep the stacks that can complete it. The
+        stacks that are done are kept, the input may end there.
+        """
+        if accept_state.state_id is None:
+            accept_state = self.states.intern(accept_state.stacks, accept_state.utf8_state)
+        next_states = self.utf8.next_states
+        classes = self.utf8.classes
+        for byte in byte_seq:
+            utf8_state = accept_state.utf8_state
+            code_point_class = classes[utf8_state][byte]
+            utf8_state = next_states[utf8_state][byte]
+            if code_point_class >= 0:
+                accept_state = self.state_dfa.next_class_state(accept_state, code_point_class)
+            elif utf8_state == UTF8_REJECT:
+                accept_state = self.states.intern([], UTF8_START)
+            else:
+                accept_state = self.states.intern(
+                    self._keep_partial(accept_state.stacks, utf8_state), utf8_state
+                )
+            if not accept_state.stacks:
+                break
+        return accept_state
 
     ##########################
     #
@@ -209,29 +420,40 @@ class StringRecognizer:
     #
     ##########################
 
-    @lru_cache(maxsize=30000)
     def _consume_code_point(
-        self, code_point: int, stacks: Tuple[Tuple[int]]
-    ) -> List[List[int]]:
+        self, code_point: int, stacks: Tuple[Stack, ...]
+    ) -> Tuple[Stack, ...]:
         """
         consume a character from the stack
         char_code_point: can be a Unicode code point, including ascii code points which are in the range [0, 127]
+        The new stacks are in canonical form, the duplicates that ambiguous
+        grammars produce are consumed only once in the next steps.
+        It is not cached, the transitions between parse states are, see
+        _consume_code_points_state.
         """
         new_stacks = []
 
-        stacks: List[List[int]] = list([list(stack) for stack in stacks])
         if code_point == 0:
-            return new_stacks
+            return ()
+        if self.arrays is not None and len(stacks) >= VECTORIZE_MIN_STACKS:
+            return canonical_stacks(self._step_stacks_vectorized(code_point, stacks))
         for stack in stacks:
-            new_stacks.extend(
-                self._consume_code_point_per_stack(code_point, tuple(stack))
-            )
-        return new_stacks
+            new_stacks.extend(self._consume_code_point_per_stack(code_point, stack))
+        return canonical_stacks(new_stacks)
 
-    @lru_cache(maxsize=30000)
     def _consume_code_point_per_stack(
-        self, code_point: int, stack: Tuple[int]
-    ) -> List[List[int]]:
+        self, code_point: int, stack: Stack
+    ) -> List[Stack]:
+        cache = self.caches["consume_code_point_per_stack"]
+        new_stacks = cache.get((code_point, stack))
+        if new_stacks is None:
+            new_stacks = self._consume_code_point_per_stack_uncached(code_point, stack)
+            cache.put((code_point, stack), new_stacks)
+        return new_stacks
+
+    def _consume_code_point_per_stack_uncached(
+        self, code_point: int, stack: Stack
+    ) -> List[Stack]:
         """
         consume a character from the stack
         char_code_point: can be a Unicode code point, including ascii code points which are in the range [0, 127]
@@ -241,63 +463,151 @@ class StringRecognizer:
         #     raise ValueError("Stacks don't contain any stack, meaning that no character can be consumed")
         # code_point = 0 is a special case when the uf8 sequence is not complete, we return an empty stack
         # to indicate that the character is not accepted
-        stack = list(stack)
         new_stacks = []
         if code_point == 0:
             return new_stacks
         # stack is empty
-        if len(stack) == 0:
+        if not stack:
             return new_stacks
 
-        element_offset = stack[-1]
-
-        found = self.accept_code_point_at_element(code_point, element_offset)
-        if not found:
+        next_element_offset = self._step_element(code_point, stack.top)
+        if next_element_offset < 0:
             return new_stacks
+        new_stack = stack.rest
+        if next_element_offset != END_OF_ALTERNATE_MARKER:
+            new_stack = new_stack.push(next_element_offset)
+        return self.advance_stack(new_stack)
 
-        size = self.grammar_encoding[element_offset]
-        element_offset += size + 1
-        new_stack = stack[:-1]
-        if self.grammar_encoding[element_offset]:
-            new_stack.append(element_offset)
-        return self.advance_stack(tuple(new_stack))
+    def _step_stacks(self, code_point: int, stacks: List[Stack]) -> List[Stack]:
+        """
+        Consume a code point on every stack, without the per-stack cache of
+        _consume_code_point_per_stack, e.g. for the walk over the token trie.
+        The new stacks have no duplicates, but they are not in canonical order.
+        """
+        if self.arrays is not None and len(stacks) >= VECTORIZE_MIN_STACKS:
+            return list(dict.fromkeys(self._step_stacks_vectorized(code_point, stacks)))
+        new_stacks = []
+        for stack in stacks:
+            if not stack:
+                continue
+            next_element_offset = self._step_element(code_point, stack.top)
+            if next_element_offset < 0:
+                continue
+            new_stack = stack.rest
+            if next_element_offset != END_OF_ALTERNATE_MARKER:
+                new_stack = new_stack.push(next_element_offset)
+            new_stacks.extend(self.advance_stack(new_stack))
+        return list(dict.fromkeys(new_stacks))
+
+    def _step_stacks_vectorized(
+        self, code_point: int, stacks: List[Stack]
+    ) -> List[Stack]:
+        """
+        Same as _step_stacks, with the range checks of all the stack tops done
+        in one pass over the arrays of the grammar. Only the stacks whose new
+        top is a reference, a repetition or an accepting DFA state go through
+        advance_stack, the others are complete already.
+        """
+        stacks = [stack for stack in stacks if stack]
+        if not stacks:
+            return []
+        tops = np.fromiter((stack.top for stack in stacks), dtype=np.int64, count=len(stacks))
+        owners, replacements = self.arrays.step(code_point, tops)
+        if len(owners) == 0:
+            return []
+
+        needs_advance = self.arrays.needs_advance[replacements].tolist()
+        new_stacks = []
+        for owner, replacement, advance in zip(
+            owners.tolist(), replacements.tolist(), needs_advance
+        ):
+            new_stack = stacks[owner].rest
+            if replacement:
+                new_stack = new_stack.push(replacement)
+                if not advance:
+                    new_stacks.append(new_stack)
+                    continue
+            new_stacks.extend(self.advance_stack(new_stack))
+        return new_stacks
+
+    def _step_element(self, code_point: int, element_offset: int) -> int:
+        """
+        Consume a code point at the element on top of a stack, i.e. a terminal
+        or a DFA state. Returns the offset of the element that replaces it on
+        the stack, END_OF_ALTERNATE_MARKER if it is just popped, or -1 if the
+        code point is not accepted or the rest of the alternative is dead.
+        """
+        if self.grammar_encoding[element_offset] == DFA_STATE_MARKER:
+            return self.tables.dfa_states[element_offset].next_state(code_point)
+        if code_point not in self.char_classes[element_offset]:
+            return -1
+        element_offset += self.grammar_encoding[element_offset] + 1
+        if self.grammar_encoding[element_offset] == END_OF_ALTERNATE_MARKER:
+            return END_OF_ALTERNATE_MARKER
+        # the rest of the alternative can never be completed, the stack is dead
+        if self.tables.is_dead(element_offset):
+            return -1
+        return element_offset
+
+    def _next_state(self, accept_state: AcceptState, code_point: int) -> AcceptState:
+        # the code point completes the pending bytes of the state if any
+        new_stacks = self._consume_code_point(code_point, accept_state.stacks)
+        return self.states.intern(new_stacks, UTF8_START)
+
+    def _consume_code_points_state(
+        self, code_points: List[int], accept_state: AcceptState, verbose=False
+    ) -> AcceptState:
+        """
+        Consume the code points from an accept state, through the lazy DFA over
+        the interned parse states: once a transition has been taken, taking it
+        again is a lookup.
+        """
+        if accept_state.state_id is None:
+            accept_state = self.states.intern(accept_state.stacks, accept_state.utf8_state)
+        if not verbose:
+            return self.state_dfa.run(accept_state, code_points)
+        for i, code_point in enumerate(code_points):
+            accept_state = self.state_dfa.next_state(accept_state, code_point)
+            if not accept_state.stacks:
+                break
+            accepted_code_point = code_points[: i + 1]
+            corresponding_char = chr(code_point)
+            logging.debug(
+                f"code point {accepted_code_point} corresponding to {corresponding_char} is accepted"
+            )
+        return accept_state
 
     def _consume_code_points(
-        self, code_points: List[int], stacks: List[List[int]], verbose=False
-    ) -> List[List[int]]:
+        self, code_points: List[int], stacks: List[Stack], verbose=False
+    ) -> List[Stack]:
+        """
+        Consume the code points from a list of stacks that is not a parse state
+        of its own, e.g. a single stack when probing a token, so it does not
+        go through the lazy DFA; the steps of the stacks are still cached.
+        """
+        stacks = canonical_stacks(stacks)
         for i, code_point in enumerate(code_points):
-            # for lru_cache to work, we need to convert the list of stacks into a tuple of stacks
-            tuple_stacks: Tuple[Tuple[int]] = tuple([tuple(stack) for stack in stacks])
-            stacks = self._consume_code_point(code_point, tuple_stacks)
-            if len(stacks) > 0 and verbose:
+            stacks = self._consume_code_point(code_point, stacks)
+            if not stacks:
+                break
+            if verbose:
                 accepted_code_point = code_points[: i + 1]
                 corresponding_char = chr(code_point)
                 logging.debug(
                     f"code point {accepted_code_point} corresponding to {corresponding_char} is accepted"
                 )
-        return stacks
+        return list(stacks)
 
     def _accept_code_points(
-        self, code_points: List[int], stacks: List[List[int]], verbose=False
+        self, code_points: List[int], stacks: List[Stack], verbose=False
     ) -> bool:
         stacks = self._consume_code_points(code_points, stacks, verbose)
         return len(stacks) > 0
 
-    @lru_cache(maxsize=30000)
     def accept_code_point_at_element(
         self, code_point: int, element_offset: int
     ) -> bool:
-        size = self.grammar_encoding[element_offset]
-        # to make idx point to the range_start of the first range
-        element_offset += 1
-        for i in range(0, size, 2):
-            if (
-                self.grammar_encoding[element_offset + i]
-                <= code_point
-                <= self.grammar_encoding[element_offset + i + 1]
-            ):
-                return True
-        return False
+        return code_point in self.char_classes[element_offset]
 
     # def _accept_code_point(self, code_point: int, stacks: List[List[int]]):
     #     # for lru_cache to work, we need to convert the list of stacks into a tuple of stacks
@@ -311,52 +621,20 @@ class StringRecognizer:
     #
     #############################
 
-    def partial_utf8_accept_at_element(
-        self, element_offset: int, partial_utf8: PartialUTF8
-    ) -> bool:
-        # Extract the accumulated value and the number of remaining bytes from the partial_utf8 object.
-        partial_value = partial_utf8.value
-        n_remain = partial_utf8.n_remain
-
-        # Return False if there are no remaining bytes to process or if it's an invalid UTF-8 sequence.
-        if n_remain == 1 and partial_value < 2:
-            return False
-
-        # If there are no remaining bytes, this means we had already consumed a complete UTF-8 sequence.
-        if n_remain <= 0:
-            return True
+    def partial_char_accept_at_element(self, element_offset: int, utf8_state: int) -> bool:
+        """
+        Whether the element accepts a character starting with the pending bytes of `utf8_state`.
+        """
+        return bool(self.element_classes[element_offset] & self.utf8.reachable[utf8_state])
 
-        # Calculate the lowest possible Unicode code point that can be formed with the remaining bytes.
-        low = partial_value << (n_remain * 6)
-        # Calculate the highest possible Unicode code point by setting all remaining bits to 1.
-        high = low | ((1 << (n_remain * 6)) - 1)
-
-        # If the low end of the range is 0 and a specific number of bytes remain, adjust low to the minimum value
-        # that can be represented with that number of bytes. This accounts for UTF-8 encoding rules.
-        if low == 0:
-            if n_remain == 2:
-                low = 1 << 11  # Minimum value representable with 2 additional bytes.
-            elif n_remain == 3:
-                low = 1 << 16  # Minimum value representable with 3 additional bytes.
-
-        # Get the size of the grammar rule starting at the current element_offset.
-        size = self.grammar_encoding[element_offset]
-        # Move the element_offset to the start of the grammar rule's definition.
-        element_offset += 1
-
-        # Iterate over the grammar rule, checking if the range defined by low-high overlaps with any specified ranges.
-        for i in range(0, size, 2):
-            # If the current range (specified in the grammar encoding) overlaps with the low-high range, return True.
-            if intervals_intersect(
-                low,
-                high,
-                self.grammar_encoding[element_offset + i],
-                self.grammar_encoding[element_offset + i + 1],
-            ):
-                return True
-
-        # If no overlap is found with any of the ranges, return False, indicating no valid partial match.
-        return False
+    def _keep_partial(self, stacks: List[Stack], utf8_state: int) -> List[Stack]:
+        """
+        The stacks that can go on with the pending bytes of `utf8_state`, the
+        empty stack accepts no character.
+        """
+        reachable = self.utf8.reachable[utf8_state]
+        element_classes = self.element_classes
+        return [stack for stack in stacks if stack and element_classes[stack.top] & reachable]
 
     #############################
     #
@@ -367,8 +645,7 @@ class StringRecognizer:
     def _consume_string(self, string: str, accept_state: AcceptState):
         # _bytes = bytes(string, "utf-8")
         code_points = [ord(char) for char in string]
-        stacks = self._consume_code_points(code_points, accept_state.stacks)
-        return AcceptState(stacks, accept_state.partial_utf8)
+        return self._consume_code_points_state(code_points, accept_state)
 
     def _accept_prefix(self, string: str, accept_state: AcceptState = None):
         if accept_state is None:
@@ -381,23 +658,47 @@ class StringRecognizer:
             accept_state = self.get_initial_accept_state()
         new_accept_state = self._consume_string(string, accept_state)
         at_least_one_stack_is_empty = any(
-            len(stack) == 0 for stack in new_accept_state.stacks
+            not stack for stack in new_accept_state.stacks
         )
         return at_least_one_stack_is_empty
 
-    def _can_stop(self, stacks: List[List[int]]):
+    def _can_stop(self, stacks: List[Stack]):
         # This happens in practice, but maybe it shouldn't? TODO
         if len(stacks) == 0:
             return True
-        # if any of the stack is empty, we can stop
+        # if the rest of any of the stacks derives the empty string, we can stop
+        return any(self.tables.stack_can_finish(stack) for stack in stacks)
+
+    def _must_stop(self, stacks: List[Stack]):
+        return not any(self.tables.stack_can_continue(stack) for stack in stacks)
+
+    def _first_bytes(self, stacks: List[Stack]) -> int:
+        """
+        Bitmask of the code points below 256 that at least one of the stacks can consume next.
+        """
+        first_bytes = 0
         for stack in stacks:
-            if len(stack) == 0:
-                return True
-        else:
-            return False
+            first_bytes |= self.tables.stack_first_bytes(stack)
+        return first_bytes
 
-    def _must_stop(self, stacks: List[List[int]]):
-        return len(stacks) == 0 or all(len(stack) == 0 for stack in stacks)
+    def _next_code_points(self, stacks: List[Stack]) -> CharClass:
+        """
+        The code points that at least one of the stacks can consume next.
+        """
+        return CharClass(
+            [
+                code_point_range
+                for stack in stacks
+                for code_point_range in self.tables.stack_first(stack)
+            ]
+        )
+
+    def _min_completion_length(self, stacks: List[Stack]) -> float:
+        """
+        The minimum number of code points that complete at least one of the
+        stacks, math.inf if none can be completed.
+        """
+        return min((self.tables.stack_min_length(stack) for stack in stacks), default=math.inf)
 
     #############################
     #
@@ -405,52 +706,13 @@ class StringRecognizer:
     #
     #############################
 
-    # For each sub-rule in the grammar, cache whether each byte is accepted.
-    @lru_cache(maxsize=None)
-    def char_acceptance_at_element(self, element_offset):
+    def char_acceptance_at_element(self, element_offset) -> CharClass:
         """
-        Caches and returns a dictionary indicating whether a Unicode character is accepted
-        at a given rule position. This function considers Unicode characters, dynamically
-        inserting accepted ranges into a dictionary to optimize memory usage.
+        Returns the precomputed membership structure of the code points accepted
+        at a given terminal element. It supports `code_point in acceptance` and
+        the dict-like `acceptance.get(code_point, False)`.
 
         Args:
-        - rule_offset: The offset in the grammar encoding where the rule starts.
-
-        Returns:
-        - A dictionary where each key is a Unicode character (or range) and the value is True if accepted.
-        """
-        logging.debug(f"element_offset: {element_offset}")
-        acceptance = {}
-        num_chars = self.grammar_encoding[element_offset]
-        element_offset += 1
-        for i in range(0, num_chars, 2):
-            start = self.grammar_encoding[element_offset + i]
-            end = self.grammar_encoding[element_offset + i + 1]
-            for j in range(start, end + 1):
-                acceptance[j] = True
-        logging.debug(acceptance)
-        return acceptance
-
-    def _consume_code_points_new(
-        self, code_points: List[int], stacks: List[List[int]], verbose=False
-    ) -> List[List[int]]:
-        new_stacks: List[List[int]] = []
-        for stack in stacks:
-            new_stacks.extend(
-                self._consume_code_points_per_stack(
-                    tuple(code_points), tuple(stack), verbose
-                )
-            )
-        return new_stacks
-
-    @lru_cache(maxsize=30000)
-    def _consume_code_points_per_stack(
-        self, code_points: Tuple[int], stack: Tuple[int], verbose=False
-    ) -> List[List[int]]:
-        code_points = list(code_points)
-        stacks = (stack,)
-        for i, code_point in enumerate(code_points):
-            # for lru_cache to work, we need to convert the list of stacks into a tuple of stacks
-            stacks = self._consume_code_point(code_point, stacks)
-            stacks = tuple([tuple(stack) for stack in stacks])
-        return [list(stack) for stack in stacks]
\ No newline at end of file
+        - element_offset: The offset in the grammar encoding of the terminal element.
+        """
+        return self.char_classes[element_offset]
@@ -0,0 +1,150 @@
+import itertools
+import weakref
+from typing import Iterable, Iterator, List, Tuple
+
+
+class Stack:
+    """
+    Persistent stack of element offsets, the top is `top` and the rest of
+    the stack is `rest`, another Stack.
+
+    Stacks are hash-consed: every stack is built by pushing onto EMPTY_STACK,
+    and there is a single node for each (top, rest) pair, so the stacks of a
+    parse state form a graph-structured stack where the common bottoms are
+    shared. Two stacks are equal iff they are the same object, so hashing
+    and comparing a stack is O(1) whatever its depth, and pushing or popping
+    never copies the rest of the stack.
+
+    A stack is immutable, copying it returns the stack itself. `serial` is
+    the creation order of the node, it orders the stacks of a parse state,
+    see canonical_stacks.
+    """
+
+    __slots__ = ("top", "rest", "depth", "serial", "__weakref__")
+
+    def push(self, element_offset: int) -> "Stack":
+        key = (element_offset, self)
+        node = _NODES.get(key)
+        if node is None:
+            node = object.__new__(Stack)
+            node.top = element_offset
+            node.rest = self
+            node.depth = self.depth + 1
+            node.serial = next(_SERIALS)
+            _NODES[key] = node
+        return node
+
+    def push_all(self, element_offsets: Iterable[int]) -> "Stack":
+        """
+        Push the element offsets from the first one to the last one.
+        """
+        stack = self
+        for element_offset in element_offsets:
+            stack = stack.push(element_offset)
+        return stack
+
+    def __len__(self) -> int:
+        return self.depth
+
+    def __bool__(self) -> bool:
+        return self.depth > 0
+
+    def __reversed__(self) -> Iterator[int]:
+        """
+        The element offsets from the top down.
+        """
+        stack = self
+        while stack.depth:
+            yield stack.top
+            stack = stack.rest
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        The element offsets from the bottom up, like a list with the top at the end.
+        """
+        return iter(self.to_list())
+
+    def to_list(self) -> List[int]:
+        elements = list(reversed(self))
+        elements.reverse()
+        return elements
+
+    def __repr__(self) -> str:
+        return f"Stack({self.to_list()})"
+
+    def __copy__(self) -> "Stack":
+        return self
+
+    def __deepcopy__(self, memo) -> "Stack":
+        return self
+
+    def __reduce__(self):
+        return make_stack, (self.to_list(),)
+
+
+# the interned nodes, keyed by (top, rest); a node is dropped with its last reference
+_NODES: "weakref.WeakValueDictionary" = weakref.WeakValueDictionary()
+_SERIALS = itertools.count()
+
+EMPTY_STACK = object.__new__(Stack)
+EMPTY_STACK.top = None
+EMPTY_STACK.rest = None
+EMPTY_STACK.depth = 0
+EMPTY_STACK.serial = next(_SERIALS)
+
+
+def make_stack(element_offsets: Iterable[int]) -> Stack:
+    """
+    The stack of a sequence of element offsets, with the top at the end.
+    """
+    if isinstance(element_offsets, Stack):
+        return element_offsets
+    return EMPTY_STACK.push_all(element_offsets)
+
+
+def _serial(stack: Stack) -> int:
+    return stack.serial
+
+
+def canonical_stacks(stacks: Iterable[Stack]) -> Tuple[Stack, ...]:
+    """
+    The set of stacks of a parse state in canonical form: without duplicates
+    and in creation order, so that equal sets of stacks are equal tuples.
+    """
+    return tuple(sorted(set(stacks), key=_serial))
+
+
+def encode_stacks(stacks: Iterable[Stack]) -> List[int]:
+    """
+    Flat encoding of a set of stacks that keeps their common bottoms shared:
+    the number of nodes, the top and the index of the rest of every node,
+    rest first and -1 for the empty stack, then the index of every stack.
+    """
+    stacks = list(stacks)
+    index = {EMPTY_STACK: -1}
+    nodes: List[Stack] = []
+    for stack in stacks:
+        chain = []
+        while stack not in index:
+            chain.append(stack)
+            stack = stack.rest
+        for node in reversed(chain):
+            index[node] = len(nodes)
+            nodes.append(node)
+    encoded = [len(nodes)]
+    for node in nodes:
+        encoded += (node.top, index[node.rest])
+    encoded += (index[stack] for stack in stacks)
+    return encoded
+
+
+def decode_stacks(encoded: List[int]) -> List[Stack]:
+    """
+    The stacks of an encoding by encode_stacks.
+    """
+    num_nodes = encoded[0]
+    nodes: List[Stack] = []
+    for i in range(num_nodes):
+        top, rest = encoded[1 + 2 * i], encoded[2 + 2 * i]
+        nodes.append((nodes[rest] if rest >= 0 else EMPTY_STACK).push(top))
+    return [nodes[i] if i >= 0 else EMPTY_STACK for i in encoded[1 + 2 * num_nodes :]]
@@ -0,0 +1,129 @@
+from transformers_gad.bulk import make_string_recognizer
+from transformers_gad.char_class import CharClass
+from transformers_gad.recognizer import AcceptState
+from transformers_gad.utf8_automaton import MAX_CODE_POINT, UTF8_START
+
+
+class StreamingValidator:
+    """
+    Incremental validation of a text that arrives in chunks of bytes, e.g.
+    the output of a model served elsewhere: `feed` consumes a chunk on the
+    current parse state, in O(len(chunk)) transitions of the recognizer,
+    whatever was fed before. A chunk may end in the middle of a multi-byte
+    character, its pending bytes are carried in the state.
+
+    A validator only holds its parse state, which is immutable and shared
+    with the other validators of the same recognizer, so one recognizer can
+    serve thousands of concurrent streams, each paying for its own chunks
+    only, and the transitions taken by one stream are cached for the others.
+    """
+
+    __slots__ = ("recognizer", "accept_state", "pending")
+
+    def __init__(self, recognizer, accept_state: AcceptState = None):
+        self.recognizer = recognizer
+        self.accept_state = (
+            accept_state if accept_state is not None else recognizer.get_initial_accept_state()
+        )
+        # the bytes of the character in progress, if any
+        self.pending = b""
+
+    @classmethod
+    def from_grammar(cls, grammar_str: str, start_rule_name: str = "root", **kwargs):
+        """
+        A validator with a recognizer of its own, see make_string_recognizer;
+        to validate many streams, share a recognizer between their validators.
+        """
+        return cls(make_string_recognizer(grammar_str, start_rule_name, **kwargs))
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Consume the next chunk of the text, and return is_prefix_valid().
+        Once the text is invalid, the chunks are ignored.
+        """
+        if self.accept_state.stacks and chunk:
+            self.accept_state = self.recognizer._feed_bytes(chunk, self.accept_state)
+            if self.accept_state.utf8_state == UTF8_START:
+                self.pending = b""
+            else:
+                self.pending = _incomplete_char(self.pending + chunk[-3:])
+        return bool(self.accept_state.stacks)
+
+    def is_prefix_valid(self) -> bool:
+        """
+        Whether the text fed so far is a prefix of a string of the grammar.
+        """
+        return bool(self.accept_state.stacks)
+
+    def can_finish(self) -> bool:
+        """
+        Whether the text fed so far is a string of the grammar.
+        """
+        stacks = self.accept_state.stacks
+        return (
+            bool(stacks)
+            and self.accept_state.utf8_state == UTF8_START
+            and self.recognizer._can_stop(stacks)
+        )
+
+    def expected_next_chars(self) -> CharClass:
+        """
+        The code points of the characters that can come next, those that
+        complete the pending bytes if a character is in progress. Empty if
+        the text is invalid or can only finish.
+        """
+        stacks = self.accept_state.stacks
+        if not stacks:
+            return CharClass([])
+        next_code_points = self.recognizer._next_code_points(stacks)
+        if not self.pending:
+            return next_code_points
+        low, high = _completions(self.pending)
+        return CharClass(
+            [
+                (max(start, low), min(end, high))
+                for start, end in next_code_points.ranges()
+                if start <= high and end >= low
+            ]
+        )
+
+    def reset(self, accept_state: AcceptState = None):
+        """
+        Start validating a new text, from the initial state by default.
+        """
+        self.accept_state = (
+            accept_state
+            if accept_state is not None
+            else self.recognizer.get_initial_accept_state()
+        )
+        self.pending = b""
+
+
+def _incomplete_char(tail: bytes) -> bytes:
+    """
+    The bytes of the last character of `tail`, which is incomplete: from its
+    last lead byte on.
+    """
+    for i in range(len(tail) - 1, -1, -1):
+        if tail[i] & 0xC0 != 0x80:
+            return tail[i:]
+    return tail
+
+
+def _completions(pending: bytes):
+    """
+    The range of the code points whose UTF-8 encoding starts with the bytes
+    of an incomplete character.
+    """
+    lead = pending[0]
+    if lead >= 0xF0:
+        length, value = 4, lead & 0x07
+    elif lead >= 0xE0:
+        length, value = 3, lead & 0x0F
+    else:
+        length, value = 2, lead & 0x1F
+    for byte in pending[1:]:
+        value = (value << 6) | (byte & 0x3F)
+    n_remain = length - len(pending)
+    low = value << (6 * n_remain)
+    return low, min(low + (1 << (6 * n_remain)) - 1, MAX_CODE_POINT)
@@ -1,26 +1,98 @@
 import copy
 import logging
+import math
 from abc import ABC
-from functools import lru_cache
-from typing import List
+from array import array
+from typing import List, Optional
 
 import torch
 
 from transformers_gad.recognizer import StringRecognizer, AcceptState
+from transformers_gad.backends import check_backend, make_recognizer
+from transformers_gad.cache import BoundedCache, CacheStats, cache_budget
+from transformers_gad.earley import Column
 from transformers_gad.parser import parse_ebnf
-from transformers_gad.trie import ByteTrie
-from transformers_gad.utf8_utils import PartialUTF8
+from transformers_gad.grammar_cache import load_compiled_grammar
+from transformers_gad.stack import Stack, canonical_stacks, decode_stacks, encode_stacks
+from transformers_gad.utf8_automaton import UTF8_REJECT, UTF8_START
 from .vocab_struct import LEAF, TokenTrie
 from transformers_gad.mapping import get_mapping
 
 logger = logging.getLogger(__name__)
 
 
+class ParseSnapshot:
+    """
+    Persistent parse state of a token sequence: the AcceptState after its
+    tokens, its last token and the snapshot before it. Snapshots are never
+    modified, so forking a sequence is sharing its snapshot, and rolling it
+    back is going up to a parent, whose state is kept, nothing is consumed
+    again. A snapshot built from an AcceptState is a root, it has no parent.
+    """
+
+    __slots__ = ("accept_state", "token_id", "parent", "num_tokens")
+
+    def __init__(
+        self,
+        accept_state: AcceptState,
+        token_id: Optional[int] = None,
+        parent: Optional["ParseSnapshot"] = None,
+        num_tokens: int = 0,
+    ):
+        self.accept_state = accept_state
+        self.token_id = token_id
+        self.parent = parent
+        # the number of tokens consumed to reach the state, since the start
+        self.num_tokens = num_tokens
+
+    def rollback(self, num_tokens: int = 1) -> "ParseSnapshot":
+        """
+        The snapshot before the last `num_tokens` tokens.
+        """
+        snapshot = self
+        for _ in range(num_tokens):
+            if snapshot.parent is None:
+                raise ValueError(
+                    f"Cannot roll back {num_tokens} tokens past the root of the snapshot"
+                )
+            snapshot = snapshot.parent
+        return snapshot
+
+    def token_ids(self) -> List[int]:
+        """
+        The tokens consumed from the root to the snapshot.
+        """
+        token_ids = []
+        snapshot = self
+        while snapshot.parent is not None:
+            token_ids.append(snapshot.token_id)
+            snapshot = snapshot.parent
+        token_ids.reverse()
+        return token_ids
+
+    def __repr__(self):
+        return f"ParseSnapshot({self.num_tokens} tokens, {self.accept_state})"
+
+
 class AbsTokenRecognizer(ABC):
-    def __init__(self, grammar_str, tokenizer, start_rule_name="root", unicode=False):
-        parsed_grammar = parse_ebnf(grammar_str)
-        grammar_encoding = parsed_grammar.grammar_encoding
-        self.start_rule_id = parsed_grammar.symbol_table.get(start_rule_name)
+    def __init__(
+        self,
+        grammar_str,
+        tokenizer,
+        start_rule_name="root",
+        unicode=False,
+        cache_dir=None,
+        optimize=False,
+        compile_dfa=False,
+        vectorized=False,
+        backend="stack",
+        cache_budgets=None,
+    ):
+        check_backend(backend, compile_dfa, vectorized)
+        compiled_grammar = load_compiled_grammar(
+            grammar_str, start_rule_name, cache_dir, optimize, compile_dfa
+        )
+        self.start_rule_id = compiled_grammar.start_rule_id
         self.byte_encoding = unicode
 
         if unicode and not tokenizer.__class__.__name__.lower().startswith(
@@ -34,12 +106,45 @@ class AbsTokenRecognizer(ABC):
         self.eos_token_id = tokenizer.eos_token_id
         self.token_trie = TokenTrie(tokenizer)
         self.tokenizer = tokenizer
-        self.string_recognizer = StringRecognizer(grammar_encoding, self.start_rule_id)
-        self.unicode_trie = ByteTrie.from_tokenizer(tokenizer, unicode=unicode)
+        self.string_recognizer, self.backend = make_recognizer(
+            compiled_grammar, backend, vectorized, cache_budgets
+        )
+        # the token masks by stack, they are released with the recognizer
+        self.token_acceptance_cache = BoundedCache(
+            "token_acceptance",
+            cache_budget("token_acceptance", cache_budgets),
+            size_of=lambda mask: mask.element_size() * mask.nelement(),
+        )
+        # the min completion lengths after the tokens by stack, for the length budgets
+        self.token_completion_cache = BoundedCache(
+            "token_completion",
+            cache_budget("token_completion", cache_budgets),
+            size_of=lambda lengths: lengths.element_size() * lengths.nelement(),
+        )
+        self._max_token_code_points = None
+        # the parse state after a token by (state, token id), shared by the
+        # logits processors that use this recognizer
+        self.token_transition_cache = BoundedCache(
+            "token_transition", cache_budget("token_transition", cache_budgets)
+        )
+        # the parse state after a forced prefix of tokens, by (state, prefix)
+        self.prefix_state_cache = BoundedCache(
+            "prefix_state", cache_budget("prefix_state", cache_budgets)
+        )
         self.mapping = get_mapping(tokenizer, unicode=unicode)
         assert len(self.mapping) == len(
             self.token_trie
         ), f"{len(self.mapping)}, {len(self.token_trie)}"
+        # the trie of the raw bytes of the tokens, the decoded tokens of the
+        # token trie replace the bytes of partial characters
+        if unicode:
+            self.byte_trie = {}
+            for token_id in range(len(self.mapping)):
+                self.token_trie.insert_into_trie(
+                    self.byte_trie, self.mapping.map(token_id), token_id
+                )
+        else:
+            self.byte_trie = self.token_trie.trie
 
     def _consume_token_id(
         self, token_id: int, accept_state: AcceptState
@@ -62,11 +167,32 @@ class AbsTokenRecognizer(ABC):
                     f"the stacks are {accept_state.stacks}"
                 )
 
-        bytes_or_codepoints = self.mapping.map(token_id)
-        accept_state = self.string_recognizer._consume_bytes(
-            bytes_or_codepoints, accept_state
-        )
-        return accept_state
+        return self._consume_token_bytes(token_id, accept_state)
+
+    def _consume_token_bytes(
+        self, token_id: int, accept_state: AcceptState, verbose=True
+    ) -> AcceptState:
+        """
+        The parse state after the bytes of the token. Accept states are
+        immutable and hashable, so the transitions are memoized by (state,
+        token id): the same token on the same state, e.g. the prefixes that
+        the oracle revisits, is consumed once. The bytes of a token may depend
+        on the previous token, e.g. after BOS for BPEMapping, so the context
+        of the mapping is part of the key.
+        """
+        if hasattr(token_id, "item"):
+            token_id = token_id.item()
+        key = (accept_state, token_id, self.mapping.context())
+        next_state = self.token_transition_cache.get(key)
+        if next_state is None:
+            bytes_or_codepoints = self.mapping.map(token_id)
+            next_state = self.string_recognizer._consume_bytes(
+                bytes_or_codepoints, accept_state, verbose=verbose
+            )
+            self.token_transition_cache.put(key, next_state)
+        else:
+            self.mapping.skip(token_id)
+        return next_state
 
     def probe_token_id(self, token_id: int, accept_state: AcceptState) -> bool:
         stacks = accept_state.stacks
@@ -82,25 +208,110 @@ class AbsTokenRecognizer(ABC):
                 return True
             else:
                 return False
-        # for code_point in self.mapping.map(token_id):
-        #     stacks = self.grammar._consume_char_code_point(code_point, stacks)
-        bytes_or_codepoints = self.mapping.map(token_id, verbose=False)
-        new_acc_state = self.string_recognizer._consume_bytes(
-            bytes_or_codepoints, accept_state, verbose=False
-        )
+        new_acc_state = self._consume_token_bytes(token_id, accept_state, verbose=False)
         return len(new_acc_state.stacks) > 0
 
+    def _consume_prefix(self, token_ids, accept_state: AcceptState = None) -> AcceptState:
+        """
+        The parse state after a prefix of tokens, e.g. the forced prefix from
+        parse_start_index, consumed token by token like the generated ones:
+        every token is a transition of the token cache, the prefix is neither
+        decoded nor consumed again as a string. The state reached is cached
+        by prefix and mapping context, so the same prefix in later
+        generations is one lookup.
+        """
+        if accept_state is None:
+            accept_state = self.string_recognizer.get_initial_accept_state()
+        if hasattr(token_ids, "tolist"):
+            token_ids = token_ids.tolist()
+        key = (accept_state, tuple(token_ids), self.mapping.context())
+        cached = self.prefix_state_cache.get(key)
+        if cached is not None:
+            # the state, and the number of tokens consumed before the state
+            # has no stacks left, the last of them is the context of the next
+            prefix_state, num_consumed = cached
+            if num_consumed:
+                self.mapping.skip(token_ids[num_consumed - 1])
+            return prefix_state
+        prefix_state = accept_state
+        num_consumed = 0
+        for token_id in token_ids:
+            prefix_state = self._consume_token_bytes(token_id, prefix_state, verbose=False)
+            num_consumed += 1
+            if not prefix_state.stacks:
+                break
+        self.prefix_state_cache.put(key, (prefix_state, num_consumed))
+        return prefix_state
+
+    def snapshot(self, accept_state: AcceptState = None) -> ParseSnapshot:
+        """
+        A root snapshot of `accept_state`, by default the initial state.
+        """
+        if accept_state is None:
+            accept_state = self.string_recognizer.get_initial_accept_state()
+        return ParseSnapshot(accept_state)
+
+    def fork(self, snapshot: ParseSnapshot, token_ids: List[int]) -> ParseSnapshot:
+        """
+        A branch of `snapshot` with the tokens consumed on top of it, the
+        snapshot itself is left as it is. The transitions are memoized, so a
+        branch that revisits the tokens of another one costs a lookup per token.
+        """
+        for token_id in token_ids:
+            accept_state = self._consume_token_id(token_id, snapshot.accept_state)
+            snapshot = ParseSnapshot(accept_state, token_id, snapshot, snapshot.num_tokens + 1)
+        return snapshot
+
+    def rollback(self, snapshot: ParseSnapshot, num_tokens: int = 1) -> ParseSnapshot:
+        """
+        The snapshot before the last `num_tokens` tokens of `snapshot`.
+        """
+        return snapshot.rollback(num_tokens)
+
+    def dumps_snapshot(self, snapshot: ParseSnapshot) -> bytes:
+        """
+        Compact serialization of the parse state of a snapshot, e.g. to hand
+        it to a worker process: the stacks are written once per shared node,
+        see encode_stacks. The history is not written, the loaded snapshot is
+        a root. Only the stack and LALR backends, whose states are Stacks,
+        can be serialized.
+        """
+        accept_state = snapshot.accept_state
+        if not all(isinstance(stack, Stack) for stack in accept_state.stacks):
+            raise ValueError(f"The parse states of the {self.backend} backend cannot be serialized.")
+        encoded = [accept_state.utf8_state, snapshot.num_tokens]
+        encoded += encode_stacks(accept_state.stacks)
+        return array("q", encoded).tobytes()
+
+    def loads_snapshot(self, data: bytes) -> ParseSnapshot:
+        """
+        The snapshot serialized by dumps_snapshot of a recognizer of the same grammar.
+        """
+        encoded = array("q")
+        encoded.frombytes(data)
+        utf8_state, num_tokens = encoded[0], encoded[1]
+        stacks = canonical_stacks(decode_stacks(encoded[2:]))
+        return ParseSnapshot(AcceptState(stacks, utf8_state), num_tokens=num_tokens)
+
     def advance_token_ids(self, *args, **kwargs):
         """Process a list of tokens according to the grammar rules."""
         raise NotImplementedError
 
-    def batch_filter_vocab(self, batch_accept_states, device) -> torch.Tensor:
+    def batch_filter_vocab(
+        self, batch_accept_states, device, remaining_tokens=None
+    ) -> torch.Tensor:
+        # the rows at the same parse state get the mask computed once for all of them
+        acceptances = {}
         batch_acceptance = []
         for accept_state in batch_accept_states:
-            batch_acceptance.append(self.filter_vocab(accept_state, device))
+            acceptance = acceptances.get(accept_state)
+            if acceptance is None:
+                acceptance = self.filter_vocab(accept_state, device, remaining_tokens)
+                acceptances[accept_state] = acceptance
+            batch_acceptance.append(acceptance)
         return torch.stack(batch_acceptance)
 
-    def filter_vocab(self, accept_state, device) -> torch.Tensor:
+    def filter_vocab(self, accept_state, device, remaining_tokens=None) -> torch.Tensor:
         if not accept_state.stacks:  # Check if stacks is empty
             # Handle the empty case: for example, return a tensor of False
             # The size of the tensor should match the size of your vocabulary
@@ -111,15 +322,96 @@ class AbsTokenRecognizer(ABC):
             accepts[self.eos_token_id] = True
             return torch.tensor(accepts, dtype=torch.bool, device=device)
 
+        if remaining_tokens is None:
+            return self.get_token_acceptance(accept_state, device)
+        # the walk over the trie that collects the completion lengths also
+        # caches the token masks, the acceptance is then looked up
+        lengths = self.get_token_completion_lengths(accept_state, device)
         acceptance = self.get_token_acceptance(accept_state, device)
-
-        return acceptance
+        return self.filter_vocab_within_budget(acceptance, lengths, remaining_tokens)
+
+    @property
+    def supports_length_budget(self) -> bool:
+        """
+        Whether the completion lengths of the length budgets are available,
+        only with the stack backend.
+        """
+        return isinstance(self.string_recognizer, StringRecognizer)
+
+    @property
+    def max_token_code_points(self) -> int:
+        """
+        The most code points a token can complete. A code point is completed
+        by an ASCII byte or a continuation byte, so it is the max number of
+        such bytes in a token, read from the byte trie without mapping the
+        tokens again.
+        """
+        if self._max_token_code_points is None:
+            max_code_points = 0
+            nodes = [(self.byte_trie, 0)]
+            while nodes:
+                node, code_points = nodes.pop()
+                for byte, child in node.items():
+                    if byte == LEAF:
+                        max_code_points = max(max_code_points, code_points)
+                    else:
+                        nodes.append((child, code_points + (byte < 0xC0)))
+            self._max_token_code_points = max_code_points
+        return self._max_token_code_points
+
+    def filter_vocab_within_budget(self, acceptance, lengths, remaining_tokens) -> torch.Tensor:
+        """
+        Mask the accepted tokens after which the sequence cannot be completed
+        within the budget, `remaining_tokens` counting the token being chosen:
+        the rest needs at least the min completion length, in code points, of
+        the parse state after the token, see get_token_completion_lengths, and
+        a token completes at most max_token_code_points code points. EOS is
+        kept if accepted. If no token fits the budget, those with the shortest
+        completion are kept, the sequence gets as close to an end as it can.
+        """
+        max_length = max(remaining_tokens - 1, 0) * self.max_token_code_points
+        within_budget = acceptance & (lengths <= max_length)
+        within_budget[self.eos_token_id] = acceptance[self.eos_token_id]
+        if not within_budget.any():
+            shortest = lengths[acceptance].min()
+            within_budget = acceptance & (lengths <= shortest)
+        return within_budget
+
+    def get_token_completion_lengths(self, accept_state, device) -> torch.Tensor:
+        """
+        For every token, the min completion length of the parse state after
+        it, math.inf for the rejected tokens and EOS.
+        """
+        if not self.supports_length_budget:
+            raise ValueError(
+                f"Length budgets are only supported by the stack backend, not {self.backend}."
+            )
+        lengths = [
+            self.get_token_completion_lengths_for_stack(stack, accept_state.utf8_state, device)
+            for stack in accept_state.stacks
+        ]
+        return torch.stack(lengths).amin(dim=0)
+
+    def get_token_completion_lengths_for_stack(self, stack, utf8_state, device):
+        key = (stack, utf8_state, device)
+        lengths = self.token_completion_cache.get(key)
+        if lengths is None:
+            # a single walk over the trie gets the token mask of the stack too
+            min_lengths = [math.inf] * len(self.mapping)
+            acceptance = self._get_token_acceptance_array_for_stack(
+                stack, utf8_state, device, min_lengths
+            )
+            if key not in self.token_acceptance_cache:
+                self.token_acceptance_cache.put(key, acceptance)
+            lengths = torch.tensor(min_lengths, dtype=torch.float, device=device)
+            self.token_completion_cache.put(key, lengths)
+        return lengths
 
     def get_token_acceptance(self, accept_state, device) -> torch.Tensor:
         acceptance_matrix = torch.cat(
             [
                 self.get_token_acceptance_array_for_stack(
-                    tuple(stack), accept_state.partial_utf8, device
+                    stack, accept_state.utf8_state, device
                 )
                 for stack in accept_state.stacks
             ]
@@ -128,33 +420,55 @@ class AbsTokenRecognizer(ABC):
         acceptance = acceptance_matrix.reshape(len(accept_state.stacks), -1).any(dim=0)
         return acceptance
 
-    @lru_cache(maxsize=32768)
-    def get_token_acceptance_array_for_stack(self, stack, partial_utf8, device):
-        # stack = list(stack)  # needs to come in as a tuple for lru_cache
-        assert isinstance(stack, tuple)
-        stack = list(stack)
-
-        if self.byte_encoding:
+    def get_token_acceptance_array_for_stack(self, stack, utf8_state, device):
+        # stacks, including LR stacks, are hash-consed and Earley columns are
+        # never modified, they can be keys of the cache as they are
+        assert isinstance(stack, (Stack, Column))
+        key = (stack, utf8_state, device)
+        acceptance = self.token_acceptance_cache.get(key)
+        if acceptance is None:
+            acceptance = self._get_token_acceptance_array_for_stack(stack, utf8_state, device)
+            self.token_acceptance_cache.put(key, acceptance)
+        return acceptance
 
-            accept_f = lambda x: self.string_recognizer._probe_bytes(
-                x, [stack], partial_utf8=partial_utf8
-            )
-            token_acceptance = self.unicode_trie.get_token_acceptance(
-                accept=accept_f, accept_eos=False, eos_token_id=self.eos_token_id
-            )
-        else:
-            accepts = [False] * len(self.mapping)
-            token_acceptance = check_token_acceptance_in_trie(
-                self.token_trie.trie,
-                [stack],
-                self.string_recognizer,
-                self.eos_token_id,
-                accepts,
-            )
+    def _get_token_acceptance_array_for_stack(self, stack, utf8_state, device, min_lengths=None):
+        accepts = [False] * len(self.mapping)
+        token_acceptance = check_token_acceptance_in_trie(
+            self.byte_trie,
+            [stack],
+            self.string_recognizer,
+            self.eos_token_id,
+            accepts,
+            utf8_state,
+            min_lengths,
+        )
         x = torch.tensor(token_acceptance, dtype=torch.bool, device=device)
         x_eos = self.validate_and_set_eos_acceptance(x)
         return x_eos
 
+    def cache_stats(self) -> List[CacheStats]:
+        """
+        The counters of the token mask, completion, transition and prefix
+        caches and of the caches of the string recognizer.
+        """
+        return [
+            self.token_acceptance_cache.stats(),
+            self.token_completion_cache.stats(),
+            self.token_transition_cache.stats(),
+            self.prefix_state_cache.stats(),
+        ] + self.string_recognizer.cache_stats()
+
+    def close(self):
+        """
+        Release the cached token masks, completion lengths, transitions and
+        prefix states and the caches of the string recognizer.
+        """
+        self.token_acceptance_cache.close()
+        self.token_completion_cache.close()
+        self.prefix_state_cache.close()
+        self.token_transition_cache.close()
+        self.string_recognizer.close()
+
     def validate_and_set_eos_acceptance(self, acceptance: torch.Tensor) -> torch.Tensor:
         if torch.any(acceptance) == 0:
             acceptance[self.eos_token_id] = True
@@ -166,8 +480,31 @@ class AbsTokenRecognizer(ABC):
 
 
 class IncrementalTokenRecognizer(AbsTokenRecognizer):
-    def __init__(self, grammar_str, start_rule_name, tokenizer, unicode=False):
-        super().__init__(grammar_str, tokenizer, start_rule_name, unicode)
+    def __init__(
+        self,
+        grammar_str,
+        start_rule_name,
+        tokenizer,
+        unicode=False,
+        cache_dir=None,
+        optimize=False,
+        compile_dfa=False,
+        vectorized=False,
+        backend="stack",
+        cache_budgets=None,
+    ):
+        super().__init__(
+            grammar_str,
+            tokenizer,
+            start_rule_name,
+            unicode,
+            cache_dir,
+            optimize,
+            compile_dfa,
+            vectorized,
+            backend,
+            cache_budgets,
+        )
         self.last_size = None
         self.is_incremental = True
 
@@ -186,7 +523,7 @@ class IncrementalTokenRecognizer(AbsTokenRecognizer):
 
             # self.grammar_acceptor.accept_token_ids(prefix_to_parse, self.stacks)
             batch_accept_states = [
-                self._consume_token_ids(prefix, accept_state)
+                self._consume_prefix(prefix, accept_state)
                 for prefix, accept_state in zip(prefix_to_parse, batch_accept_states)
             ]
             #  if the length of the current input IDs (input_ids[0]) is exactly one more than self.last_size.
@@ -242,7 +579,19 @@ class IncrementalTokenRecognizer(AbsTokenRecognizer):
     def reset(self):
         self.last_size = None
 
-def check_token_acceptance_in_trie(trie, stacks, grammar, eos_token_id, accepts):
+def check_token_acceptance_in_trie(
+    trie, stacks, grammar, eos_token_id, accepts, utf8_state=UTF8_START, min_lengths=None
+):
+    # the bytes are read by the Utf8Automaton of the grammar, `utf8_state` is
+    # the state in the bytes of a multi-byte character, if any
+    # if `min_lengths` is given, it also gets the min completion length of
+    # the stacks after every accepted token
+    utf8 = grammar.utf8
+    next_states = utf8.next_states[utf8_state]
+    classes = utf8.classes[utf8_state]
+    # the ASCII bytes that at least one of the stacks can consume next,
+    # the children for the other ASCII bytes are pruned without visiting them
+    first_bytes = grammar._first_bytes(stacks) if utf8_state == UTF8_START else 0
 
     for byte, next_trie in trie.items():
         if byte == LEAF:
@@ -251,31 +600,29 @@ def check_token_acceptance_in_trie(trie, stacks, grammar, eos_token_id, accepts)
                 # if the stacks is not empty, it means we can still continue to parse
                 # so we should accept the token
                 accepts[token_id] = bool(stacks)
+                if min_lengths is not None and stacks:
+                    min_lengths[token_id] = grammar._min_completion_length(stacks)
             continue
-
-        new_stacks = []
-        for stk in stacks:
-            if not stk:
+        next_utf8_state = next_states[byte]
+        code_point_class = classes[byte]
+        if code_point_class >= 0:
+            if byte < 0x80 and not (first_bytes >> byte) & 1:
                 continue
-
-            next_element_offset = stk[-1]
-            num_chars = grammar.grammar_encoding[next_element_offset]
-
-            if not grammar.char_acceptance_at_element(next_element_offset).get(
-                byte, False
-            ):
-                # if the current byte is not accepted by the current rule, we need to try next rule
-                continue
-
-            next_element_offset += num_chars + 1
-            new_stack = stk[:-1]
-            if grammar.grammar_encoding[next_element_offset]:
-                new_stack.append(next_element_offset)
-            new_stacks.extend(grammar.advance_stack(tuple(new_stack)))
+            new_stacks = grammar._step_stacks(utf8.representatives[code_point_class], stacks)
+        elif next_utf8_state == UTF8_REJECT:
+            continue
+        else:
+            new_stacks = grammar._keep_partial(stacks, next_utf8_state)
 
         if new_stacks:
             check_token_acceptance_in_trie(
-                next_trie, new_stacks, grammar, eos_token_id, accepts
+                next_trie,
+                new_stacks,
+                grammar,
+                eos_token_id,
+                accepts,
+                next_utf8_state,
+                min_lengths,
             )
 
     return accepts
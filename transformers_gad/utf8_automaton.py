@@ -0,0 +1,156 @@
+from bisect import bisect_right
+from typing import Dict, List, Sequence, Tuple
+
+from transformers_gad.char_class import CharClass
+
+# the state between two characters, no byte of the next one consumed yet
+UTF8_START = 0
+# the target of a byte that no valid UTF-8 sequence continues with
+UTF8_REJECT = -1
+
+MAX_CODE_POINT = 0x10FFFF
+SURROGATES = (0xD800, 0xDFFF)
+
+
+class Utf8Automaton:
+    """
+    Byte-level automaton of the UTF-8 encodings of the code points, compiled
+    from the code point classes of a grammar, see code_point_boundaries: it
+    reads the bytes of a token one at a time and yields the class of every
+    complete character, so that recognizers consume raw bytes without
+    decoding them.
+
+    State UTF8_START is between two characters, the other states are the
+    prefixes of a multi-byte character, merged when they lead to the same
+    classes on the same continuations, so there is one state per distinct
+    split of the grammar classes, not per prefix. `reachable[state]` is the
+    bitmask of the classes of the characters that can complete the prefix,
+    a stack can go on with the prefix iff its top accepts one of them.
+
+    Only valid UTF-8 is accepted: overlong encodings, surrogates, code
+    points past U+10FFFF and NUL (code point 0 is never accepted) lead to
+    UTF8_REJECT.
+    """
+
+    def __init__(self, boundaries: Sequence[int]):
+        self.boundaries = list(boundaries)
+        # by state and byte: the next state, and the class of the character
+        # the byte completes or -1
+        self.next_states: List[List[int]] = []
+        self.classes: List[List[int]] = []
+        self.reachable: List[int] = []
+        self._states: Dict[Tuple, int] = {}
+
+        start = self._new_state()
+        for byte in range(0x01, 0x80):
+            self.next_states[start][byte] = UTF8_START
+            self.classes[start][byte] = self.code_point_class(byte)
+        # the lead bytes, with the code points of their sequences
+        for byte in range(0xC2, 0xE0):
+            self.next_states[start][byte] = self._prefix_state((byte & 0x1F) << 6, 1, 0x80)
+        for byte in range(0xE0, 0xF0):
+            self.next_states[start][byte] = self._prefix_state((byte & 0x0F) << 12, 2, 0x800)
+        for byte in range(0xF0, 0xF5):
+            self.next_states[start][byte] = self._prefix_state((byte & 0x07) << 18, 3, 0x10000)
+        self.reachable[start] = ~0
+        self.representatives: List[int] = [0] + self.boundaries
+
+    def _new_state(self) -> int:
+        self.next_states.append([UTF8_REJECT] * 256)
+        self.classes.append([-1] * 256)
+        self.reachable.append(0)
+        return len(self.next_states) - 1
+
+    def code_point_class(self, code_point: int) -> int:
+        return bisect_right(self.boundaries, code_point)
+
+    def _prefix_state(self, low: int, n_remain: int, min_code_point: int) -> int:
+        """
+        The state after the bytes of a character whose completions are the
+        code points [low, low + 64 ** n_remain), of which those from
+        `min_code_point` on are not overlong.
+        """
+        high = low + (1 << (6 * n_remain)) - 1
+        if not _valid_block(low, high, min_code_point):
+            return UTF8_REJECT
+        low_class = self.code_point_class(low)
+        if low_class == self.code_point_class(high) and _valid_block(
+            low, high, min_code_point, partially=False
+        ):
+            # every completion is in the same class, whatever the prefix
+            key = (n_remain, low_class)
+            if key in self._states:
+                return self._states[key]
+        else:
+            key = None
+
+        step = 1 << (6 * (n_remain - 1))
+        targets = []
+        for k in range(64):
+            sub_low = low + k * step
+            if n_remain == 1:
+                valid = _valid_block(sub_low, sub_low, min_code_point)
+                targets.append(self.code_point_class(sub_low) if valid else -1)
+            else:
+                targets.append(self._prefix_state(sub_low, n_remain - 1, min_code_point))
+        signature = (n_remain, tuple(targets))
+        state = self._states.get(signature)
+        if state is None:
+            state = self._new_state()
+            reachable = 0
+            for k, target in enumerate(targets):
+                if n_remain == 1:
+                    if target >= 0:
+                        self.next_states[state][0x80 + k] = UTF8_START
+                        self.classes[state][0x80 + k] = target
+                        reachable |= 1 << target
+                elif target != UTF8_REJECT:
+                    self.next_states[state][0x80 + k] = target
+                    reachable |= self.reachable[target]
+            self.reachable[state] = reachable
+            self._states[signature] = state
+        if key is not None:
+            self._states[key] = state
+        return state
+
+    def step(self, state: int, byte: int) -> Tuple[int, int]:
+        """
+        The next state and the class of the character completed by the byte,
+        -1 if the character is not complete.
+        """
+        return self.next_states[state][byte], self.classes[state][byte]
+
+    def class_mask(self, char_class: CharClass) -> int:
+        """
+        Bitmask of the classes of the code points of `char_class`.
+        """
+        mask = 0
+        for start, end in char_class.ranges():
+            first = self.code_point_class(start)
+            last = self.code_point_class(end)
+            mask |= ((1 << (last - first + 1)) - 1) << first
+        return mask
+
+    @property
+    def num_states(self) -> int:
+        return len(self.next_states)
+
+
+def _valid_block(low: int, high: int, min_code_point: int, partially: bool = True) -> bool:
+    """
+    Whether some (or, with partially=False, all) code points of [low, high]
+    can be encoded in a UTF-8 sequence whose shortest code point is
+    `min_code_point`. The blocks are aligned, so they are either inside or
+    outside the surrogates.
+    """
+    if partially:
+        return (
+            high >= min_code_point
+            and low <= MAX_CODE_POINT
+            and not (SURROGATES[0] <= low and high <= SURROGATES[1])
+        )
+    return (
+        low >= min_code_point
+        and high <= MAX_CODE_POINT
+        and (high < SURROGATES[0] or low > SURROGATES[1])
+    )